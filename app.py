@@ -1,18 +1,18 @@
 import streamlit as st
-import imaplib
-import email
-from email.header import decode_header
-import joblib
-import pandas as pd
-import re
-import time
-import datetime
 import os
 import hashlib
+import time
+import uuid
 import streamlit.components.v1 as components
 import auth_utils
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
-import subprocess
+import imap_utils
+import model_utils
+import cache_utils
+import history_utils
+import blob_utils
+import inbox_utils
+import scanner_utils
+import metrics_utils
 
 # --- 1. PAGE CONFIG ---
 st.set_page_config(
@@ -143,62 +143,31 @@ st.markdown("""
 
 # --- 3. CONSTANTS & STATE ---
 
-if 'data' not in st.session_state:
-    st.session_state.data = pd.DataFrame()
+if 'inbox' not in st.session_state:
+    st.session_state.inbox = inbox_utils.InboxModel()
 
 if 'seen_emails' not in st.session_state:
     st.session_state.seen_emails = set()
 
-if 'monitoring' not in st.session_state: st.session_state.monitoring = False
 if 'scan_status' not in st.session_state: st.session_state.scan_status = "Idle"
 if 'last_scan_time' not in st.session_state: st.session_state.last_scan_time = None
-if 'last_max_id' not in st.session_state: st.session_state.last_max_id = 0
+if 'scan_error' not in st.session_state: st.session_state.scan_error = None
+if 'new_email_count' not in st.session_state: st.session_state.new_email_count = 0
+if 'render_scheduler' not in st.session_state: st.session_state.render_scheduler = None
+# (ID, Sender, Subject) of the rows loaded from history, so scanner events for the
+# same rows (saved just before the load) are not added twice
+if 'history_keys' not in st.session_state: st.session_state.history_keys = set()
 if 'current_user' not in st.session_state: st.session_state.current_user = None
 if 'oauth_token' not in st.session_state: st.session_state.oauth_token = None
-if 'model_obj' not in st.session_state: st.session_state.model_obj = None
-if 'model_kind' not in st.session_state: st.session_state.model_kind = None
-if 'model_label_map' not in st.session_state:
-    st.session_state.model_label_map = {0: "Low", 1: "Medium", 2: "High"}
-
-# Default model directory (for HF zip/unzip artifact)
-# Point to the distilled model by default; override via env as needed
-MODEL_DIR = os.getenv("MODEL_DIR", "./final_transformer_model")
-ASSET_URL = os.getenv(
-    "MODEL_ASSET_URL",
-    "https://github.com/PerseusJ/NeuroMail/releases/download/v1.0/email_model_transformer.zip"
-)
+# This session's subscription to the account scanner's events (one queue per tab)
+if 'scan_subscriber' not in st.session_state: st.session_state.scan_subscriber = uuid.uuid4().hex
 
-# --- MODEL ARTIFACT FETCHER ---
-def ensure_model_present():
-    """
-    Ensure the HF model directory exists by downloading/unzipping the release asset if missing.
-    Honors MODEL_DIR and optional GITHUB_TOKEN (for private releases).
-    """
-    config_path = os.path.join(MODEL_DIR, "config.json")
-    if os.path.exists(config_path):
-        return
-
-    os.makedirs(MODEL_DIR, exist_ok=True)
-    
-    # Use a path inside MODEL_DIR for Windows compatibility
-    zip_path = os.path.join(MODEL_DIR, "model.zip")
-
-    token = os.getenv("GITHUB_TOKEN")
-    if token:
-        curl_cmd = ["curl", "-L", "-H", f"Authorization: Bearer {token}", ASSET_URL, "-o", zip_path]
-    else:
-        curl_cmd = ["curl", "-L", ASSET_URL, "-o", zip_path]
-
-    subprocess.run(curl_cmd, check=True)
-    
-    # Use python's built-in zipfile for cross-platform support (Windows doesn't have 'unzip' by default)
-    import zipfile
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(MODEL_DIR)
-        
-    # Clean up the zip file
-    if os.path.exists(zip_path):
-        os.remove(zip_path)
+# Monitoring: "push" holds an IMAP IDLE connection per account, "poll" re-scans every
+# SCAN_POLL_SECONDS while mail arrives and backs off while the inbox is quiet
+MONITOR_MODES = ["Push (IMAP IDLE)", "Poll (adaptive)"]
+MONITOR_MODE = os.getenv("MONITOR_MODE", "push")
+# How often an open page checks the background scanner for new results
+SCANNER_UI_POLL_SECONDS = float(os.getenv("SCANNER_UI_POLL_SECONDS", "1"))
 
 # --- 4. HELPER FUNCTIONS ---
 def get_user_history_file(email_address):
@@ -206,282 +175,109 @@ def get_user_history_file(email_address):
     safe_name = hashlib.md5(email_address.strip().lower().encode()).hexdigest()
     return f"scan_history_{safe_name}.csv"
 
-def clean_text(text):
-    if text is None: return ""
-    if isinstance(text, bytes): text = text.decode(errors='ignore')
-    text = str(text).replace('"', '').replace("'", "").replace("\n", " ").replace("\t", " ")
-    return re.sub(' +', ' ', text).strip()
-
-def safe_decode_header(header_value):
-    if not header_value: return "No Subject"
-    try:
-        headers = decode_header(header_value)
-        parts = []
-        for content, encoding in headers:
-            if isinstance(content, bytes):
-                parts.append(content.decode(encoding or 'utf-8', errors='ignore'))
-            else:
-                parts.append(str(content))
-        return "".join(parts)
-    except: return str(header_value)
-
-def get_email_content(msg):
-    body_text = ""
-    body_html = ""
-    tokens = []
-    
-    if msg.is_multipart():
-        for part in msg.walk():
-            ctype = part.get_content_type()
-            
-            if ctype == "text/plain":
-                try: body_text = part.get_payload(decode=True).decode(errors='ignore')
-                except: pass
-            elif ctype == "text/html":
-                try: body_html = part.get_payload(decode=True).decode(errors='ignore')
-                except: pass
-                
-            if part.get_filename():
-                fname = part.get_filename().lower()
-                if ".pdf" in fname: tokens.append("PDF")
-                elif ".jpg" in fname or ".jpeg" in fname or ".png" in fname: tokens.append("IMG")
-                elif "invite" in fname: tokens.append("CALENDAR")
-    else:
-        # Not multipart, payload is body
-        try:
-            payload = msg.get_payload(decode=True).decode(errors='ignore')
-            if msg.get_content_type() == "text/html":
-                body_html = payload
-            else:
-                body_text = payload
-        except: pass
-        
-    # If we found HTML but no Text, use HTML as text (cleaned) for classification
-    # If we found Text but no HTML, simple.
-    
-    final_text_for_model = clean_text(body_text) if body_text else clean_text(re.sub('<[^<]+?>', '', body_html))
-    
-    return final_text_for_model, body_text, body_html, tokens
-
-def save_history(user_email):
-    fname = get_user_history_file(user_email)
-    if fname and not st.session_state.data.empty:
-        st.session_state.data.to_csv(fname, index=False)
+def get_user_history_db(email_address):
+    if not email_address: return None
+    safe_name = hashlib.md5(email_address.strip().lower().encode()).hexdigest()
+    return f"scan_history_{safe_name}.db"
 
-def process_single_email(msg, model, e_id_int):
-    sub = safe_decode_header(msg["Subject"])
-    snd_raw = msg.get("From", "")
-    snd = safe_decode_header(snd_raw).replace("<", "").replace(">", "")
-    
-    # Extract content (Text for Model, HTML for Display)
-    c_b_model, body_plain, body_html, toks = get_email_content(msg)
-    
-    c_s, c_sub = clean_text(snd), clean_text(sub)
-    tok_str = " ".join(toks)
-    
-    # Deduplication removed per user request: show all emails even near-duplicates
-    # (previously used sender+subject+body signature)
-
-    # Prediction — align with training input format (sender + subject + body)
-    full_input = f"{c_s} {c_sub} {c_b_model}"
-    priority_label = "Unknown"
-    prob = 0.0
-
-    if st.session_state.model_kind == "hf_pipeline":
-        # Hugging Face pipeline returns list of dicts
-        results = model(full_input)[0]
-        results = sorted(results, key=lambda x: x.get("score", 0), reverse=True)
-        top = results[0] if results else {}
-        priority_label = top.get("label", "Unknown")
-        prob = top.get("score", 0.0)
-    else:
-        try:
-            pred = model.predict([full_input])[0]
-            prob = max(model.predict_proba([full_input])[0])
-        except:
-            pred = "Unknown"
-            prob = 0.0
-
-        label_map = st.session_state.model_label_map
-        if isinstance(pred, int):
-            priority_label = label_map.get(pred, "Unknown")
-        else:
-            priority_label = str(pred)
-
-    if priority_label == '0': priority_label = "Low"
-    if priority_label == '1': priority_label = "Medium"
-    if priority_label == '2': priority_label = "High"
-
-    row = {
-        "Time": datetime.datetime.now().strftime("%H:%M:%S"),
-        "Priority": priority_label,
-        "Confidence": prob,
-        "Sender": c_s,
-        "Subject": c_sub,
-        "Tokens": toks,
-        "Content": c_b_model[:500], # Short snippet for legacy/debug
-        "ContentFull": body_plain,  # Full Plain Text
-        "ContentHtml": body_html,   # Full HTML
-        "ID": e_id_int
-    }
-    
-    return row
+def get_user_blob_store(email_address):
+    """Out-of-frame email bodies (compressed, content-addressed) for this user."""
+    if not email_address: return None
+    safe_name = hashlib.md5(email_address.strip().lower().encode()).hexdigest()
+    return blob_utils.get_blob_store(f"email_bodies_{safe_name}")
+
+def get_user_history_store(email_address):
+    path = get_user_history_db(email_address)
+    if not path: return None
+    store = history_utils.get_history_store(path, blobs=get_user_blob_store(email_address))
+    # One-time migration of the legacy CSV history (renamed to *.imported afterwards)
+    imported = store.import_csv(get_user_history_file(email_address))
+    if imported:
+        print(f"Imported {imported} rows from legacy CSV history into {path}")
+    return store
+
+def get_user_sync_file(email_address):
+    """UID/UIDVALIDITY high-water mark, stored next to the scan history."""
+    if not email_address: return None
+    safe_name = hashlib.md5(email_address.strip().lower().encode()).hexdigest()
+    return f"sync_state_{safe_name}.json"
 
 # --- 5. SCANNING LOGIC ---
-def run_scan_cycle(model, server, user, limit, placeholder_metrics, placeholder_table, placeholder_status, placeholder_detail):
-    try:
-        # REFRESH TOKEN LOGIC
-        token_data = st.session_state.get('oauth_token')
-        if not token_data:
-             raise Exception("Not authenticated")
-
-        if token_data['provider'] == 'google':
-            token_data = auth_utils.refresh_google_token(token_data)
-            if not token_data: raise Exception("Token refresh failed")
-            access_token = token_data['token']
-        else:
-            token_data = auth_utils.refresh_microsoft_token(token_data)
-            if not token_data: raise Exception("Token refresh failed")
-            access_token = token_data.get('access_token')
-        
-        # Update session
-        st.session_state['oauth_token'] = token_data
-
-        # Connect with XOAUTH2
-        # IMAP authenticate command typically expects base64 encoded SASL response
-        auth_str = auth_utils.generate_oauth2_string(user, access_token, base64_encode=False)
-        
-        mail = imaplib.IMAP4_SSL(server, 993)
-        # XOAUTH2 requires specific auth mechanism
-        # We pass the auth string directly to the authentication method
-        # Note: imaplib authenticate() typically handles the base64 encoding if the mechanism expects it, 
-        # but for XOAUTH2 it often expects the raw SASL string or we need to check how imaplib sends it.
-        # Actually, standard imaplib.authenticate('XOAUTH2', ...) usually expects a callable that returns the *unencoded* bytes or string
-        # which it then encodes? Or it expects the encoded string?
-        # Let's try passing the auth string generator which returns it.
-        # If the server rejects "Invalid SASL argument", it often means double encoding or wrong format.
-        # Let's try passing the callable that constructs the string.
-        # BUT for imaplib, the second arg is `authobject` which must be a callable returning the response.
-        
-        # FIX: The XOAUTH2 string format is user=...\x01auth=Bearer ...\x01\x01
-        # It seems imaplib's authenticate helper doesn't auto-encode for custom mechanisms like XOAUTH2 in older versions?
-        # Wait, if we use the lambda, `imaplib` sends the result of the lambda as the initial client response.
-        # If the server requires it base64 encoded, we must return the base64 encoded string.
-        
-        auth_str_encoded = auth_utils.generate_oauth2_string(user, access_token, base64_encode=False)
-        
-        # Try Authenticate with explicit mechanism
-        # Using the standard approach for Gmail/Outlook XOAUTH2 with imaplib
-        # We usually define a helper class or just pass the lambda
-        mail.authenticate('XOAUTH2', lambda x: auth_str_encoded)
-        mail.select("inbox")
-
-        # Search for UNSEEN messages instead of ALL
-        # We use UNSEEN to get only unread messages
-        _, messages = mail.search(None, 'UNSEEN')
-        raw_ids = messages[0].split()
-        
-        if not raw_ids:
-            st.session_state.scan_status = "No Unread Emails"
-            mail.logout()
-            return
+def get_imap_server(provider):
+    return "imap.gmail.com" if provider == 'google' else "outlook.office365.com"
 
-        # Convert to ints and sort descending (newest first)
-        all_ids = sorted([int(x) for x in raw_ids], reverse=True)
+def start_scanner(model, server, user, limit, push):
+    """
+    Start (or reuse) the account's background scanner; it keeps running across reruns.
+    A running scanner with a different batch size or mode is restarted with these.
+    """
+    blobs = get_user_blob_store(user)
+    return scanner_utils.start_scanner(
+        server, user,
+        subscriber=st.session_state.scan_subscriber,
+        token_data=st.session_state.oauth_token,
+        model=model,
+        build_row=lambda parsed, label, prob: scanner_utils.build_row(parsed, label, prob, blobs=blobs),
+        history_store=get_user_history_store(user),
+        sync_path=get_user_sync_file(user),
+        limit=limit,
+        push=push,
+    )
 
-        processed_count = 0
-        ids_to_process = []
-
-        if st.session_state.last_max_id == 0:
-             # Initial Batch: Take top N newest
-             ids_to_process = all_ids[:limit]
-        else:
-             # Live Update: Take everything newer than last max
-             ids_to_process = [x for x in all_ids if x > st.session_state.last_max_id]
-
-        if not ids_to_process:
-             # Only idle if truly no new messages (and we aren't in first-run state)
-             if st.session_state.last_max_id > 0:
-                 st.session_state.scan_status = "Monitoring (Up to date)"
-                 mail.logout()
-                 return
-             else:
-                 st.session_state.scan_status = "No Unread Emails"
-                 mail.logout()
-                 return
-
-        st.session_state.scan_status = f"Scanning {len(ids_to_process)} emails..."
-        
-        new_rows = []
-        
-        for e_id_int in ids_to_process:
-            # Update high water mark safely
-            if e_id_int > st.session_state.last_max_id:
-                st.session_state.last_max_id = e_id_int
-                
-            try:
-                _, msg_data = mail.fetch(str(e_id_int), "(RFC822)")
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        row = process_single_email(msg, model, e_id_int)
-                        
-                        if row == "DUPLICATE":
-                             continue
-                        
-                        if row:
-                            # Mark as READ (Seen)
-                            mail.store(str(e_id_int), '+FLAGS', '\\Seen')
-                            
-                            new_rows.append(row)
-                            processed_count += 1
-                            
-                            # Immediate Session Update
-                            temp_df = pd.DataFrame([row])
-                            # Use concat to append, ensuring we keep old rows
-                            st.session_state.data = pd.concat([temp_df, st.session_state.data], ignore_index=True)
-                            
-                            # Sort
-                            sort_map = {"High": 0, "Medium": 1, "Low": 2, "Unknown": 3}
-                            st.session_state.data['SortKey'] = st.session_state.data['Priority'].map(sort_map).fillna(3)
-                            st.session_state.data = st.session_state.data.sort_values(by=['SortKey', 'Time'], ascending=[True, False]).drop('SortKey', axis=1)
-                            
-                            save_history(user)
-                            
-                            # Update UI
-                            with placeholder_metrics.container():
-                                render_metrics()
-                            with placeholder_table.container():
-                                render_table_with_selection()
-                                
-            except Exception as e:
-                print(f"Error processing email {e_id_int}: {e}")
-                continue
-
-        mail.logout()
-        st.session_state.last_scan_time = datetime.datetime.now()
-        
-        # Keep monitoring active for new emails
-        
-        if new_rows:
-             st.toast(f"Found {len(new_rows)} new emails!", icon="📩")
-        else:
-             # Just update status if nothing valid added
-             pass
-        
-    except Exception as e:
-        st.error(f"Connection Error: {e}")
-        st.session_state.monitoring = False
+def _row_key(row):
+    return (row.get("ID"), row.get("Sender"), row.get("Subject"))
+
+def load_inbox_from_history(history_store):
+    """Replace the session inbox with the persisted history."""
+    st.session_state.inbox = inbox_utils.InboxModel.from_frame(history_store.load_frame())
+    st.session_state.history_keys = {_row_key(row) for row in st.session_state.inbox.rows()}
+
+def apply_scan_events(scanner):
+    """Move everything the scanner published for this session since the last rerun into it."""
+    cycles = 0
+    for event in scanner.drain(st.session_state.scan_subscriber):
+        if event.kind == "resync":
+            # Not subscribed while rows were published: the history has all of them
+            load_inbox_from_history(scanner.history_store)
+            st.session_state.last_scan_time = scanner.last_scan_time
+            cycles += 1
+        elif event.kind == "rows":
+            rows = [row for row in event.payload if _row_key(row) not in st.session_state.history_keys]
+            # Sorted insert, counts updated in place (the worker already persisted them)
+            st.session_state.inbox.extend(rows)
+            st.session_state.new_email_count += len(rows)
+        elif event.kind == "status":
+            st.session_state.scan_status = event.payload
+        elif event.kind == "cycle":
+            st.session_state.last_scan_time = event.payload
+            cycles += 1
+        elif event.kind == "error":
+            st.session_state.scan_error = event.payload
+    return cycles
 
 # --- 6. UI COMPONENTS ---
-def render_metrics():
-    df = st.session_state.data
-    if df.empty:
-        h, m, l = 0, 0, 0
+def rerun_page():
+    """Full rerun requested by the scanner UI (counted in the diagnostics)."""
+    metrics_utils.inc("ui_reruns_total", help="Full page reruns triggered by scan progress.")
+    st.rerun()
+
+@st.fragment(run_every=SCANNER_UI_POLL_SECONDS)
+def watch_scanner(scanner):
+    """Polls the background scanner without rerunning the whole page on every tick."""
+    cycles = apply_scan_events(scanner)
+    if st.session_state.scan_error or not scanner.is_alive():
+        rerun_page()
+    st.caption(f"Status: {st.session_state.scan_status}")
+    # Full rerun at most every RENDER_INTERVAL_SECONDS / RENDER_MIN_ROWS rows, and
+    # always once a cycle completed
+    if cycles:
+        st.session_state.render_scheduler.flush()
     else:
-        h = len(df[df['Priority'] == "High"])
-        m = len(df[df['Priority'] == "Medium"])
-        l = len(df[df['Priority'] == "Low"])
+        st.session_state.render_scheduler.notify()
+
+def render_metrics():
+    counts = st.session_state.inbox.counts
+    h, m, l = counts["High"], counts["Medium"], counts["Low"]
     
     c1, c2, c3 = st.columns(3)
     with c1:
@@ -492,13 +288,13 @@ def render_metrics():
         st.markdown(f"""<div class="metric-card"><div class="metric-value" style="color:#3b82f6">{l}</div><div class="metric-label">Low Priority</div></div>""", unsafe_allow_html=True)
 
 def render_table_with_selection():
-    df = st.session_state.data
-    if df.empty:
+    inbox = st.session_state.inbox
+    if inbox.empty:
         st.info("No emails scanned yet.")
         return None
 
-    # Hide bulky columns
-    table_df = df.drop(columns=['ContentFull', 'ContentHtml', 'Content', 'ID'], errors='ignore')
+    # Hide bulky columns (the frame is only rebuilt when the inbox changed)
+    table_df = inbox.to_frame(exclude=('ContentFull', 'ContentHtml', 'BodyRef', 'HtmlRef', 'Content', 'ID'))
     
     # Interactive Table
     selected_rows = st.dataframe(
@@ -530,11 +326,9 @@ def render_detail_panel(selected_idx):
 
     # Retrieve row
     try:
-        # iloc works on position, assuming index hasn't been messed with or we use reset_index
-        # st.dataframe selection returns row index relative to displayed dataframe.
-        # We displayed st.session_state.data directly (just dropped cols).
-        # So the index should match.
-        row = st.session_state.data.iloc[selected_idx]
+        # st.dataframe selection returns the row position in the displayed frame,
+        # which is the inbox's display order.
+        row = st.session_state.inbox.row_at(selected_idx)
     except:
         st.warning("Selection out of sync. Please re-select.")
         return
@@ -552,14 +346,15 @@ def render_detail_panel(selected_idx):
 
     st.divider()
 
-    # Body Content
+    # Body Content (loaded from the blob store on demand)
     # Prefer HTML if available, else Plain Text
-    html_content = row.get("ContentHtml")
-    plain_content = row.get("ContentFull")
+    blobs = get_user_blob_store(st.session_state.current_user)
+    html_content = blobs.get_text(row.get("HtmlRef")) if row.get("HtmlRef") else row.get("ContentHtml")
+    plain_content = blobs.get_text(row.get("BodyRef")) if row.get("BodyRef") else row.get("ContentFull")
     
     # If NaN/None, treat as empty string
-    if pd.isna(html_content): html_content = ""
-    if pd.isna(plain_content): plain_content = ""
+    if not isinstance(html_content, str): html_content = ""
+    if not isinstance(plain_content, str): plain_content = ""
 
     if html_content:
         # Render HTML in a secure iframe
@@ -597,37 +392,86 @@ def render_login_screen():
 
 # --- MODEL LOADER ---
 def load_model_once():
-    """Load model into session_state if not already loaded.
-    Priority: HF directory (MODEL_DIR), then local email_model.pkl for backward compat."""
-    if st.session_state.model_obj is not None:
-        return
+    """
+    Start (or look up) the process-wide model warm-up; never blocks the page.
+    Returns the ModelWarmup, whose `handle` is None until the model is ready.
+    """
+    return model_utils.start_model_warmup()
+
+@st.fragment(run_every=SCANNER_UI_POLL_SECONDS)
+def watch_model_warmup(warmup):
+    """Status indicator while the model loads; reruns the page once it is ready."""
+    if warmup.done:
+        st.rerun()
+    download = model_utils.model_download_progress()
+    if download["state"] in ("downloading", "verifying", "extracting"):
+        label = f"Downloading model ({download['state']}) · {model_utils.format_bytes(download['downloaded'])}"
+        if download["total"]:
+            label += f" of {model_utils.format_bytes(download['total'])}"
+        st.progress(download["fraction"] or 0.0, text=label)
+    else:
+        st.info(f"Loading model in the background... {time.monotonic() - warmup.started_at:.0f}s", icon="⏳")
 
-    # Ensure model artifacts are present (fetch + unzip if missing)
-    ensure_model_present()
-
-    # 1) Try Hugging Face directory
-    if os.path.isdir(MODEL_DIR) and os.path.exists(os.path.join(MODEL_DIR, "config.json")):
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_DIR)
-        hf_model = AutoModelForSequenceClassification.from_pretrained(MODEL_DIR)
-        # Ensure input fits the model by truncating; max_length=512 is standard for DistilBERT
-        clf = pipeline("text-classification", model=hf_model, tokenizer=tokenizer, top_k=None, truncation=True, max_length=512)
-        st.session_state.model_obj = clf
-        st.session_state.model_kind = "hf_pipeline"
+def render_model_status(warmup):
+    if not warmup.done:
+        watch_model_warmup(warmup)
         return
-
-    # 2) Fallback: legacy sklearn pickle
-    legacy_path = "email_model.pkl"
-    if os.path.exists(legacy_path):
-        st.session_state.model_obj = joblib.load(legacy_path)
-        st.session_state.model_kind = "pkl"
+    model = warmup.handle
+    if warmup.state == "failed":
+        st.error(f"Model failed to load: {warmup.error}")
         return
-
-    st.session_state.model_obj = None
-    st.session_state.model_kind = None
+    if model is None:
+        st.error("No model found. Ensure MODEL_DIR is set or email_model.pkl is present.")
+        download = model_utils.model_download_progress()
+        if download["state"] == "failed":
+            st.caption(
+                f"Model download failed after {model_utils.format_bytes(download['downloaded'])}: "
+                f"{download['error']} (retried and resumed automatically)"
+            )
+        return
+    if model.kind == "hf_pipeline":
+        st.success(f"Model Loaded (HF @ {model.source}, {model.backend})", icon="✅")
+    else:
+        st.success("Model Loaded (legacy .pkl)", icon="✅")
+    st.caption(
+        f"Shared across sessions · loaded in {model.load_seconds:.1f}s · "
+        f"weights {model_utils.format_bytes(model.parameter_bytes())} · "
+        f"process RSS {model_utils.format_bytes(model_utils.process_rss_bytes())}"
+    )
+    cache = cache_utils.get_classification_cache()
+    if cache.enabled:
+        stats = cache.stats()
+        st.caption(
+            f"Classification cache: {stats['hits']} hits ({stats['disk_hits']} from disk) · "
+            f"{stats['misses']} misses · {stats['hit_rate']:.0%} hit rate · {stats['entries']} entries"
+        )
+
+def render_diagnostics():
+    """Per-stage timings and counters of this process (the same data /metrics exports)."""
+    with st.expander("🩺 Diagnostics"):
+        snap = metrics_utils.snapshot()
+        if snap["stages"]:
+            st.dataframe(snap["stages"], hide_index=True, use_container_width=True)
+        else:
+            st.caption("No stage timings recorded yet.")
+        for name, value in snap["counters"].items():
+            st.caption(f"{name}: {value:,}")
+        targets = []
+        if metrics_utils.METRICS_PORT:
+            targets.append(f"http://{metrics_utils.METRICS_HOST}:{metrics_utils.METRICS_PORT}/metrics")
+        if metrics_utils.METRICS_FILE:
+            targets.append(metrics_utils.METRICS_FILE)
+        st.caption("Prometheus: " + (", ".join(targets) if targets else "set METRICS_PORT or METRICS_FILE to export"))
+        st.download_button(
+            "Download metrics", metrics_utils.render_prometheus(), "neuromail_metrics.prom", "text/plain",
+            use_container_width=True,
+        )
 
 # --- 7. MAIN LAYOUT ---
 def main():
-    load_model_once()
+    # Loads in the background: the OAuth callback and login screen render right away
+    warmup = load_model_once()
+    model = warmup.handle
 
     # --- OAUTH CALLBACK HANDLER ---
     if 'code' in st.query_params:
@@ -658,36 +502,43 @@ def main():
         return
 
     # --- DASHBOARD (ONLY SHOWN IF LOGGED IN) ---
+    user = st.session_state.current_user
+    server = get_imap_server(st.session_state.oauth_token['provider'])
+    scanner = scanner_utils.get_scanner(server, user)
+
     with st.sidebar:
         st.title("🧠 NeuroMail")
         st.caption("AI-Powered Email Intelligence")
         
         st.markdown("### ⚙️ Configuration")
         
-        if st.session_state.model_kind == "hf_pipeline":
-            st.success(f"Model Loaded (HF @ {MODEL_DIR})", icon="✅")
-        elif st.session_state.model_kind == "pkl":
-            st.success("Model Loaded (legacy .pkl)", icon="✅")
-        else:
-            st.error("No model found. Ensure MODEL_DIR is set or email_model.pkl is present.")
+        render_model_status(warmup)
 
-        st.success(f"Logged in as: {st.session_state.current_user}")
+        st.success(f"Logged in as: {user}")
         if st.button("Logout", use_container_width=True):
+            scanner_utils.stop_scanner(server, user)
+            if scanner is not None:
+                scanner.unsubscribe(st.session_state.scan_subscriber)
+            # A cycle still holding the connection closes it when it finishes
+            imap_utils.close_pooled_connection(server, user, wait=False)
             st.session_state.oauth_token = None
             st.session_state.current_user = None
-            st.session_state.data = pd.DataFrame()
-            st.session_state.monitoring = False
+            st.session_state.inbox = inbox_utils.InboxModel()
+            st.session_state.history_keys = set()
             st.rerun()
 
         # --- USER SESSION LOGIC ---
-        if st.session_state.current_user:
-             # Load User Specific File
-             user_file = get_user_history_file(st.session_state.current_user)
-             if user_file and os.path.exists(user_file) and st.session_state.data.empty:
+        if user:
+             # Load User Specific History
+             if st.session_state.inbox.empty:
                  try:
-                     st.session_state.data = pd.read_csv(user_file)
+                     # Subscribe before loading so no row falls between the two; rows
+                     # that end up in both are skipped via history_keys
+                     if scanner is not None:
+                         scanner.subscribe(st.session_state.scan_subscriber)
+                     load_inbox_from_history(get_user_history_store(user))
                      # Re-populate seen cache
-                     for _, row in st.session_state.data.iterrows():
+                     for row in st.session_state.inbox.rows():
                          sig = f"{row.get('Sender')}_{row.get('Subject')}_{str(row.get('Content'))[:20]}"
                          st.session_state.seen_emails.add(sig)
                  except:
@@ -695,45 +546,85 @@ def main():
 
         st.markdown("---")
         scan_limit = st.slider("Batch Scan Size (Newest)", 10, 1000, 50)
+        monitor_mode = st.radio(
+            "Monitoring Mode", MONITOR_MODES,
+            index=0 if MONITOR_MODE == "push" else 1,
+            help="Push waits for the server to announce new mail (IMAP IDLE); Poll re-scans on a timer."
+        )
         
         col1, col2 = st.columns(2)
         with col1:
             if st.button("🔴 Stop", use_container_width=True):
-                st.session_state.monitoring = False
+                scanner_utils.stop_scanner(server, user)
+                st.session_state.scan_status = "Idle"
                 st.rerun()
         with col2:
             start_btn = st.button("🟢 Start", use_container_width=True)
             if start_btn:
-                if st.session_state.model_obj is None:
+                if model is None and not warmup.done:
+                    st.warning("The model is still loading; press Start again in a moment.")
+                elif model is None:
                     st.error("Model required! Ensure MODEL_DIR exists or email_model.pkl is present.")
                 else:
-                    # Reset high-water mark so we always fetch newest batch
-                    st.session_state.last_max_id = 0
-                    st.session_state.monitoring = True
+                    # Keep the persisted UID high-water mark: a restart only picks up new mail
+                    st.session_state.scan_error = None
+                    if scanner is not None:
+                        apply_scan_events(scanner)
+                    start_scanner(model, server, user, scan_limit, push=(monitor_mode == MONITOR_MODES[0]))
                     st.rerun()
+        if scanner_utils.SCANNER_BACKEND == "asyncio":
+            # Every logged-in account that pressed Start shares one event loop and classifier
+            st.caption(f"Multi-account mode: {scanner_utils.active_scanners()} account(s) scanning")
 
         st.markdown("---")
         
         # Clear History (User Scoped)
         if st.button("🗑️ Clear History", use_container_width=True):
-            st.session_state.data = pd.DataFrame()
+            # The scanner writes history and sync state; let it finish before wiping them
+            # and resume monitoring afterwards with the same settings
+            was_monitoring = scanner is not None and scanner.is_alive()
+            with st.spinner("Waiting for the current scan to finish..."):
+                if scanner_utils.stop_scanner(server, user, wait=True) is not None:
+                    scanner.drain(st.session_state.scan_subscriber)
+            st.session_state.inbox = inbox_utils.InboxModel()
+            st.session_state.history_keys = set()
             st.session_state.seen_emails = set()
-            st.session_state.last_max_id = 0
             
-            if st.session_state.current_user:
-                u_file = get_user_history_file(st.session_state.current_user)
+            if user:
+                get_user_history_store(user).clear()
+                get_user_blob_store(user).clear()
+                u_file = get_user_history_file(user)
                 if u_file and os.path.exists(u_file):
                     os.remove(u_file)
+                s_file = get_user_sync_file(user)
+                if s_file and os.path.exists(s_file):
+                    os.remove(s_file)
+                if was_monitoring:
+                    start_scanner(scanner.model, server, user, scanner.limit, scanner.push)
             st.rerun()
             
-        if not st.session_state.data.empty:
+        if not st.session_state.inbox.empty:
             # Do not include raw HTML in export unless requested, keep it light
-            export_df = st.session_state.data.drop(columns=['ContentHtml', 'ContentFull'], errors='ignore')
+            export_df = st.session_state.inbox.to_frame(exclude=('ContentHtml', 'ContentFull', 'BodyRef', 'HtmlRef'))
             csv = export_df.to_csv(index=False).encode('utf-8')
             st.download_button("💾 Download CSV", csv, "email_report.csv", "text/csv", use_container_width=True)
 
+        render_diagnostics()
+
+    # Pick up whatever the background scanner produced since the last run
+    if scanner is not None:
+        apply_scan_events(scanner)
+    monitoring = scanner is not None and scanner.is_alive()
+
+    if st.session_state.scan_error:
+        st.error(st.session_state.scan_error)
+        st.session_state.scan_error = None
+    if st.session_state.new_email_count:
+        st.toast(f"Found {st.session_state.new_email_count} new emails!", icon="📩")
+        st.session_state.new_email_count = 0
+
     st.title("Live Inbox Monitor")
-    st.caption(f"Logged in as: {st.session_state.current_user}")
+    st.caption(f"Logged in as: {user}")
 
     metrics_placeholder = st.empty()
     with metrics_placeholder.container():
@@ -744,7 +635,7 @@ def main():
     status_col, _ = st.columns([1, 3])
     status_placeholder = status_col.empty()
     
-    if st.session_state.monitoring:
+    if monitoring:
         status_placeholder.markdown(f'<div class="live-badge"><div class="dot"></div>LIVE: Active</div>', unsafe_allow_html=True)
     else:
         status_placeholder.markdown(f'<div style="color: #64748b; font-weight:600">● Inactive</div>', unsafe_allow_html=True)
@@ -763,26 +654,18 @@ def main():
         render_detail_panel(selected_row_idx)
 
     # --- BACKGROUND WORKER ---
-    if st.session_state.monitoring and st.session_state.model_obj:
-        try:
-            model = st.session_state.model_obj
-            
-            # Determine server based on provider
-            provider = st.session_state.oauth_token['provider']
-            server = "imap.gmail.com" if provider == 'google' else "outlook.office365.com"
-            
-            run_scan_cycle(
-                model, server, st.session_state.current_user, 
-                scan_limit, metrics_placeholder, table_placeholder, status_placeholder, detail_placeholder
-            )
-            
-            time.sleep(5)
-            st.rerun()
-            
-        except Exception as e:
-            st.error(f"Runtime Error: {e}")
-            st.session_state.monitoring = False
+    # The scan itself runs in the scanner thread; this page only polls its queue and
+    # reruns (throttled by the render scheduler) when there is something new to show
+    if monitoring:
+        # Reads the session inbox on every check: a resync in the fragment replaces it
+        st.session_state.render_scheduler = inbox_utils.RenderScheduler(lambda: st.session_state.inbox, rerun_page)
+        with status_col:
+            watch_scanner(scanner)
 
 if __name__ == "__main__":
-    main()
+    metrics_utils.start_metrics_server()
+    metrics_utils.inc("ui_runs_total", help="Streamlit script runs (page loads and reruns).")
+    # Includes the run cut short by st.rerun()/st.stop() (they raise)
+    with metrics_utils.timed("ui_render"):
+        main()
 
@@ -0,0 +1,404 @@
+import os
+import re
+import ssl
+import time
+import asyncio
+import imaplib
+import itertools
+import auth_utils
+import imap_utils
+import metrics_utils
+
+# --- CONFIG ---
+# Per provider (IMAP host): scan cycles running at once, and IMAP commands per second
+# across all of its accounts. 0 disables the command rate limit.
+IMAP_PROVIDER_MAX_SESSIONS = int(os.getenv("IMAP_PROVIDER_MAX_SESSIONS", "8"))
+IMAP_PROVIDER_COMMANDS_PER_SECOND = float(os.getenv("IMAP_PROVIDER_COMMANDS_PER_SECOND", "20"))
+# Longest response line read (UID SEARCH puts every match on one line); asyncio's
+# default is 64 KiB, imaplib allows 1,000,000 bytes
+IMAP_MAX_LINE_BYTES = int(os.getenv("IMAP_MAX_LINE_BYTES", str(8 * 1024 * 1024)))
+
+_LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+_UNTAGGED_STATUS_RE = re.compile(rb'\* (\d+) ([A-Za-z-]+)(?: (.*))?$', re.DOTALL)
+_UNTAGGED_RE = re.compile(rb'\* ([A-Za-z-]+)(?: (.*))?$', re.DOTALL)
+_RESPONSE_CODE_RE = re.compile(rb'\[([A-Za-z-]+)(?: ([^\]]*))?\]')
+_TAG_PREFIXES = itertools.count(1)
+
+class ProviderLimiter:
+    """Caps concurrent scan cycles and the IMAP command rate for one provider."""
+    def __init__(self, max_sessions=IMAP_PROVIDER_MAX_SESSIONS, commands_per_second=IMAP_PROVIDER_COMMANDS_PER_SECOND):
+        self.sessions = asyncio.Semaphore(max(1, max_sessions))
+        self.rate = commands_per_second
+        self._tokens = float(commands_per_second)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait for one command slot (token bucket, burst of one second's worth)."""
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class AsyncIMAPClient:
+    """
+    Minimal asyncio IMAP4rev1 client: just what the scanner needs (XOAUTH2, SELECT,
+    ENABLE, UID SEARCH/FETCH/STORE, IDLE). Responses are returned in imaplib's shape
+    ((typ, data), literals as (prefix, bytes) tuples) so imap_utils' parsers apply,
+    and errors use imaplib's exception classes.
+    """
+    def __init__(self, host, port=None, timeout=imap_utils.IMAP_TIMEOUT_SECONDS, limiter=None, ssl_context=None):
+        self.host = host
+        self.port = port or imap_utils.IMAP_PORT
+        self.timeout = timeout
+        self.limiter = limiter
+        if ssl_context is None and imap_utils.IMAP_SSL:
+            ssl_context = ssl.create_default_context()
+        self.ssl_context = ssl_context
+        self.reader = None
+        self.writer = None
+        self.state = "LOGOUT"
+        self.capabilities = ()
+        self.untagged_responses = {}
+        self.access_token = None
+        self._tag_prefix = f"N{next(_TAG_PREFIXES)}"
+        self._tags = itertools.count(1)
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_open(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl_context, limit=IMAP_MAX_LINE_BYTES),
+            self.timeout
+        )
+        greeting = await self._readline()
+        if not greeting.startswith(b"* OK") and not greeting.startswith(b"* PREAUTH"):
+            raise imaplib.IMAP4.abort(f"unexpected greeting: {greeting!r}")
+        self.state = "NONAUTH"
+        await self.capability()
+        return self
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+        self.writer = self.reader = None
+        self.state = "LOGOUT"
+
+    # --- wire ---
+    async def _readline(self, timeout=None):
+        try:
+            line = await asyncio.wait_for(self.reader.readuntil(b"\r\n"), timeout or self.timeout)
+        except asyncio.IncompleteReadError:
+            raise imaplib.IMAP4.abort("connection closed by server")
+        except asyncio.LimitOverrunError:
+            # Not transient: the same response would overrun again on every retry
+            raise imaplib.IMAP4.error(f"response line longer than IMAP_MAX_LINE_BYTES ({IMAP_MAX_LINE_BYTES})")
+        except asyncio.TimeoutError:
+            raise imaplib.IMAP4.abort("timed out waiting for the server")
+        return line[:-2]
+
+    async def _read_response(self, first=None):
+        """One response as (literal items, last line), literals read in full."""
+        line = first if first is not None else await self._readline()
+        items = []
+        while True:
+            m = _LITERAL_RE.search(line)
+            if not m:
+                return items, line
+            try:
+                literal = await asyncio.wait_for(self.reader.readexactly(int(m.group(1))), self.timeout)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                raise imaplib.IMAP4.abort("connection lost while reading a literal")
+            items.append((line, literal))
+            line = await self._readline()
+
+    def _store_untagged(self, items, tail, untagged):
+        """File an untagged response the way imaplib does ('* 3 FETCH (...)' -> FETCH: b'3 (...)')."""
+        first = items[0][0] if items else tail
+        m = _UNTAGGED_STATUS_RE.match(first)
+        if m:
+            typ = m.group(2).upper().decode()
+            head = m.group(1) + (b" " + m.group(3) if m.group(3) is not None else b"")
+        else:
+            m = _UNTAGGED_RE.match(first)
+            if not m:
+                return None
+            typ = m.group(1).upper().decode()
+            head = m.group(2) or b""
+        if typ in ("OK", "NO", "BAD", "BYE", "PREAUTH"):
+            code = _RESPONSE_CODE_RE.search(head)
+            if code:
+                self.untagged_responses.setdefault(code.group(1).upper().decode(), []).append(code.group(2))
+        if items:
+            data = [(head, items[0][1])] + items[1:] + [tail]
+        else:
+            data = [head]
+        untagged.setdefault(typ, []).extend(data)
+        self.untagged_responses.setdefault(typ, []).extend(data)
+        return typ
+
+    async def _send(self, line):
+        self.writer.write(line.encode() if isinstance(line, str) else line)
+        await self.writer.drain()
+
+    async def _command(self, name, *args, continuation=None):
+        """Run one tagged command; returns (status, {type: data}, tagged text)."""
+        if not self.is_open:
+            raise imaplib.IMAP4.abort("not connected")
+        async with self._lock:
+            if self.limiter is not None:
+                await self.limiter.acquire()
+            tag = f"{self._tag_prefix}{next(self._tags)}".encode()
+            parts = [tag.decode(), name] + [str(a) for a in args if a is not None]
+            await self._send(" ".join(parts) + "\r\n")
+            untagged = {}
+            while True:
+                items, tail = await self._read_response()
+                first = items[0][0] if items else tail
+                if first.startswith(tag + b" "):
+                    status, _, text = first[len(tag) + 1:].partition(b" ")
+                    status = status.decode().upper()
+                    if status == "BAD":
+                        raise imaplib.IMAP4.error(f"{name} command error: {text!r}")
+                    return status, untagged, text
+                if first.startswith(b"+"):
+                    if continuation is None:
+                        raise imaplib.IMAP4.abort(f"unexpected continuation for {name}")
+                    await self._send(continuation() + "\r\n")
+                    continue
+                typ = self._store_untagged(items, tail, untagged)
+                if typ == "BYE" and name != "LOGOUT":
+                    raise imaplib.IMAP4.abort(first.decode(errors='ignore'))
+
+    # --- commands ---
+    async def capability(self):
+        status, untagged, _ = await self._command("CAPABILITY")
+        caps = untagged.get("CAPABILITY")
+        if status == "OK" and caps and caps[-1]:
+            self.capabilities = tuple(caps[-1].decode().upper().split())
+        return self.capabilities
+
+    async def authenticate_xoauth2(self, user, access_token):
+        auth_str = auth_utils.generate_oauth2_string(user, access_token, base64_encode=True)
+        # On failure the server sends a JSON error as a continuation; answer it with an empty line
+        replies = [auth_str]
+        status, _, text = await self._command(
+            "AUTHENTICATE", "XOAUTH2", continuation=lambda: replies.pop(0) if replies else ""
+        )
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"AUTHENTICATE failed: {text!r}")
+        self.state = "AUTH"
+        self.access_token = access_token
+        # Pre-auth capabilities may omit extensions (IDLE, CONDSTORE); ask again
+        await self.capability()
+
+    async def enable(self, capability):
+        status, _, text = await self._command("ENABLE", capability)
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"ENABLE {capability} failed: {text!r}")
+
+    async def select(self, mailbox="inbox"):
+        self.untagged_responses = {}
+        name = f'"{mailbox}"' if " " in mailbox else mailbox
+        status, untagged, text = await self._command("SELECT", name)
+        if status != "OK":
+            return status, [text]
+        self.state = "SELECTED"
+        return status, untagged.get("EXISTS", [None])
+
+    def response(self, code):
+        """Same as imaplib: pop the data of a response code (e.g. UIDVALIDITY)."""
+        code = code.upper()
+        return code, self.untagged_responses.pop(code, [None])
+
+    async def uid(self, command, *args):
+        command = command.upper()
+        status, untagged, text = await self._command("UID", command, *args)
+        if status != "OK":
+            return status, [text]
+        name = command if command in ("SEARCH", "SORT", "THREAD") else "FETCH"
+        return status, untagged.get(name, [None])
+
+    async def noop(self):
+        status, _, _ = await self._command("NOOP")
+        return status
+
+    async def logout(self):
+        try:
+            if self.is_open:
+                await self._command("LOGOUT")
+        except Exception:
+            pass
+        finally:
+            await self.close()
+
+    async def idle(self, timeout, stop_event=None, poll_interval=1.0):
+        """
+        One IDLE (RFC 2177) for at most `timeout` seconds. True as soon as the server
+        reports EXISTS; False on timeout or when `stop_event` (threading.Event) is set.
+        """
+        async with self._lock:
+            tag = f"{self._tag_prefix}{next(self._tags)}".encode()
+            await self._send(tag + b" IDLE\r\n")
+            while True:
+                line = await self._readline(30)
+                if line.startswith(b"+"):
+                    break
+                if line.startswith(tag):
+                    raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+            got_exists = False
+            deadline = time.monotonic() + timeout
+            while not got_exists and not (stop_event is not None and stop_event.is_set()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    line = await asyncio.wait_for(self.reader.readuntil(b"\r\n"), min(remaining, poll_interval))
+                except asyncio.TimeoutError:
+                    continue
+                except asyncio.IncompleteReadError:
+                    raise imaplib.IMAP4.abort("connection closed by server")
+                if line.upper().startswith(b"* BYE"):
+                    raise imaplib.IMAP4.abort(line.decode(errors='ignore'))
+                if imap_utils._EXISTS_RE.match(line):
+                    got_exists = True
+
+            await self._send(b"DONE\r\n")
+            while True:
+                line = await self._readline(30)
+                if line.startswith(tag):
+                    if b" OK" not in line.upper():
+                        raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+                    return got_exists
+                if imap_utils._EXISTS_RE.match(line):
+                    got_exists = True
+
+# --- SCAN HELPERS (async twins of imap_utils) ---
+async def connect_xoauth2(server, user, access_token, limiter=None, port=None):
+    client = AsyncIMAPClient(server, port, limiter=limiter)
+    with metrics_utils.timed("imap_connect"):
+        await client.connect()
+        try:
+            await client.authenticate_xoauth2(user, access_token)
+        except Exception:
+            await client.close()
+            raise
+    return client
+
+async def select_mailbox(client, mailbox="inbox", condstore=False):
+    """SELECT and return (uidvalidity, highestmodseq); see imap_utils.select_mailbox."""
+    if condstore and "CONDSTORE" in client.capabilities and "ENABLE" in client.capabilities:
+        try:
+            if client.state == "AUTH":
+                await client.enable("CONDSTORE")
+        except Exception as e:
+            print(f"CONDSTORE not enabled: {e}")
+            condstore = False
+    else:
+        condstore = False
+
+    typ, data = await client.select(mailbox)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"SELECT {mailbox} failed: {data}")
+    uidvalidity = imap_utils._response_int(client, "UIDVALIDITY")
+    highestmodseq = imap_utils._response_int(client, "HIGHESTMODSEQ") if condstore else None
+    return uidvalidity, highestmodseq
+
+async def search_unseen_uids(client, last_uid=0, since_modseq=None):
+    with metrics_utils.timed("imap_search"):
+        typ, data = await client.uid('SEARCH', None, *imap_utils.search_criteria(last_uid, since_modseq))
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"UID SEARCH failed: {data}")
+    return imap_utils.search_result(data, last_uid)
+
+async def fetch_uid_chunk(client, uids, query):
+    with metrics_utils.timed("imap_fetch"):
+        typ, data = await client.uid('FETCH', imap_utils.format_uid_set(uids), query)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"UID FETCH failed: {data}")
+    imap_utils.record_fetched_bytes(data)
+    return imap_utils.collect_fetched(data, uids)
+
+async def fetch_uid_attributes(client, uids, query, chunk_size=None):
+    """List of (uid, attribute dict); same chunking and per-UID fallback as imap_utils."""
+    results = []
+    for chunk in imap_utils.uid_chunks(uids, chunk_size):
+        try:
+            fetched = await fetch_uid_chunk(client, chunk, query)
+        except imaplib.IMAP4.abort:
+            raise
+        except Exception as e:
+            print(f"Chunk fetch failed ({e}), retrying {len(chunk)} emails one by one")
+            fetched = {}
+            for uid in chunk:
+                try:
+                    fetched.update(await fetch_uid_chunk(client, [uid], query))
+                except imaplib.IMAP4.abort:
+                    raise
+                except Exception as e_one:
+                    print(f"Error fetching email {uid}: {e_one}")
+        results.extend((int(uid), fetched[int(uid)]) for uid in chunk if int(uid) in fetched)
+    return results
+
+async def fetch_messages(client, uids, chunk_size=None):
+    """List of (uid, raw RFC822 bytes), fetched with BODY.PEEK."""
+    return [
+        (uid, attrs["BODY[]"])
+        for uid, attrs in await fetch_uid_attributes(client, uids, "(UID BODY.PEEK[])", chunk_size)
+        if isinstance(attrs.get("BODY[]"), bytes)
+    ]
+
+async def fetch_messages_partial(client, uids, chunk_size=None, max_bytes=None):
+    """List of (uid, header, body_text, body_html, tokens); see imap_utils.fetch_messages_partial."""
+    max_bytes = imap_utils.IMAP_PARTIAL_BYTES if max_bytes is None else max_bytes
+    results = []
+    for chunk in imap_utils.uid_chunks(uids, chunk_size):
+        plans = imap_utils.partial_plans(
+            await fetch_uid_attributes(client, chunk, imap_utils.PARTIAL_STRUCTURE_QUERY, chunk_size)
+        )
+        bodies = {}
+        for query, group_uids in imap_utils.partial_body_queries(plans, max_bytes):
+            for uid, attrs in await fetch_uid_attributes(client, group_uids, query, chunk_size):
+                bodies[uid] = attrs
+        results.extend(imap_utils.partial_results(chunk, plans, bodies))
+    return results
+
+async def mark_seen(client, uids, chunk_size=None):
+    """+FLAGS.SILENT (\\Seen) per chunk with per-UID fallback; returns the UIDs flagged."""
+    flagged = set()
+    for chunk in imap_utils.uid_chunks(uids, chunk_size):
+        try:
+            with metrics_utils.timed("imap_store"):
+                typ, data = await client.uid('STORE', imap_utils.format_uid_set(chunk), '+FLAGS.SILENT', '(\\Seen)')
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"UID STORE failed: {data}")
+            flagged.update(int(u) for u in chunk)
+        except imaplib.IMAP4.abort:
+            raise
+        except Exception as e:
+            print(f"Chunk store failed ({e}), retrying {len(chunk)} emails one by one")
+            for uid in chunk:
+                try:
+                    typ, data = await client.uid('STORE', str(uid), '+FLAGS.SILENT', '(\\Seen)')
+                    if typ == 'OK':
+                        flagged.add(int(uid))
+                except imaplib.IMAP4.abort:
+                    raise
+                except Exception as e_one:
+                    print(f"Error marking email {uid} as read: {e_one}")
+    return flagged
@@ -3,8 +3,12 @@ import msal
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
+from google.auth.exceptions import TransportError
 import base64
 import requests
+import threading
+import time
+import datetime
 
 # --- CONFIG ---
 # Ensure these are set in your environment variables (e.g. on Render)
@@ -25,6 +29,67 @@ GOOGLE_SCOPES = [
 ]
 MICROSOFT_SCOPES = ['https://outlook.office.com/IMAP.AccessAsUser.All', 'User.Read', 'email', 'offline_access']
 
+# Refresh access tokens this many seconds before they expire (instead of every scan)
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+
+# --- TOKEN CACHE ---
+# Process-wide, keyed by provider + account: every session (and the IDLE thread) of
+# one account shares the freshest access token, and refreshes are serialized so a
+# burst of expiring sessions only costs one identity-provider round trip.
+_TOKEN_CACHE = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
+_REFRESH_LOCKS = {}
+
+def _account_key(token_info):
+    return (token_info.get('provider'), (token_info.get('email') or "").strip().lower())
+
+def _access_token_field(token_info):
+    return 'token' if token_info.get('provider') == 'google' else 'access_token'
+
+def _refresh_lock(key):
+    with _TOKEN_CACHE_LOCK:
+        return _REFRESH_LOCKS.setdefault(key, threading.Lock())
+
+def _expiry_timestamp(expiry):
+    # google-auth reports expiry as a naive UTC datetime
+    if expiry is None: return None
+    return expiry.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+def _is_fresh(expires_at):
+    return expires_at is not None and expires_at - TOKEN_REFRESH_MARGIN > time.time()
+
+def _remember_token(token_info):
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE[_account_key(token_info)] = {
+            "access_token": token_info.get(_access_token_field(token_info)),
+            "refresh_token": token_info.get('refresh_token'),
+            "expires_at": token_info.get('expires_at'),
+        }
+
+def _adopt_cached_token(token_info):
+    """Copy a fresher token another session already fetched; True if it is usable."""
+    with _TOKEN_CACHE_LOCK:
+        cached = _TOKEN_CACHE.get(_account_key(token_info))
+    if not cached or not _is_fresh(cached['expires_at']):
+        return False
+    token_info[_access_token_field(token_info)] = cached['access_token']
+    token_info['expires_at'] = cached['expires_at']
+    if cached.get('refresh_token'):
+        token_info['refresh_token'] = cached['refresh_token']
+    return True
+
+def _refresh_if_expiring(token_info, do_refresh):
+    if _is_fresh(token_info.get('expires_at')):
+        return token_info
+    with _refresh_lock(_account_key(token_info)):
+        # Another thread may have refreshed while we waited for the lock
+        if _adopt_cached_token(token_info):
+            return token_info
+        token_info = do_refresh(token_info)
+        if token_info:
+            _remember_token(token_info)
+        return token_info
+
 # --- GOOGLE AUTH ---
 def get_google_auth_url():
     if not GOOGLE_CLIENT_ID or not GOOGLE_CLIENT_SECRET:
@@ -73,11 +138,12 @@ def get_google_token_from_code(code):
         "client_id": creds.client_id,
         "client_secret": creds.client_secret,
         "scopes": creds.scopes,
+        "expires_at": _expiry_timestamp(creds.expiry),
         "email": email,
         "provider": "google"
     }
 
-def refresh_google_token(token_info):
+def _refresh_google_now(token_info):
     creds = Credentials(
         token_info['token'],
         refresh_token=token_info.get('refresh_token'),
@@ -86,24 +152,40 @@ def refresh_google_token(token_info):
         client_secret=token_info.get('client_secret'),
         scopes=token_info.get('scopes')
     )
-    if creds.expired and creds.refresh_token:
+    if creds.refresh_token:
         try:
             creds.refresh(Request())
             token_info['token'] = creds.token
+            token_info['expires_at'] = _expiry_timestamp(creds.expiry)
+        except (TransportError, requests.RequestException, OSError) as e:
+            # Network trouble, not a revoked grant: surface it as a retryable error
+            raise ConnectionError(f"Google token refresh failed: {e}") from e
         except Exception as e:
             print(f"Error refreshing Google token: {e}")
             return None
     return token_info
 
+def refresh_google_token(token_info):
+    """Return token_info with a valid access token, refreshing only close to expiry."""
+    return _refresh_if_expiring(token_info, _refresh_google_now)
+
 # --- MICROSOFT AUTH ---
+_MSAL_APP = None
+_MSAL_LOCK = threading.Lock()
+
 def _get_msal_app():
+    """One shared client: building it performs authority discovery over HTTPS."""
+    global _MSAL_APP
     if not MICROSOFT_CLIENT_ID or not MICROSOFT_CLIENT_SECRET:
         return None
-    return msal.ConfidentialClientApplication(
-        MICROSOFT_CLIENT_ID,
-        authority=f"https://login.microsoftonline.com/{MICROSOFT_TENANT_ID}",
-        client_credential=MICROSOFT_CLIENT_SECRET,
-    )
+    with _MSAL_LOCK:
+        if _MSAL_APP is None:
+            _MSAL_APP = msal.ConfidentialClientApplication(
+                MICROSOFT_CLIENT_ID,
+                authority=f"https://login.microsoftonline.com/{MICROSOFT_TENANT_ID}",
+                client_credential=MICROSOFT_CLIENT_SECRET,
+            )
+    return _MSAL_APP
 
 def get_microsoft_auth_url():
     app = _get_msal_app()
@@ -130,9 +212,11 @@ def get_microsoft_token_from_code(code):
     
     result['email'] = email
     result['provider'] = 'microsoft'
+    if 'expires_in' in result:
+        result['expires_at'] = time.time() + int(result['expires_in'])
     return result
 
-def refresh_microsoft_token(token_info):
+def _refresh_microsoft_now(token_info):
     app = _get_msal_app()
     if 'refresh_token' in token_info:
             result = app.acquire_token_by_refresh_token(
@@ -144,12 +228,27 @@ def refresh_microsoft_token(token_info):
                 return None
             # Update access token
             token_info['access_token'] = result['access_token']
+            token_info['expires_at'] = time.time() + int(result.get('expires_in', 0))
             # Update refresh token if a new one is returned
             if 'refresh_token' in result:
                 token_info['refresh_token'] = result['refresh_token']
             return token_info
     return None
 
+def refresh_microsoft_token(token_info):
+    """Return token_info with a valid access token, refreshing only close to expiry."""
+    return _refresh_if_expiring(token_info, _refresh_microsoft_now)
+
+def get_access_token(token_info):
+    """Provider-agnostic: (token_info, access_token), or (None, None) if refresh failed."""
+    if token_info.get('provider') == 'google':
+        token_info = refresh_google_token(token_info)
+    else:
+        token_info = refresh_microsoft_token(token_info)
+    if not token_info:
+        return None, None
+    return token_info, token_info.get(_access_token_field(token_info))
+
 # --- XOAUTH2 GENERATOR ---
 def generate_oauth2_string(user, token, base64_encode=True):
     auth_string = f"user={user}\x01auth=Bearer {token}\x01\x01"
@@ -0,0 +1,281 @@
+"""
+Headless backfill: classify a whole mail archive without the dashboard.
+
+Reads an mbox file, a Maildir or an IMAP folder, parses on the parse_utils
+process pool, classifies in batches with the shared model (and classification
+cache), and streams one row per email to CSV, Parquet or NDJSON:
+
+    python backfill.py mbox archive.mbox --output results.csv
+    python backfill.py maildir ~/Maildir/cur --output results.parquet
+    python backfill.py imap --server imap.gmail.com --user me@example.com \\
+        --token-file token.json --folder "[Gmail]/All Mail" --output results.ndjson
+
+IMAP folders are opened read-only and fetched with BODY.PEEK, so nothing is
+marked read. Uses no Streamlit; the row format is the dashboard's (build_row).
+"""
+import os
+import sys
+import csv
+import json
+import time
+import imaplib
+import mailbox
+import argparse
+import itertools
+import auth_utils
+import imap_utils
+import model_utils
+import parse_utils
+import scanner_utils
+
+# --- CONFIG ---
+# Raw messages read from the source per parse/classify round
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "1000"))
+# IMAP folders are searched this many UIDs at a time: one SEARCH over a whole
+# archive returns a single line longer than imaplib accepts (1,000,000 bytes)
+BACKFILL_UID_WINDOW = int(os.getenv("BACKFILL_UID_WINDOW", "50000"))
+FORMATS = ("csv", "parquet", "ndjson")
+COLUMNS = ["ID", "Key", "Priority", "Confidence", "Sender", "Subject", "Tokens", "Content"]
+BODY_COLUMNS = ["ContentFull", "ContentHtml"]
+
+# --- SOURCES ---
+# Each yields (sequence number, source key, raw RFC822 bytes)
+def iter_mbox(path):
+    box = mailbox.mbox(path, create=False)
+    try:
+        for seq, key in enumerate(box.iterkeys(), 1):
+            yield seq, str(key), box.get_bytes(key)
+    finally:
+        box.close()
+
+def iter_maildir(path):
+    box = mailbox.Maildir(path, factory=None, create=False)
+    # Maildir keys start with the delivery time, so sorting gives arrival order
+    for seq, key in enumerate(sorted(box.iterkeys()), 1):
+        yield seq, key, box.get_bytes(key)
+
+def iter_imap(server, user, access_token, folder="INBOX", unseen_only=False, window=BACKFILL_UID_WINDOW):
+    mail = imap_utils.connect_xoauth2(server, user, access_token)
+    try:
+        typ, data = mail.select(_quote_mailbox(folder), readonly=True)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"SELECT {folder} failed: {data}")
+        count = int(data[0]) if data and data[0] and data[0].isdigit() else None
+        top = _highest_uid(mail)
+        if count is not None:
+            print(f"{count} messages in {folder}", file=sys.stderr)
+        seq = 0
+        for lo in range(1, top + 1, max(1, window)):
+            hi = min(top, lo + window - 1)
+            criteria = ('UID', f'{lo}:{hi}') + (('UNSEEN',) if unseen_only else ())
+            typ, data = mail.uid('SEARCH', None, *criteria)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"UID SEARCH failed: {data}")
+            # "lo:hi" also matches the highest UID when nothing is in range; keep the window
+            uids = sorted(u for u in (int(x) for x in (data[0] or b"").split() if x.isdigit()) if lo <= u <= hi)
+            for uid, raw in imap_utils.fetch_messages(mail, uids):
+                seq += 1
+                yield seq, str(uid), raw
+    finally:
+        try: mail.logout()
+        except Exception: pass
+
+def _highest_uid(mail):
+    """UIDNEXT - 1 from the SELECT response, else the UID of the last message (0 if empty)."""
+    typ, data = mail.response('UIDNEXT')
+    if data and data[0] and data[0].isdigit():
+        return int(data[0]) - 1
+    typ, data = mail.uid('SEARCH', None, 'UID', '*')
+    uids = [int(x) for x in (data[0] or b"").split() if x.isdigit()] if typ == 'OK' and data else []
+    return max(uids, default=0)
+
+def _quote_mailbox(name):
+    # imaplib sends arguments verbatim; names like "[Gmail]/All Mail" need quoting
+    if name.startswith('"') or not any(c in name for c in ' ()[]{}%*"\\'):
+        return name
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def imap_access_token(args):
+    """An explicit --access-token, or the OAuth token JSON of --token-file (refreshed if it is expiring)."""
+    if args.access_token:
+        return args.access_token
+    if not args.token_file:
+        raise SystemExit("imap needs --access-token (or NEUROMAIL_ACCESS_TOKEN) or --token-file")
+    with open(args.token_file, "r", encoding="utf-8") as f:
+        token_data = json.load(f)
+    token_data, access_token = auth_utils.get_access_token(token_data)
+    if not token_data:
+        raise SystemExit("Token refresh failed")
+    return access_token
+
+# --- WRITERS ---
+class CsvWriter:
+    def __init__(self, stream, columns):
+        self.stream = stream
+        self.writer = csv.DictWriter(stream, fieldnames=columns, extrasaction="ignore")
+        self.writer.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            self.writer.writerow({**row, "Tokens": json.dumps(row.get("Tokens") or [])})
+        self.stream.flush()
+
+    def close(self):
+        _close_stream(self.stream)
+
+class NdjsonWriter:
+    def __init__(self, stream, columns):
+        self.stream = stream
+        self.columns = columns
+
+    def write(self, rows):
+        for row in rows:
+            self.stream.write(json.dumps({c: row.get(c) for c in self.columns}, ensure_ascii=False) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        _close_stream(self.stream)
+
+class ParquetWriter:
+    """One row group per batch; needs pyarrow (pip install pyarrow)."""
+    def __init__(self, path, columns):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow: pip install pyarrow")
+        types = {"ID": pa.int64(), "Confidence": pa.float64(), "Tokens": pa.list_(pa.string())}
+        self.pa = pa
+        self.columns = columns
+        self.schema = pa.schema([(c, types.get(c, pa.string())) for c in columns])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        if rows:
+            data = {c: [row.get(c) for row in rows] for c in self.columns}
+            self.writer.write_table(self.pa.Table.from_pydict(data, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+def _close_stream(stream):
+    if stream is sys.stdout:
+        stream.flush()
+    else:
+        stream.close()
+
+def open_writer(path, fmt, columns):
+    if fmt == "parquet":
+        if path == "-":
+            raise SystemExit("Parquet output needs a file path")
+        return ParquetWriter(path, columns)
+    stream = sys.stdout if path == "-" else open(path, "w", encoding="utf-8", newline="")
+    return CsvWriter(stream, columns) if fmt == "csv" else NdjsonWriter(stream, columns)
+
+def output_format(path, fmt=None):
+    if fmt:
+        return fmt
+    ext = os.path.splitext(path)[1].lower().lstrip(".")
+    if ext in ("jsonl", "ndjson", "json"):
+        return "ndjson"
+    if ext in ("parquet", "pq"):
+        return "parquet"
+    return "csv"
+
+# --- PIPELINE ---
+def _batches(messages, size):
+    batch = []
+    for item in messages:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def classify_stream(model, messages, writer, batch_size=BACKFILL_BATCH_SIZE, include_bodies=False, limit=None):
+    """
+    Parse, classify and write (seq, key, raw) messages batch by batch; only one
+    batch of raw messages is held in memory at a time. Returns counters.
+    """
+    stats = {"read": 0, "classified": 0, "skipped": 0}
+    started = time.perf_counter()
+    if limit is not None:
+        messages = itertools.islice(messages, limit)
+    for batch in _batches(messages, batch_size):
+        stats["read"] += len(batch)
+        keys = {seq: key for seq, key, _ in batch}
+        fetched = [(seq, raw, None) for seq, _, raw in batch]
+        del batch
+        for parsed_chunk, predictions in scanner_utils.iter_parse_and_classify(model, fetched):
+            rows = []
+            for parsed, prediction in zip(parsed_chunk, predictions):
+                if prediction is None:
+                    continue
+                row = scanner_utils.build_row(parsed, *prediction)
+                row["Key"] = keys[parsed["id"]]
+                row["Confidence"] = float(row["Confidence"])
+                if not include_bodies:
+                    row.pop("ContentFull", None)
+                    row.pop("ContentHtml", None)
+                rows.append(row)
+            writer.write(rows)
+            stats["classified"] += len(rows)
+        stats["skipped"] = stats["read"] - stats["classified"]
+        elapsed = time.perf_counter() - started
+        print(f"{stats['read']} read, {stats['classified']} classified, {stats['skipped']} skipped "
+              f"({stats['read'] / elapsed:.0f} msg/s)", file=sys.stderr)
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify an mbox, Maildir or IMAP folder without the dashboard.")
+    parser.add_argument("source", choices=("mbox", "maildir", "imap"))
+    parser.add_argument("path", nargs="?", help="mbox file or Maildir directory")
+    parser.add_argument("--output", "-o", default="-", help="output file ('-' = stdout for csv/ndjson)")
+    parser.add_argument("--format", choices=FORMATS, help="default: from the --output extension, else csv")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE, help="messages per parse/classify round")
+    parser.add_argument("--limit", type=int, help="stop after this many messages")
+    parser.add_argument("--include-bodies", action="store_true", help="also write the full plain-text and HTML bodies")
+    parser.add_argument("--backend", help="model backend override (torch, torch-int8, onnx)")
+    imap = parser.add_argument_group("imap")
+    imap.add_argument("--server", help="e.g. imap.gmail.com or outlook.office365.com")
+    imap.add_argument("--user")
+    imap.add_argument("--folder", default="INBOX")
+    imap.add_argument("--unseen-only", action="store_true")
+    imap.add_argument("--access-token", default=os.getenv("NEUROMAIL_ACCESS_TOKEN"))
+    imap.add_argument("--token-file", help=(
+        "JSON file holding an OAuth token dict in auth_utils' format: provider (google/microsoft), "
+        "email, refresh_token, expires_at (unix time) and the access token as \"token\" (Google, plus "
+        "token_uri, client_id, client_secret, scopes) or \"access_token\" (Microsoft, client from "
+        "MICROSOFT_CLIENT_ID/SECRET); refreshed when expiring"
+    ))
+    args = parser.parse_args(argv)
+
+    if args.source == "imap":
+        if not args.server or not args.user:
+            parser.error("imap needs --server and --user")
+        messages = iter_imap(args.server, args.user, imap_access_token(args), args.folder, args.unseen_only)
+    elif not args.path:
+        parser.error(f"{args.source} needs a path")
+    elif args.source == "mbox":
+        messages = iter_mbox(args.path)
+    else:
+        messages = iter_maildir(args.path)
+
+    model = model_utils.load_model(args.backend)
+    if model is None:
+        raise SystemExit("No model found. Set MODEL_DIR or provide email_model.pkl.")
+    print(f"Model: {model.kind} ({model.backend}) from {model.source}", file=sys.stderr)
+
+    columns = COLUMNS + (BODY_COLUMNS if args.include_bodies else [])
+    writer = open_writer(args.output, output_format(args.output, args.format), columns)
+    try:
+        stats = classify_stream(model, messages, writer, max(1, args.batch_size), args.include_bodies, args.limit)
+    finally:
+        writer.close()
+        parse_utils.shutdown_parse_pool()
+    print(json.dumps(stats), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,672 @@
+"""
+Throughput benchmark for the scan pipeline.
+
+Generates a synthetic RFC822 corpus (plain/HTML/multipart mix, attachments,
+non-UTF-8 and RFC 2047 headers), serves it from an in-process IMAP server that
+accepts XOAUTH2, and drives the real fetch / parse / classify / scan-cycle code
+against it. Every stage reports messages per second, p50/p99 latency per email
+and peak RSS as JSON, so runs can be compared across releases:
+
+    python benchmark.py --messages 1000 --output bench_output.txt
+"""
+import os
+import sys
+import json
+import time
+import email
+import email.utils
+import quopri
+import random
+import base64
+import asyncio
+import argparse
+import platform
+import tempfile
+import datetime
+import threading
+import contextlib
+from email.header import Header
+import auth_utils
+import imap_utils
+import parse_utils
+import model_utils
+import cache_utils
+import history_utils
+import blob_utils
+import scanner_utils
+import metrics_utils
+
+# --- CONFIG ---
+BENCH_USER = "bench@example.com"
+BENCH_TOKEN = "bench-access-token"
+# How often the RSS sampler looks at the process during a stage
+RSS_SAMPLE_SECONDS = 0.01
+# New messages delivered per scan cycle in the scan_cycle stage
+SCAN_CYCLE_BATCH = 100
+STAGES = ("corpus", "imap_fetch", "parse", "parse_pool", "classify", "process_single_email", "scan_cycle")
+
+# --- SYNTHETIC CORPUS ---
+_WORDS = (
+    "meeting schedule report update project budget review team deadline client invoice "
+    "payment account order shipping delivery newsletter offer discount sale event "
+    "webinar reminder password security login server outage incident release notes "
+    "agenda minutes quarterly forecast contract proposal feedback survey weekend lunch"
+).split()
+_URGENT = "urgent asap immediately critical action required overdue escalation today".split()
+_ACCENTED = "café naïve résumé façade déjà-vu über Größe señor crème brûlée".split()
+_SUBJECTS = (
+    ("ascii", None, "Weekly project update"),
+    ("utf-8", "utf-8", "Réunion: budget 2025 ✔"),
+    ("iso-8859-1", "iso-8859-1", "Qualität der Lieferung überprüfen"),
+    ("shift_jis", "shift_jis", "会議の件について"),
+    ("koi8-r", "koi8-r", "Срочно: счёт на оплату"),
+    ("raw-8bit", "latin-1", "Café menu für Freitag"),
+)
+_BODY_CHARSETS = ("utf-8", "iso-8859-1", "windows-1252")
+_ENCODINGS = ("7bit", "8bit", "quoted-printable", "base64")
+
+def _sentence(rng):
+    words = [rng.choice(_WORDS) for _ in range(rng.randint(6, 18))]
+    if rng.random() < 0.2:
+        words.insert(rng.randrange(len(words)), rng.choice(_URGENT))
+    if rng.random() < 0.3:
+        words.insert(rng.randrange(len(words)), rng.choice(_ACCENTED))
+    return " ".join(words).capitalize() + "."
+
+def _paragraphs(rng):
+    return ["".join(_sentence(rng) + " " for _ in range(rng.randint(1, 6))).strip()
+            for _ in range(rng.randint(1, 8))]
+
+def _encode_body(payload, cte):
+    if cte == "base64":
+        return base64.encodebytes(payload).replace(b"\n", b"\r\n")
+    if cte == "quoted-printable":
+        return quopri.encodestring(payload).replace(b"\n", b"\r\n")
+    return payload.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+def _text_part(rng, subtype, text):
+    charset = rng.choice(_BODY_CHARSETS)
+    payload = text.encode(charset, errors="replace")
+    cte = rng.choice(_ENCODINGS)
+    if cte == "7bit" and any(b > 127 for b in payload):
+        cte = "quoted-printable"
+    head = (f"Content-Type: text/{subtype}; charset=\"{charset}\"\r\n"
+            f"Content-Transfer-Encoding: {cte}\r\n\r\n").encode("ascii")
+    return head + _encode_body(payload, cte)
+
+def _html(paragraphs):
+    cells = "".join(f"<tr><td><p>{p}</p></td></tr>" for p in paragraphs)
+    return ("<html><head><style>td { font-family: Arial; }</style>"
+            "<script>var tracking = 1;</script></head><body>"
+            f"<table>{cells}</table><p>Unsubscribe &amp; preferences: "
+            "<a href=\"https://example.com/u\">here</a></p></body></html>")
+
+def _multipart(subtype, parts, boundary):
+    out = [f"Content-Type: multipart/{subtype}; boundary=\"{boundary}\"\r\n\r\n".encode("ascii")]
+    for part in parts:
+        out.append(f"--{boundary}\r\n".encode("ascii") + part + b"\r\n")
+    out.append(f"--{boundary}--\r\n".encode("ascii"))
+    return b"".join(out)
+
+def _attachment(rng, index):
+    kind, ext = rng.choice((("application/pdf", "pdf"), ("image/png", "png"), ("application/zip", "zip")))
+    data = rng.randbytes(rng.randint(1024, 32 * 1024))
+    head = (f"Content-Type: {kind}; name=\"file{index}.{ext}\"\r\n"
+            "Content-Transfer-Encoding: base64\r\n"
+            f"Content-Disposition: attachment; filename=\"file{index}.{ext}\"\r\n\r\n").encode("ascii")
+    return head + base64.encodebytes(data).replace(b"\n", b"\r\n")
+
+def synthetic_message(rng, uid):
+    """One RFC822 message (CRLF line endings) and its kind."""
+    kind = rng.choices(("plain", "html", "alternative", "attachment"), weights=(40, 25, 20, 15))[0]
+    label, charset, subject = rng.choice(_SUBJECTS)
+    subject = f"{subject} #{uid}"
+    if label == "raw-8bit":
+        # Undeclared 8-bit header bytes: invalid per RFC 5322 but common in the wild
+        subject_line = b"Subject: " + subject.encode(charset)
+    elif charset:
+        subject_line = b"Subject: " + Header(subject, charset).encode().encode("ascii")
+    else:
+        subject_line = b"Subject: " + subject.encode("ascii")
+    sender = rng.choice(("Alice Example", "Bøb Büilder", "Team Notifications", "Зоя Иванова"))
+    from_line = b"From: " + Header(sender, "utf-8").encode().encode("ascii") + f" <sender{uid % 97}@example.com>".encode("ascii")
+    date = email.utils.formatdate(1700000000 + uid * 60)
+    headers = b"\r\n".join((
+        from_line,
+        f"To: {BENCH_USER}".encode("ascii"),
+        subject_line,
+        f"Date: {date}".encode("ascii"),
+        f"Message-ID: <bench-{uid}@example.com>".encode("ascii"),
+        b"MIME-Version: 1.0",
+    )) + b"\r\n"
+
+    paragraphs = _paragraphs(rng)
+    plain = "\n\n".join(paragraphs)
+    boundary = f"b{uid}x{rng.getrandbits(32):08x}"
+    if kind == "plain":
+        body = _text_part(rng, "plain", plain)
+    elif kind == "html":
+        body = _text_part(rng, "html", _html(paragraphs))
+    else:
+        alternative = _multipart("alternative", [
+            _text_part(rng, "plain", plain), _text_part(rng, "html", _html(paragraphs)),
+        ], boundary + "a")
+        if kind == "alternative":
+            body = alternative
+        else:
+            attachments = [_attachment(rng, i) for i in range(rng.randint(1, 3))]
+            body = _multipart("mixed", [alternative] + attachments, boundary + "m")
+    return headers + body, kind
+
+def generate_corpus(count, seed=0, stage=None):
+    """[(uid, raw bytes)] for UIDs 1..count plus {kind: count}; deterministic per seed."""
+    rng = random.Random(seed)
+    corpus, mix = [], {}
+    for uid in range(1, count + 1):
+        started = time.perf_counter()
+        raw, kind = synthetic_message(rng, uid)
+        if stage is not None:
+            stage.record(time.perf_counter() - started)
+        corpus.append((uid, raw))
+        mix[kind] = mix.get(kind, 0) + 1
+    return corpus, mix
+
+# --- IN-PROCESS IMAP SERVER ---
+class BenchIMAPServer:
+    """
+    Plain-TCP IMAP4rev1 server on an asyncio loop thread, serving a fixed corpus:
+    XOAUTH2 (checked against one user/token), SELECT, UID SEARCH/FETCH/STORE,
+    NOOP, ENABLE, IDLE and LOGOUT, which is everything the scanners send.
+    BODYSTRUCTURE is not served, so benchmarks always use full fetches.
+    """
+    CAPABILITIES = b"IMAP4rev1 IDLE ENABLE AUTH=XOAUTH2"
+
+    def __init__(self, corpus, user=BENCH_USER, token=BENCH_TOKEN, host="127.0.0.1"):
+        self.messages = dict(corpus)
+        self.user = user
+        self.token = token
+        self.host = host
+        self.port = None
+        self.seen = set()
+        self.bytes_sent = 0
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread = threading.Thread(target=self._loop.run_forever, name="bench-imap", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, self.host, 0), self._loop
+        ).result()
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        async def _close():
+            self._server.close()
+            await self._server.wait_closed()
+        asyncio.run_coroutine_threadsafe(_close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+
+    def reset(self):
+        """Mark every message unseen again (between stages)."""
+        self.seen.clear()
+        self.bytes_sent = 0
+
+    def _uid_set(self, spec):
+        highest = max(self.messages) if self.messages else 0
+        uids = set()
+        for part in spec.split(","):
+            start, _, end = part.partition(":")
+            lo = highest if start == "*" else int(start)
+            hi = lo if not end else (highest if end == "*" else int(end))
+            lo, hi = min(lo, hi), max(lo, hi)
+            uids.update(u for u in range(lo, hi + 1) if u in self.messages)
+        return sorted(uids)
+
+    def _search(self, args):
+        uids = sorted(self.messages)
+        tokens = args.split()
+        i = 0
+        while i < len(tokens):
+            token = tokens[i].upper()
+            if token == "UID" and i + 1 < len(tokens):
+                allowed = set(self._uid_set(tokens[i + 1]))
+                uids = [u for u in uids if u in allowed]
+                i += 1
+            elif token == "UNSEEN":
+                uids = [u for u in uids if u not in self.seen]
+            i += 1
+        return uids
+
+    async def _handle(self, reader, writer):
+        def send(data):
+            self.bytes_sent += len(data)
+            writer.write(data)
+
+        send(b"* OK [CAPABILITY " + self.CAPABILITIES + b"] bench IMAP ready\r\n")
+        authenticated = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                tag, _, rest = line.rstrip(b"\r\n").partition(b" ")
+                command, _, args = rest.partition(b" ")
+                command = command.upper()
+                args = args.decode("utf-8", errors="replace")
+                if command == b"UID":
+                    sub, _, args = args.partition(" ")
+                    command = b"UID " + sub.upper().encode("ascii")
+
+                if command == b"CAPABILITY":
+                    send(b"* CAPABILITY " + self.CAPABILITIES + b"\r\n" + tag + b" OK CAPABILITY completed\r\n")
+                elif command == b"AUTHENTICATE":
+                    mechanism, _, initial = args.partition(" ")
+                    if mechanism.upper() != "XOAUTH2":
+                        send(tag + b" NO unsupported mechanism\r\n")
+                    else:
+                        if not initial:
+                            send(b"+ \r\n")
+                            await writer.drain()
+                            initial = (await reader.readline()).strip().decode("ascii", errors="replace")
+                        try:
+                            credentials = base64.b64decode(initial).decode("utf-8")
+                        except ValueError:
+                            credentials = ""
+                        expected = auth_utils.generate_oauth2_string(self.user, self.token, base64_encode=False)
+                        if credentials == expected:
+                            authenticated = True
+                            send(tag + b" OK authenticated\r\n")
+                        else:
+                            send(tag + b" NO [AUTHENTICATIONFAILED] invalid credentials\r\n")
+                elif command == b"LOGOUT":
+                    send(b"* BYE logging out\r\n" + tag + b" OK LOGOUT completed\r\n")
+                    await writer.drain()
+                    break
+                elif command == b"NOOP":
+                    send(tag + b" OK NOOP completed\r\n")
+                elif not authenticated:
+                    send(tag + b" NO not authenticated\r\n")
+                elif command == b"ENABLE":
+                    send(b"* ENABLED\r\n" + tag + b" OK ENABLE completed\r\n")
+                elif command in (b"SELECT", b"EXAMINE"):
+                    highest = max(self.messages) if self.messages else 0
+                    send(
+                        f"* {len(self.messages)} EXISTS\r\n* 0 RECENT\r\n* FLAGS (\\Seen)\r\n"
+                        f"* OK [UIDVALIDITY 1] UIDs valid\r\n* OK [UIDNEXT {highest + 1}] next UID\r\n".encode("ascii")
+                        + tag + b" OK [READ-WRITE] SELECT completed\r\n"
+                    )
+                elif command == b"UID SEARCH":
+                    uids = self._search(args)
+                    send(b"* SEARCH" + b"".join(b" %d" % u for u in uids) + b"\r\n" + tag + b" OK SEARCH completed\r\n")
+                elif command == b"UID FETCH":
+                    spec, _, items = args.partition(" ")
+                    items = items.upper()
+                    if "BODY[]" not in items and "BODY.PEEK[]" not in items and "RFC822" not in items:
+                        send(tag + b" BAD only full-message fetches are served\r\n")
+                    else:
+                        for uid in self._uid_set(spec):
+                            raw = self.messages[uid]
+                            if "BODY[]" in items:
+                                self.seen.add(uid)
+                            send(b"* %d FETCH (UID %d BODY[] {%d}\r\n" % (uid, uid, len(raw)) + raw + b")\r\n")
+                        send(tag + b" OK FETCH completed\r\n")
+                elif command == b"UID STORE":
+                    spec, _, change = args.partition(" ")
+                    if "\\SEEN" in change.upper():
+                        uids = self._uid_set(spec)
+                        if change.startswith("-"):
+                            self.seen.difference_update(uids)
+                        else:
+                            self.seen.update(uids)
+                        if ".SILENT" not in change.upper():
+                            for uid in uids:
+                                send(b"* %d FETCH (UID %d FLAGS (\\Seen))\r\n" % (uid, uid))
+                    send(tag + b" OK STORE completed\r\n")
+                elif command == b"IDLE":
+                    send(b"+ idling\r\n")
+                    await writer.drain()
+                    await reader.readline()  # DONE
+                    send(tag + b" OK IDLE terminated\r\n")
+                else:
+                    send(tag + b" BAD unknown command\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+# --- MEASUREMENT ---
+class _RssSampler:
+    """Tracks the highest RSS seen while a stage runs."""
+    def __init__(self):
+        self.peak = model_utils.process_rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(RSS_SAMPLE_SECONDS):
+            self._sample()
+
+    def _sample(self):
+        rss = model_utils.process_rss_bytes()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+class Stage:
+    """
+    Times one benchmark stage. `record(seconds, count)` adds per-email latencies (a
+    batch's time is split evenly over its emails).
+    """
+    def __init__(self, name):
+        self.name = name
+        self.messages = 0
+        self.latencies = []
+        self.extra = {}
+        self.seconds = 0.0
+        self._rss = _RssSampler()
+
+    def record(self, seconds, count=1):
+        if count > 0:
+            self.latencies.extend([seconds / count] * count)
+
+    def __enter__(self):
+        print(f"[bench] {self.name}...", file=sys.stderr)
+        self._rss.__enter__()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._started
+        self._rss.__exit__(*exc)
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        messages = self.messages or len(latencies)
+        p50, p99 = _percentile(latencies, 50), _percentile(latencies, 99)
+        return {
+            "stage": self.name,
+            "messages": messages,
+            "seconds": round(self.seconds, 6),
+            "msgs_per_sec": round(messages / self.seconds, 3) if self.seconds > 0 else None,
+            "p50_ms": round(p50 * 1000, 4) if p50 is not None else None,
+            "p99_ms": round(p99 * 1000, 4) if p99 is not None else None,
+            "peak_rss_bytes": self._rss.peak,
+            **self.extra,
+        }
+
+# --- STAGES ---
+class _NullClassifier:
+    """Keyword stand-in for runs without a trained model: measures the pipeline, not the model."""
+    def predict(self, texts):
+        return [2 if any(w in t.lower() for w in _URGENT) else 0 for t in texts]
+
+    def predict_proba(self, texts):
+        return [[0.1, 0.1, 0.8] if p == 2 else [0.8, 0.1, 0.1] for p in self.predict(texts)]
+
+def load_bench_model(choice):
+    """A local model when one is installed ("auto"; never downloads), else the keyword stand-in."""
+    if choice == "auto" and (model_utils.resolve_model_dir() or os.path.exists(model_utils.LEGACY_MODEL_PATH)):
+        handle = model_utils.load_model()
+        if handle is not None:
+            return handle
+    return model_utils.ModelHandle(_NullClassifier(), "pkl", "null")
+
+def _token_data():
+    # Far-future expiry: get_access_token returns it without a provider round trip
+    return {"provider": "microsoft", "email": BENCH_USER, "access_token": BENCH_TOKEN,
+            "expires_at": time.time() + 86400}
+
+def run_imap_fetch(server, stage):
+    mail = imap_utils.connect_xoauth2(server.host, BENCH_USER, BENCH_TOKEN, port=server.port)
+    try:
+        imap_utils.select_mailbox(mail)
+        uids = imap_utils.search_unseen_uids(mail)
+        fetched = []
+        for chunk in imap_utils.uid_chunks(uids):
+            started = time.perf_counter()
+            attrs = imap_utils.fetch_uid_chunk(mail, chunk, "(UID BODY.PEEK[])")
+            stage.record(time.perf_counter() - started, len(chunk))
+            fetched.extend((uid, attrs[int(uid)]["BODY[]"]) for uid in chunk if int(uid) in attrs)
+    finally:
+        mail.logout()
+    stage.extra["bytes_fetched"] = sum(len(raw) for _, raw in fetched)
+    return fetched
+
+def run_parse(fetched, stage):
+    parsed = []
+    for uid, raw in fetched:
+        started = time.perf_counter()
+        parsed.append(parse_utils.parse_fetched(uid, raw))
+        stage.record(time.perf_counter() - started)
+    return parsed
+
+def run_parse_pool(fetched, stage):
+    # Per email: how long the driver waited for the next result, i.e. what the pool
+    # adds to a scan cycle (the same measure as the "parse" stage metric)
+    results = []
+    iterator = parse_utils.iter_parsed([(uid, raw, None) for uid, raw in fetched])
+    while True:
+        started = time.perf_counter()
+        parsed = next(iterator, None)
+        if parsed is None:
+            break
+        stage.record(time.perf_counter() - started)
+        results.append(parsed)
+    stage.extra["parse_workers"] = parse_utils.PARSE_WORKERS
+    return results
+
+def run_classify(model, parsed, stage):
+    texts = [p["full_input"] for p in parsed]
+    chunk = scanner_utils.PARSE_CLASSIFY_CHUNK
+    for i in range(0, len(texts), chunk):
+        batch = texts[i:i + chunk]
+        started = time.perf_counter()
+        model.classify(batch)
+        stage.record(time.perf_counter() - started, len(batch))
+
+def run_process_single_email(model, fetched, stage):
+    for uid, raw in fetched:
+        started = time.perf_counter()
+        scanner_utils.process_single_email(email.message_from_bytes(raw), model, uid)
+        stage.record(time.perf_counter() - started)
+
+@contextlib.contextmanager
+def fresh_classification_cache(stage):
+    """
+    Run a stage against an empty in-memory classification cache, so it is not served
+    from what an earlier stage classified; its stats and model inputs go in the report.
+    """
+    cache = cache_utils.ClassificationCache(path="")
+    previous = cache_utils.set_classification_cache(cache)
+    inputs = metrics_utils.snapshot()["counters"].get("model_inputs_total", 0)
+    try:
+        yield cache
+    finally:
+        cache_utils.set_classification_cache(previous)
+        stage.extra["classification_cache"] = {"enabled": cache.enabled, **cache.stats()}
+        stage.extra["model_inputs"] = metrics_utils.snapshot()["counters"].get("model_inputs_total", 0) - inputs
+
+def run_scan_cycle(model, server, count, stage, workdir, batch=SCAN_CYCLE_BATCH):
+    """
+    Deliver the corpus `batch` messages at a time, as if mail were arriving, and run
+    one ScannerWorker cycle per delivery; each cycle's time is split over its emails.
+    """
+    server.reset()
+    corpus = sorted(server.messages.items())
+    server.messages = {}
+    blobs = blob_utils.BlobStore(os.path.join(workdir, "bodies"))
+    history = history_utils.HistoryStore(os.path.join(workdir, "history.db"), blobs=blobs)
+    worker = scanner_utils.ScannerWorker(
+        server.host, BENCH_USER, _token_data(), model,
+        build_row=lambda parsed, label, prob: scanner_utils.build_row(parsed, label, prob, blobs=blobs),
+        history_store=history, sync_path=os.path.join(workdir, "sync_state.json"),
+        limit=count, push=False,
+    )
+    worker.subscribe("bench")
+    previous_port = imap_utils.IMAP_PORT
+    imap_utils.IMAP_PORT = server.port
+    cycles = 0
+    try:
+        for i in range(0, len(corpus), max(1, batch)):
+            server.messages.update(corpus[i:i + batch])
+            started = time.perf_counter()
+            stored = worker.scan_cycle()
+            stage.record(time.perf_counter() - started, stored)
+            cycles += 1
+    finally:
+        imap_utils.close_pooled_connection(server.host, BENCH_USER)
+        imap_utils.IMAP_PORT = previous_port
+        server.messages = dict(corpus)
+    stage.messages = history.count()
+    stage.extra["cycles"] = cycles
+    stage.extra["bytes_fetched"] = server.bytes_sent
+    errors = [e.payload for e in worker.drain("bench") if e.kind == "error"]
+    if errors:
+        stage.extra["errors"] = errors
+
+def run_backend_agreement(model, fetched, backends):
+    """
+    backend_agreement() of each backend against the loaded model on the corpus:
+    label agreement and largest confidence difference (the accuracy delta).
+    """
+    if model.kind != "hf_pipeline":
+        return {"skipped": "needs the transformer model (MODEL_DIR); nothing to compare against"}
+    texts = [parse_utils.parse_fetched(uid, raw)["full_input"] for uid, raw in fetched]
+    agreement = {"reference": model.backend}
+    for backend in backends:
+        print(f"[bench] backend agreement {model.backend} vs {backend}...", file=sys.stderr)
+        candidate = model_utils.load_model(backend)
+        if candidate is None or candidate.backend != backend:
+            agreement[backend] = {"error": f"{backend} backend is not available"}
+            continue
+        agreement[backend] = model_utils.backend_agreement(model, candidate, texts)
+    return agreement
+
+def run_benchmark(messages, seed=0, stages=STAGES, model_choice="auto", scan_batch=SCAN_CYCLE_BATCH,
+                  compare_backends=()):
+    """Run the selected stages and return the JSON-ready report."""
+    # The bench server speaks plain TCP and only serves full-message fetches
+    imap_utils.IMAP_SSL = False
+    imap_utils.IMAP_FETCH_MODE = "full"
+    results = []
+    report = {
+        "benchmark": "neuromail-scan",
+        "schema": 1,
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "messages": messages,
+            "seed": seed,
+            "imap_fetch_chunk": imap_utils.IMAP_FETCH_CHUNK,
+            "parse_workers": parse_utils.PARSE_WORKERS,
+            "parse_classify_chunk": scanner_utils.PARSE_CLASSIFY_CHUNK,
+            "scan_cycle_batch": scan_batch,
+            "inference_batch_size": model_utils.INFERENCE_BATCH_SIZE,
+            "classification_cache": cache_utils.get_classification_cache().enabled,
+        },
+        "stages": results,
+    }
+
+    stage = Stage("corpus")
+    with stage:
+        corpus, mix = generate_corpus(messages, seed, stage)
+    report["corpus"] = {"messages": len(corpus), "bytes": sum(len(raw) for _, raw in corpus), "mix": mix}
+    if "corpus" in stages:
+        results.append(stage.result())
+
+    model = load_bench_model(model_choice)
+    report["config"]["model"] = {"kind": model.kind, "backend": model.backend, "source": model.source}
+
+    server = BenchIMAPServer(corpus).start()
+    try:
+        fetched = corpus
+        if "imap_fetch" in stages:
+            with Stage("imap_fetch") as stage:
+                fetched = run_imap_fetch(server, stage)
+            results.append(stage.result())
+        parsed = None
+        if "parse" in stages or "classify" in stages:
+            with Stage("parse") as stage:
+                parsed = run_parse(fetched, stage)
+            if "parse" in stages:
+                results.append(stage.result())
+        if "parse_pool" in stages:
+            with Stage("parse_pool") as stage:
+                run_parse_pool(fetched, stage)
+            results.append(stage.result())
+        if "classify" in stages:
+            with Stage("classify") as stage:
+                run_classify(model, parsed, stage)
+            results.append(stage.result())
+        if "process_single_email" in stages:
+            with Stage("process_single_email") as stage, fresh_classification_cache(stage):
+                run_process_single_email(model, fetched, stage)
+            results.append(stage.result())
+        if "scan_cycle" in stages:
+            with tempfile.TemporaryDirectory(prefix="neuromail-bench-") as workdir:
+                with Stage("scan_cycle") as stage, fresh_classification_cache(stage):
+                    run_scan_cycle(model, server, messages, stage, workdir, scan_batch)
+            results.append(stage.result())
+        if compare_backends:
+            report["backend_agreement"] = run_backend_agreement(model, fetched, compare_backends)
+    finally:
+        server.stop()
+        parse_utils.shutdown_parse_pool()
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the NeuroMail scan pipeline on a synthetic corpus.")
+    parser.add_argument("--messages", type=int, default=1000, help="corpus size (100 to 100000 is the tested range)")
+    parser.add_argument("--seed", type=int, default=0, help="corpus seed (same seed, same corpus)")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma-separated subset of: {', '.join(STAGES)}")
+    parser.add_argument("--model", choices=("auto", "none"), default="auto",
+                        help="auto: the installed model if any (never downloads); none: keyword stand-in")
+    parser.add_argument("--scan-batch", type=int, default=SCAN_CYCLE_BATCH,
+                        help="new messages per scan cycle in the scan_cycle stage")
+    parser.add_argument("--compare-backends", default="",
+                        help="also report backend_agreement() of these backends (e.g. torch-int8,onnx) "
+                             "against the loaded model")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = sorted(set(stages) - set(STAGES))
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+    if args.messages < 1:
+        parser.error("--messages must be positive")
+
+    if args.scan_batch < 1:
+        parser.error("--scan-batch must be positive")
+
+    compare = [b.strip().lower() for b in args.compare_backends.split(",") if b.strip()]
+    report = run_benchmark(args.messages, args.seed, stages, args.model, args.scan_batch, compare)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import os
+import mmap
+import zlib
+import shutil
+import hashlib
+import threading
+
+# --- CONFIG ---
+# zlib level for stored bodies (1 = fastest, 9 = smallest)
+BLOB_COMPRESS_LEVEL = int(os.getenv("BLOB_COMPRESS_LEVEL", "6"))
+# Read blobs through mmap instead of read(); helps with very large HTML bodies
+BLOB_MMAP = os.getenv("BLOB_MMAP", "0").lower() in ("1", "true", "yes")
+
+class BlobStore:
+    """
+    Content-addressed, zlib-compressed body storage: <root>/<ab>/<sha256>.z.
+    The table rows only keep the hash; identical bodies are stored once.
+    """
+    def __init__(self, root, level=BLOB_COMPRESS_LEVEL, use_mmap=BLOB_MMAP):
+        self.root = root
+        self.level = level
+        self.use_mmap = use_mmap
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, ref):
+        return os.path.join(self.root, ref[:2], f"{ref}.z")
+
+    def put(self, data):
+        """Store bytes; returns the reference (sha256 hex). Empty data is not stored."""
+        if not data:
+            return ""
+        ref = hashlib.sha256(data).hexdigest()
+        path = self._path(ref)
+        if os.path.exists(path):
+            return ref
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(zlib.compress(data, self.level))
+        # Atomic: readers never see a partial blob; concurrent writers write identical bytes
+        os.replace(tmp, path)
+        return ref
+
+    def put_text(self, text):
+        if text is None:
+            return ""
+        return self.put(str(text).encode("utf-8", errors="surrogatepass"))
+
+    def get(self, ref):
+        """Bytes for a reference, or None when the blob is missing."""
+        if not ref:
+            return None
+        try:
+            with open(self._path(ref), "rb") as f:
+                if self.use_mmap:
+                    size = os.fstat(f.fileno()).st_size
+                    if size:
+                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                            return zlib.decompress(mm)
+                return zlib.decompress(f.read())
+        except (OSError, zlib.error) as e:
+            print(f"Could not read blob {ref}: {e}")
+            return None
+
+    def get_text(self, ref):
+        data = self.get(ref)
+        if data is None:
+            return ""
+        return data.decode("utf-8", errors="replace")
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+def get_blob_store(root):
+    key = os.path.abspath(root)
+    with _STORES_LOCK:
+        store = _STORES.get(key)
+        if store is None:
+            store = _STORES[key] = BlobStore(root)
+        return store
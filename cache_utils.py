@@ -0,0 +1,168 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+import metrics_utils
+
+# --- CONFIG ---
+# In-memory LRU entries (0 disables the cache entirely)
+CLASSIFICATION_CACHE_SIZE = int(os.getenv("CLASSIFICATION_CACHE_SIZE", "20000"))
+# Optional on-disk tier (SQLite file); empty keeps the cache in memory only
+CLASSIFICATION_CACHE_PATH = os.getenv("CLASSIFICATION_CACHE_PATH", "")
+
+def cache_key(text, model_identity):
+    """Hash of the exact classifier input plus the model that produced the label."""
+    h = hashlib.sha256()
+    h.update(str(model_identity).encode("utf-8"))
+    h.update(b"\0")
+    h.update(text.encode("utf-8", errors="surrogatepass"))
+    return h.hexdigest()
+
+class ClassificationCache:
+    """
+    Two-tier (label, confidence) cache: an LRU dict in memory and, optionally, a
+    SQLite table on disk that survives restarts. Thread-safe; shared process-wide.
+    """
+    def __init__(self, max_entries=CLASSIFICATION_CACHE_SIZE, path=CLASSIFICATION_CACHE_PATH):
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS classifications (key TEXT PRIMARY KEY, label TEXT, score REAL)"
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Classification cache on disk disabled ({path}): {e}")
+                self._db = None
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def __len__(self):
+        return len(self._lru)
+
+    def _remember(self, key, value):
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def get_many(self, keys):
+        """Return {key: (label, score)} for the keys that are cached; counts hits/misses."""
+        found = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                value = self._lru.get(key)
+                if value is not None:
+                    self._lru.move_to_end(key)
+                    found[key] = value
+                else:
+                    missing.append(key)
+            if missing and self._db is not None:
+                for i in range(0, len(missing), 500):
+                    part = missing[i:i + 500]
+                    rows = self._db.execute(
+                        f"SELECT key, label, score FROM classifications WHERE key IN ({','.join('?' * len(part))})",
+                        part,
+                    ).fetchall()
+                    for key, label, score in rows:
+                        found[key] = (label, score)
+                        self._remember(key, (label, score))
+                        self.disk_hits += 1
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """items: {key: (label, score)}"""
+        if not items: return
+        with self._lock:
+            for key, value in items.items():
+                self._remember(key, value)
+            if self._db is not None:
+                try:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO classifications (key, label, score) VALUES (?, ?, ?)",
+                        [(k, v[0], float(v[1])) for k, v in items.items()],
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"Error writing classification cache: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._lru),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+def get_classification_cache():
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = ClassificationCache()
+        return _CACHE
+
+def set_classification_cache(cache):
+    """Swap the process-wide cache (e.g. an empty one for a benchmark stage); returns the old one."""
+    global _CACHE
+    with _CACHE_LOCK:
+        previous, _CACHE = _CACHE, cache
+        return previous
+
+def _cache_metrics():
+    cache = _CACHE
+    if cache is None or not cache.enabled:
+        return []
+    stats = cache.stats()
+    return [
+        ("classification_cache_hits_total", "counter", "Classification cache hits (memory or disk).", stats["hits"]),
+        ("classification_cache_disk_hits_total", "counter", "Classification cache hits served from disk.", stats["disk_hits"]),
+        ("classification_cache_misses_total", "counter", "Classification cache misses.", stats["misses"]),
+        ("classification_cache_entries", "gauge", "Entries in the in-memory classification cache.", stats["entries"]),
+    ]
+
+metrics_utils.register_collector(_cache_metrics)
+
+def classify_with_cache(model, texts, batch_size=None, cache=None):
+    """
+    ModelHandle.classify with memoization: cached texts skip the transformer,
+    duplicate texts in one batch are classified once. Same output as classify().
+    """
+    if cache is None:
+        cache = get_classification_cache()
+    metrics_utils.inc("messages_classified_total", len(texts), help="Emails given a priority (cached or by the model).")
+    if not cache.enabled or not texts:
+        return model.classify(texts, batch_size)
+
+    keys = [cache_key(text, model.identity) for text in texts]
+    found = cache.get_many(list(dict.fromkeys(keys)))
+
+    pending = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in pending:
+            pending[key] = text
+    if pending:
+        results = model.classify(list(pending.values()), batch_size)
+        fresh = {key: result for key, result in zip(pending.keys(), results) if result is not None}
+        cache.put_many(fresh)
+        found.update(fresh)
+    return [found.get(key) for key in keys]
@@ -0,0 +1,233 @@
+import os
+import time
+import shutil
+import zipfile
+import hashlib
+import threading
+import requests
+
+# --- CONFIG ---
+# Bytes read per streamed chunk (also how often progress is updated)
+DOWNLOAD_CHUNK_BYTES = int(os.getenv("DOWNLOAD_CHUNK_BYTES", str(256 * 1024)))
+# Connect/read timeout for the artifact request
+DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("DOWNLOAD_TIMEOUT_SECONDS", "30"))
+# Attempts per fetch; each retry resumes from the bytes already on disk
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))
+# Name of the file (inside the artifact root) naming the active version directory
+CURRENT_MARKER = "CURRENT"
+
+class DownloadError(Exception):
+    pass
+
+class DownloadProgress:
+    """Thread-safe progress of one artifact fetch, polled by the UI."""
+    def __init__(self, url):
+        self.url = url
+        self._lock = threading.Lock()
+        self.state = "idle"   # idle, downloading, verifying, extracting, done, failed
+        self.downloaded = 0
+        self.total = None
+        self.error = None
+
+    def update(self, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+
+    def snapshot(self):
+        with self._lock:
+            fraction = self.downloaded / self.total if self.total else None
+            return {
+                "state": self.state, "downloaded": self.downloaded, "total": self.total,
+                "fraction": fraction, "error": self.error,
+            }
+
+_PROGRESS = {}
+_PROGRESS_LOCK = threading.Lock()
+
+def get_download_progress(url):
+    with _PROGRESS_LOCK:
+        progress = _PROGRESS.get(url)
+        if progress is None:
+            progress = _PROGRESS[url] = DownloadProgress(url)
+        return progress
+
+class FileLock:
+    """
+    Exclusive lock on `path` across processes (fcntl/msvcrt) and threads, so two
+    replicas starting at once never download or extract into the same directory.
+    """
+    _THREAD_LOCKS = {}
+    _THREAD_LOCKS_GUARD = threading.Lock()
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with self._THREAD_LOCKS_GUARD:
+            self._thread_lock = self._THREAD_LOCKS.setdefault(self.path, threading.Lock())
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._file = open(self.path, "a+b")
+            if os.name == "nt":
+                import msvcrt
+                self._file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK gives up after ~10s; keep waiting for the other process
+                        continue
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except Exception:
+            if self._file is not None:
+                self._file.close()
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if os.name == "nt":
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._thread_lock.release()
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_BYTES), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def download_file(url, path, headers=None, progress=None, retries=DOWNLOAD_RETRIES,
+                  timeout=DOWNLOAD_TIMEOUT_SECONDS):
+    """
+    Stream `url` to `path`, resuming from a partial `path` with an HTTP Range request.
+    A server that ignores Range (200 instead of 206) restarts the file from zero.
+    """
+    progress = progress or DownloadProgress(url)
+    last_error = None
+    for attempt in range(max(1, retries)):
+        have = os.path.getsize(path) if os.path.exists(path) else 0
+        request_headers = dict(headers or {})
+        if have:
+            request_headers["Range"] = f"bytes={have}-"
+        try:
+            with requests.get(url, headers=request_headers, stream=True, timeout=timeout) as resp:
+                if resp.status_code == 416 and have:
+                    # Nothing left to send: the partial file is already complete
+                    progress.update(downloaded=have, total=have)
+                    return path
+                resp.raise_for_status()
+                if resp.status_code == 206:
+                    mode = "ab"
+                    total = _content_range_total(resp.headers.get("Content-Range"))
+                else:
+                    mode, have = "wb", 0
+                    total = int(resp.headers["Content-Length"]) if "Content-Length" in resp.headers else None
+                progress.update(state="downloading", downloaded=have, total=total, error=None)
+                with open(path, mode) as f:
+                    for block in resp.iter_content(DOWNLOAD_CHUNK_BYTES):
+                        f.write(block)
+                        have += len(block)
+                        progress.update(downloaded=have)
+            if total is not None and have < total:
+                raise DownloadError(f"connection closed at {have} of {total} bytes")
+            return path
+        except (requests.RequestException, DownloadError, OSError) as e:
+            last_error = e
+            print(f"Download of {url} failed (attempt {attempt + 1}): {e}")
+            if attempt + 1 < retries:
+                time.sleep(min(2 ** attempt, 10))
+    raise DownloadError(f"could not download {url}: {last_error}")
+
+def _content_range_total(value):
+    # "bytes 100-999/1000" -> 1000 ("*" when the server does not know)
+    try:
+        total = value.rsplit("/", 1)[1]
+        return None if total == "*" else int(total)
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def current_version_dir(root):
+    """The active extracted version under `root`, or None if nothing was installed yet."""
+    try:
+        with open(os.path.join(root, CURRENT_MARKER), "r", encoding="utf-8") as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+    path = os.path.join(root, version)
+    return path if version and os.path.isdir(path) else None
+
+def fetch_artifact(url, root, sha256=None, headers=None, progress=None, required_file=None):
+    """
+    Download the zip at `url`, verify it, and extract it into `root/v-<sha256 prefix>`.
+
+    The zip is streamed to `root/download.part` (resumed on the next call after an
+    interruption) and checked against `sha256` when given. Extraction goes to a
+    temp directory that is renamed into place, then `root/CURRENT` is switched to
+    the new version, so readers only ever see a complete tree. Everything runs
+    under a file lock on `root/.lock`. Returns the version directory.
+    """
+    progress = progress or get_download_progress(url)
+    os.makedirs(root, exist_ok=True)
+    with FileLock(os.path.join(root, ".lock")):
+        # Another process may have finished while we waited for the lock
+        existing = current_version_dir(root)
+        if existing and (required_file is None or os.path.exists(os.path.join(existing, required_file))):
+            progress.update(state="done")
+            return existing
+
+        part_path = os.path.join(root, "download.part")
+        try:
+            download_file(url, part_path, headers=headers, progress=progress)
+            progress.update(state="verifying")
+            digest = file_sha256(part_path)
+            if sha256 and digest.lower() != sha256.lower():
+                # A corrupt partial would be resumed forever; start over next time
+                os.remove(part_path)
+                raise DownloadError(f"checksum mismatch for {url}: got {digest}, expected {sha256}")
+            if not sha256:
+                print(f"Warning: {url} was not verified (no checksum configured); its SHA-256 is {digest}")
+
+            progress.update(state="extracting")
+            version = f"v-{digest[:16]}"
+            target = os.path.join(root, version)
+            if not os.path.isdir(target):
+                tmp_dir = os.path.join(root, f".{version}.{os.getpid()}.tmp")
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                try:
+                    with zipfile.ZipFile(part_path, "r") as zf:
+                        zf.extractall(tmp_dir)
+                except zipfile.BadZipFile:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    os.remove(part_path)
+                    raise
+                if required_file and not os.path.exists(os.path.join(tmp_dir, required_file)):
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    os.remove(part_path)
+                    raise DownloadError(f"{url} does not contain {required_file}")
+                os.replace(tmp_dir, target)
+
+            marker_tmp = os.path.join(root, f"{CURRENT_MARKER}.{os.getpid()}.tmp")
+            with open(marker_tmp, "w", encoding="utf-8") as f:
+                f.write(version)
+            os.replace(marker_tmp, os.path.join(root, CURRENT_MARKER))
+            os.remove(part_path)
+        except (DownloadError, zipfile.BadZipFile, OSError) as e:
+            progress.update(state="failed", error=str(e))
+            raise DownloadError(str(e)) from e
+
+        progress.update(state="done")
+        return target
@@ -0,0 +1,231 @@
+import os
+import ast
+import math
+import json
+import time
+import sqlite3
+import threading
+
+# --- SCHEMA ---
+# Column order/names of the dashboard DataFrame, mapped to SQL columns
+COLUMNS = [
+    ("Time", "time"),
+    ("Priority", "priority"),
+    ("Confidence", "confidence"),
+    ("Sender", "sender"),
+    ("Subject", "subject"),
+    ("Tokens", "tokens"),
+    ("Content", "content"),
+    ("BodyRef", "body_ref"),
+    ("HtmlRef", "html_ref"),
+    ("ID", "email_id"),
+]
+# Inline bodies (pre blob store); moved out by migrate_inline_bodies()
+INLINE_BODY_COLUMNS = [
+    ("ContentFull", "content_full", "BodyRef", "body_ref"),
+    ("ContentHtml", "content_html", "HtmlRef", "html_ref"),
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    time TEXT,
+    priority TEXT,
+    confidence REAL,
+    sender TEXT,
+    subject TEXT,
+    tokens TEXT,
+    content TEXT,
+    content_full TEXT,
+    content_html TEXT,
+    body_ref TEXT,
+    html_ref TEXT,
+    email_id INTEGER,
+    scanned_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_emails_email_id ON emails (email_id);
+CREATE INDEX IF NOT EXISTS idx_emails_priority ON emails (priority, time);
+CREATE INDEX IF NOT EXISTS idx_emails_scanned_at ON emails (scanned_at);
+"""
+
+# Same order the dashboard sorts by: priority, then newest time, then newest insert
+_ORDER_BY = (
+    "ORDER BY CASE priority WHEN 'High' THEN 0 WHEN 'Medium' THEN 1 WHEN 'Low' THEN 2 ELSE 3 END, "
+    "time DESC, seq DESC"
+)
+
+def _encode_tokens(tokens):
+    if isinstance(tokens, str):
+        tokens = _decode_tokens(tokens)
+    return json.dumps(list(tokens or []))
+
+def _decode_tokens(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return []
+    if isinstance(value, list):
+        return value
+    text = str(value)
+    for parse in (json.loads, ast.literal_eval):
+        try:
+            parsed = parse(text)
+            if isinstance(parsed, (list, tuple)):
+                return list(parsed)
+        except (ValueError, SyntaxError):
+            continue
+    return []
+
+def _missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+class HistoryStore:
+    """
+    Append-only scan history in SQLite (WAL). Appends are O(1) per row and one
+    commit per scan cycle, instead of rewriting the whole CSV after every email.
+    With a BlobStore, bodies live out of the table and rows only keep references.
+    """
+    def __init__(self, path, blobs=None):
+        self.path = path
+        self.blobs = blobs
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Databases created before the blob store lack the *_ref columns
+        existing = {r[1] for r in self._conn.execute("PRAGMA table_info(emails)")}
+        if existing:
+            for col in ("body_ref", "html_ref"):
+                if col not in existing:
+                    self._conn.execute(f"ALTER TABLE emails ADD COLUMN {col} TEXT")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        if blobs is not None:
+            self.migrate_inline_bodies()
+
+    def _out_of_frame(self, row):
+        """Row copy with inline bodies swapped for blob refs (when a blob store is set)."""
+        row = dict(row)
+        for inline_col, _, ref_col, _ in INLINE_BODY_COLUMNS:
+            inline = row.pop(inline_col, None)
+            if self.blobs is not None and _missing(row.get(ref_col)) and not _missing(inline):
+                row[ref_col] = self.blobs.put_text(inline)
+            elif self.blobs is None and not _missing(inline):
+                row[inline_col] = inline
+        return row
+
+    def append_rows(self, rows):
+        """Insert a batch of dashboard rows in one transaction."""
+        if not rows: return
+        now = time.time()
+        columns = COLUMNS + [(inline_col, sql) for inline_col, sql, _, _ in INLINE_BODY_COLUMNS]
+        values = []
+        for row in rows:
+            row = self._out_of_frame(row)
+            record = []
+            for col, _ in columns:
+                value = row.get(col)
+                if col == "Tokens":
+                    value = _encode_tokens(value)
+                elif isinstance(value, float) and math.isnan(value):
+                    value = None
+                elif value is not None and col == "Confidence":
+                    value = float(value)
+                elif value is not None and col == "ID":
+                    value = int(value)
+                record.append(value)
+            record.append(now)
+            values.append(record)
+        placeholders = ", ".join("?" * (len(columns) + 1))
+        sql_cols = ", ".join([c for _, c in columns] + ["scanned_at"])
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(f"INSERT INTO emails ({sql_cols}) VALUES ({placeholders})", values)
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+
+    def load_frame(self):
+        """The whole history as the dashboard DataFrame, already in display order."""
+        sql_cols = ", ".join(c for _, c in COLUMNS)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {sql_cols} FROM emails {_ORDER_BY}").fetchall()
+        import pandas as pd  # deferred: keeps app startup light
+        if not rows:
+            return pd.DataFrame()
+        df = pd.DataFrame(rows, columns=[c for c, _ in COLUMNS])
+        df["Tokens"] = df["Tokens"].map(_decode_tokens)
+        df["BodyRef"] = df["BodyRef"].fillna("")
+        df["HtmlRef"] = df["HtmlRef"].fillna("")
+        return df
+
+    def migrate_inline_bodies(self, batch=500):
+        """Move bodies stored in the table (older rows, CSV imports) into the blob store."""
+        moved = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT seq, content_full, content_html, body_ref, html_ref FROM emails "
+                    "WHERE content_full IS NOT NULL OR content_html IS NOT NULL LIMIT ?",
+                    (batch,),
+                ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for seq, full, html, body_ref, html_ref in rows:
+                body_ref = body_ref or self.blobs.put_text(full)
+                html_ref = html_ref or self.blobs.put_text(html)
+                updates.append((body_ref, html_ref, seq))
+            with self._lock:
+                with self._conn:
+                    self._conn.executemany(
+                        "UPDATE emails SET body_ref = ?, html_ref = ?, content_full = NULL, content_html = NULL "
+                        "WHERE seq = ?",
+                        updates,
+                    )
+            moved += len(updates)
+        if moved:
+            with self._lock:
+                self._conn.execute("VACUUM")
+        return moved
+
+    def import_csv(self, csv_path):
+        """
+        One-time migration of a legacy scan_history_<md5>.csv. The CSV is renamed to
+        *.imported afterwards so it is never imported twice. Returns rows imported.
+        """
+        if not csv_path or not os.path.exists(csv_path):
+            return 0
+        import pandas as pd
+        try:
+            df = pd.read_csv(csv_path)
+        except Exception as e:
+            print(f"Could not import {csv_path}: {e}")
+            return 0
+        # The CSV was written in display order (top row first); insert bottom-up so
+        # insertion order (newest last) matches how the rows were originally added
+        rows = df.iloc[::-1].to_dict("records")
+        self.append_rows(rows)
+        os.replace(csv_path, f"{csv_path}.imported")
+        return len(rows)
+
+    def clear(self):
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM emails")
+            self._conn.execute("VACUUM")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+def get_history_store(path, blobs=None):
+    """One store (and SQLite connection) per history file per process."""
+    key = os.path.abspath(path)
+    with _STORES_LOCK:
+        store = _STORES.get(key)
+        if store is None:
+            store = _STORES[key] = HistoryStore(path, blobs)
+        return store
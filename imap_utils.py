@@ -0,0 +1,791 @@
+import os
+import re
+import imaplib
+import json
+import contextlib
+import binascii
+import quopri
+import select
+import threading
+import time
+import auth_utils
+import metrics_utils
+
+# --- CONFIG ---
+# Number of UIDs per FETCH / STORE command. Bigger chunks mean fewer round trips,
+# smaller chunks mean less data lost to a single failing command.
+IMAP_FETCH_CHUNK = int(os.getenv("IMAP_FETCH_CHUNK", "50"))
+# Socket timeout so a stalled server surfaces as an error instead of a hung scan
+IMAP_TIMEOUT_SECONDS = float(os.getenv("IMAP_TIMEOUT_SECONDS", "60"))
+# Server port, and whether to speak TLS; IMAP_SSL=0 is only for local test/benchmark servers
+IMAP_PORT = int(os.getenv("IMAP_PORT", "993"))
+IMAP_SSL = os.getenv("IMAP_SSL", "1").lower() in ("1", "true", "yes")
+# Pooled connections unused for this long are logged out
+IMAP_POOL_IDLE_SECONDS = float(os.getenv("IMAP_POOL_IDLE_SECONDS", "600"))
+
+# --- UID SETS ---
+def format_uid_set(uids):
+    """Compress UIDs into an IMAP sequence set, e.g. [1, 2, 3, 7, 9, 10] -> '1:3,7,9:10'."""
+    ordered = sorted(set(int(u) for u in uids))
+    ranges = []
+    start = prev = None
+    for uid in ordered:
+        if start is None:
+            start = prev = uid
+        elif uid == prev + 1:
+            prev = uid
+        else:
+            ranges.append((start, prev))
+            start = prev = uid
+    if start is not None:
+        ranges.append((start, prev))
+    return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+def uid_chunks(uids, chunk_size=None):
+    chunk_size = max(1, chunk_size or IMAP_FETCH_CHUNK)
+    uids = list(uids)
+    for i in range(0, len(uids), chunk_size):
+        yield uids[i:i + chunk_size]
+
+# --- FETCH RESPONSE PARSING ---
+# imaplib hands back FETCH data as a flat list mixing (header, literal) tuples and
+# bare bytes continuations. We rebuild the token stream and parse it properly so
+# that several messages (and several literals per message) can share one command.
+_LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+_ATOM_STOP = b' ()"\r\n'
+
+class _Literal(bytes):
+    pass
+
+def _tokenize(text, tokens):
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i:i + 1]
+        if c in (b' ', b'\r', b'\n'):
+            i += 1
+        elif c in (b'(', b')'):
+            tokens.append(c.decode())
+            i += 1
+        elif c == b'"':
+            i += 1
+            buf = bytearray()
+            while i < n and text[i:i + 1] != b'"':
+                if text[i:i + 1] == b'\\':
+                    i += 1
+                buf += text[i:i + 1]
+                i += 1
+            tokens.append(bytes(buf))
+            i += 1
+        elif c == b'{' and _LITERAL_RE.match(text, i):
+            # Literal marker: the payload is the next segment
+            break
+        else:
+            start = i
+            depth = 0
+            while i < n:
+                ch = text[i:i + 1]
+                if ch == b'[':
+                    depth += 1
+                elif ch == b']':
+                    depth -= 1
+                elif depth == 0 and ch in _ATOM_STOP:
+                    break
+                i += 1
+            atom = text[start:i].decode(errors='ignore')
+            tokens.append(None if atom.upper() == "NIL" else atom)
+
+def _build_tokens(data):
+    tokens = []
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            _tokenize(item[0], tokens)
+            tokens.append(_Literal(item[1]))
+        else:
+            _tokenize(item, tokens)
+    return tokens
+
+def _parse_list(tokens, pos):
+    out = []
+    while pos < len(tokens):
+        tok = tokens[pos]
+        if tok == ")":
+            return out, pos + 1
+        if tok == "(":
+            sub, pos = _parse_list(tokens, pos + 1)
+            out.append(sub)
+        else:
+            out.append(tok)
+            pos += 1
+    return out, pos
+
+def parse_fetch_response(data):
+    """
+    Parse the data list of a (UID) FETCH into one dict per message, keyed by the
+    upper-cased attribute name (e.g. 'UID', 'FLAGS', 'BODY[]', 'BODY[1]<0>').
+    """
+    tokens = _build_tokens(data or [])
+    messages = []
+    pos = 0
+    while pos < len(tokens):
+        tok = tokens[pos]
+        if isinstance(tok, str) and tok.isdigit() and pos + 1 < len(tokens) and tokens[pos + 1] == "(":
+            attrs, pos = _parse_list(tokens, pos + 2)
+            msg = {"SEQ": int(tok)}
+            for i in range(0, len(attrs) - 1, 2):
+                key = attrs[i]
+                if isinstance(key, str):
+                    msg[key.upper()] = attrs[i + 1]
+            messages.append(msg)
+        else:
+            pos += 1
+    return messages
+
+# --- BULK FETCH / STORE ---
+def fetch_uid_chunk(mail, uids, query):
+    """One UID FETCH for a whole chunk; returns {uid: attribute dict}."""
+    with metrics_utils.timed("imap_fetch"):
+        typ, data = mail.uid('FETCH', format_uid_set(uids), query)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"UID FETCH failed: {data}")
+    record_fetched_bytes(data)
+    return collect_fetched(data, uids)
+
+def record_fetched_bytes(data):
+    """Count the literal payload of a FETCH response (message bodies, headers, sections)."""
+    size = sum(len(item[1]) for item in data or [] if isinstance(item, tuple) and isinstance(item[1], bytes))
+    metrics_utils.inc("imap_bytes_fetched_total", size, help="Literal bytes received in FETCH responses.")
+
+def collect_fetched(data, uids):
+    """{uid: attribute dict} for the requested UIDs in a FETCH response."""
+    wanted = set(int(u) for u in uids)
+    fetched = {}
+    for msg in parse_fetch_response(data):
+        uid = msg.get("UID")
+        if uid is None or not str(uid).isdigit():
+            continue
+        uid = int(uid)
+        if uid in wanted:
+            fetched.setdefault(uid, {}).update(msg)
+    return fetched
+
+def fetch_uid_attributes(mail, uids, query, chunk_size=None):
+    """
+    Yield (uid, attribute dict) in the order of `uids`, issuing one FETCH per chunk.
+    If a chunk fails (NO/BAD, unparsable response) it is retried one message at a
+    time so a single bad message only costs itself. Connection aborts propagate.
+    """
+    for chunk in uid_chunks(uids, chunk_size):
+        try:
+            fetched = fetch_uid_chunk(mail, chunk, query)
+        except imaplib.IMAP4.abort:
+            raise
+        except Exception as e:
+            print(f"Chunk fetch failed ({e}), retrying {len(chunk)} emails one by one")
+            fetched = {}
+            for uid in chunk:
+                try:
+                    fetched.update(fetch_uid_chunk(mail, [uid], query))
+                except imaplib.IMAP4.abort:
+                    raise
+                except Exception as e_one:
+                    print(f"Error fetching email {uid}: {e_one}")
+        for uid in chunk:
+            if int(uid) in fetched:
+                yield int(uid), fetched[int(uid)]
+
+def fetch_messages(mail, uids, chunk_size=None):
+    """Yield (uid, raw RFC822 bytes) without setting \\Seen (BODY.PEEK)."""
+    for uid, attrs in fetch_uid_attributes(mail, uids, "(UID BODY.PEEK[])", chunk_size):
+        raw = attrs.get("BODY[]")
+        if isinstance(raw, bytes):
+            yield uid, raw
+
+def mark_seen(mail, uids, chunk_size=None):
+    """
+    Set \\Seen with one UID STORE per chunk (FLAGS.SILENT: no echoed FETCH lines).
+    Falls back to per-message STORE for a failing chunk. Returns the UIDs flagged.
+    """
+    flagged = set()
+    for chunk in uid_chunks(uids, chunk_size):
+        try:
+            with metrics_utils.timed("imap_store"):
+                typ, data = mail.uid('STORE', format_uid_set(chunk), '+FLAGS.SILENT', '(\\Seen)')
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"UID STORE failed: {data}")
+            flagged.update(int(u) for u in chunk)
+        except imaplib.IMAP4.abort:
+            raise
+        except Exception as e:
+            print(f"Chunk store failed ({e}), retrying {len(chunk)} emails one by one")
+            for uid in chunk:
+                try:
+                    typ, data = mail.uid('STORE', str(uid), '+FLAGS.SILENT', '(\\Seen)')
+                    if typ == 'OK':
+                        flagged.add(int(uid))
+                except imaplib.IMAP4.abort:
+                    raise
+                except Exception as e_one:
+                    print(f"Error marking email {uid} as read: {e_one}")
+    return flagged
+
+# --- INCREMENTAL SYNC STATE ---
+# Opt-in: with CONDSTORE (RFC 7162) we can tell from HIGHESTMODSEQ alone that nothing
+# changed, and restrict SEARCH to messages modified since the last scan.
+IMAP_CONDSTORE = os.getenv("IMAP_CONDSTORE", "0").lower() in ("1", "true", "yes")
+
+def new_sync_state():
+    return {"uidvalidity": None, "last_uid": 0, "highestmodseq": None}
+
+def load_sync_state(path):
+    """Load the per-account high-water mark; a missing or corrupt file means 'start fresh'."""
+    state = new_sync_state()
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                state.update(json.load(f))
+        except Exception as e:
+            print(f"Ignoring unreadable sync state {path}: {e}")
+    return state
+
+def save_sync_state(path, state):
+    if not path: return
+    # Write-then-rename so a crash never leaves a half-written file behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def _has_capability(mail, name):
+    return name in getattr(mail, "capabilities", ())
+
+def _response_int(mail, code):
+    _, data = mail.response(code)
+    for value in data or []:
+        if value is None: continue
+        value = value.decode() if isinstance(value, bytes) else str(value)
+        digits = value.split()[0].strip("()") if value.split() else ""
+        if digits.isdigit():
+            return int(digits)
+    return None
+
+def select_mailbox(mail, mailbox="inbox", condstore=False):
+    """
+    SELECT the mailbox and return (uidvalidity, highestmodseq). highestmodseq is None
+    unless CONDSTORE was requested and the server supports it.
+    """
+    if condstore and _has_capability(mail, "CONDSTORE") and _has_capability(mail, "ENABLE"):
+        try:
+            if mail.state == "AUTH":
+                mail.enable("CONDSTORE")
+        except Exception as e:
+            print(f"CONDSTORE not enabled: {e}")
+            condstore = False
+    else:
+        condstore = False
+
+    typ, data = mail.select(mailbox)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"SELECT {mailbox} failed: {data}")
+    uidvalidity = _response_int(mail, "UIDVALIDITY")
+    highestmodseq = _response_int(mail, "HIGHESTMODSEQ") if condstore else None
+    return uidvalidity, highestmodseq
+
+def reconcile_sync_state(state, uidvalidity):
+    """UIDs are only comparable within one UIDVALIDITY; a change invalidates the mark."""
+    if state.get("uidvalidity") != uidvalidity:
+        if state.get("uidvalidity") is not None:
+            print(f"UIDVALIDITY changed ({state.get('uidvalidity')} -> {uidvalidity}), resetting sync state")
+        state.update(new_sync_state())
+        state["uidvalidity"] = uidvalidity
+    return state
+
+def search_unseen_uids(mail, last_uid=0, since_modseq=None):
+    """
+    UID SEARCH for unread mail above `last_uid`, newest first. With `since_modseq`
+    only messages changed after that MODSEQ are considered (CONDSTORE).
+    """
+    with metrics_utils.timed("imap_search"):
+        typ, data = mail.uid('SEARCH', None, *search_criteria(last_uid, since_modseq))
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"UID SEARCH failed: {data}")
+    return search_result(data, last_uid)
+
+def search_criteria(last_uid=0, since_modseq=None):
+    criteria = []
+    if last_uid:
+        criteria.append(f"UID {int(last_uid) + 1}:*")
+    criteria.append("UNSEEN")
+    if since_modseq:
+        criteria.append(f"MODSEQ {int(since_modseq) + 1}")
+    return criteria
+
+def search_result(data, last_uid=0):
+    """UIDs from a UID SEARCH response, above `last_uid`, newest first."""
+    raw = data[0].split() if data and data[0] else []
+    # 'N:*' always matches the highest UID even when it is below N, so filter again
+    uids = [int(x) for x in raw if x.isdigit()]
+    return sorted((u for u in uids if u > last_uid), reverse=True)
+
+# --- CONNECT ---
+def connect_xoauth2(server, user, access_token, port=None):
+    """Open a TLS IMAP connection and authenticate with XOAUTH2."""
+    imap_class = imaplib.IMAP4_SSL if IMAP_SSL else imaplib.IMAP4
+    mail = imap_class(server, port or IMAP_PORT, timeout=IMAP_TIMEOUT_SECONDS)
+    auth_str = auth_utils.generate_oauth2_string(user, access_token, base64_encode=False)
+    mail.authenticate('XOAUTH2', lambda x: auth_str)
+    # Pre-auth capabilities may omit extensions (IDLE, CONDSTORE); ask again
+    try:
+        typ, dat = mail.capability()
+        if typ == 'OK' and dat and dat[-1]:
+            mail.capabilities = tuple(dat[-1].decode().upper().split())
+    except Exception:
+        pass
+    return mail
+
+# --- IMAP IDLE (RFC 2177) ---
+# RFC 2177: servers may drop an IDLE after 30 minutes, so clients re-issue it before that
+IDLE_REFRESH_SECONDS = int(os.getenv("IDLE_REFRESH_SECONDS", str(29 * 60)))
+_EXISTS_RE = re.compile(rb'^\* \d+ EXISTS', re.IGNORECASE)
+
+class _LineReader:
+    """
+    Minimal line reader on the raw socket with a timeout. imaplib's buffered file
+    object becomes unusable after a read timeout, so IDLE does its own reading.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b""
+
+    def readline(self, timeout):
+        deadline = time.monotonic() + timeout
+        while b"\r\n" not in self.buf:
+            pending = self.sock.pending() if hasattr(self.sock, "pending") else 0
+            if not pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                readable, _, _ = select.select([self.sock], [], [], remaining)
+                if not readable:
+                    return None
+            chunk = self.sock.recv(8192)
+            if not chunk:
+                raise imaplib.IMAP4.abort("connection closed by server")
+            self.buf += chunk
+        line, self.buf = self.buf.split(b"\r\n", 1)
+        return line
+
+def idle_once(mail, timeout, stop_event=None, poll_interval=1.0):
+    """
+    Run one IDLE command for at most `timeout` seconds. Returns True as soon as the
+    server reports EXISTS (new mail), False on timeout or when `stop_event` is set.
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    reader = _LineReader(mail.sock)
+    line = reader.readline(30)
+    while line is not None and line.startswith(b"*"):
+        # Untagged data queued before the server entered IDLE
+        line = reader.readline(30)
+    if line is None or not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+    got_exists = False
+    deadline = time.monotonic() + timeout
+    while not got_exists and not (stop_event is not None and stop_event.is_set()):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        line = reader.readline(min(remaining, poll_interval))
+        if line is None:
+            continue
+        if line.upper().startswith(b"* BYE"):
+            raise imaplib.IMAP4.abort(line.decode(errors='ignore'))
+        if _EXISTS_RE.match(line):
+            got_exists = True
+
+    mail.send(b"DONE\r\n")
+    while True:
+        line = reader.readline(30)
+        if line is None:
+            raise imaplib.IMAP4.abort("timed out waiting for IDLE to finish")
+        if line.startswith(tag):
+            if b" OK" not in line.upper():
+                raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+            return got_exists
+        if _EXISTS_RE.match(line):
+            got_exists = True
+
+class IdleWatcher:
+    """
+    Holds one IDLE connection for an account in a daemon thread. Every EXISTS from
+    the server bumps `generation`; sessions wait for the generation to change and
+    only then run a scan cycle. Reconnects (with a fresh token from `token_provider`)
+    after errors and re-issues IDLE every IDLE_REFRESH_SECONDS.
+    """
+    def __init__(self, server, user, token_provider, mailbox="inbox"):
+        self.server = server
+        self.user = user
+        self.mailbox = mailbox
+        self.token_provider = token_provider
+        self.generation = 1  # > 0 so every session scans once right away
+        self.supported = True
+        self.last_error = None
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"imap-idle-{user}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._notify()
+
+    def is_alive(self):
+        return self._thread.is_alive() and not self._stop.is_set()
+
+    def _notify(self):
+        with self._cond:
+            self.generation += 1
+            self._cond.notify_all()
+
+    def wait_for_change(self, seen_generation, timeout):
+        """Block until new mail was reported since `seen_generation` (or timeout)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.generation != seen_generation, timeout)
+            return self.generation
+
+    def _run(self):
+        backoff = 5
+        while not self._stop.is_set():
+            mail = None
+            try:
+                mail = connect_xoauth2(self.server, self.user, self.token_provider())
+                if not _has_capability(mail, "IDLE"):
+                    print(f"{self.server} does not support IDLE, falling back to polling")
+                    self.supported = False
+                    self._stop.set()
+                    self._notify()
+                    return
+                mail.select(self.mailbox)
+                backoff = 5
+                while not self._stop.is_set():
+                    if idle_once(mail, IDLE_REFRESH_SECONDS, self._stop):
+                        self._notify()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"IDLE connection for {self.user} dropped: {e}")
+                # Anything may have arrived while we were disconnected
+                self._notify()
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 300)
+            finally:
+                if mail is not None:
+                    try: mail.logout()
+                    except Exception: pass
+
+_IDLE_WATCHERS = {}
+_IDLE_LOCK = threading.Lock()
+
+def get_idle_watcher(server, user, token_provider):
+    """Process-wide: one IDLE connection per account, shared by all of its sessions."""
+    key = (server, user.strip().lower())
+    with _IDLE_LOCK:
+        watcher = _IDLE_WATCHERS.get(key)
+        if watcher is None or (not watcher.is_alive() and watcher.supported):
+            watcher = IdleWatcher(server, user, token_provider).start()
+            _IDLE_WATCHERS[key] = watcher
+        else:
+            watcher.token_provider = token_provider
+        return watcher
+
+def stop_idle_watcher(server, user):
+    key = (server, user.strip().lower())
+    with _IDLE_LOCK:
+        watcher = _IDLE_WATCHERS.pop(key, None)
+    if watcher is not None:
+        watcher.stop()
+
+# --- CONNECTION POOL ---
+class PooledConnection:
+    """
+    One authenticated, selected connection per account, kept across scan cycles
+    (and Streamlit reruns). `lock` serializes use by concurrent sessions.
+    """
+    def __init__(self, server, user):
+        self.server = server
+        self.user = user
+        self.lock = threading.RLock()
+        self.mail = None
+        self.access_token = None
+        self.mailbox = None
+        self.uidvalidity = None
+        self.highestmodseq = None
+        self.last_used = time.monotonic()
+        self.connects = 0
+
+    def close(self):
+        if self.mail is not None:
+            try: self.mail.logout()
+            except Exception: pass
+        self.mail = None
+        self.access_token = None
+        self.mailbox = None
+
+    def _healthy(self):
+        try:
+            typ, _ = self.mail.noop()
+            return typ == 'OK'
+        except (imaplib.IMAP4.error, OSError):
+            # BYE, timeouts and resets all mean this connection is gone
+            return False
+
+    def ensure(self, access_token, mailbox="inbox", condstore=False):
+        if self.mail is not None and access_token != self.access_token:
+            # XOAUTH2 can't re-authenticate an open session; start over with the new token
+            self.close()
+        if self.mail is not None and not self._healthy():
+            print(f"IMAP connection for {self.user} went stale, reconnecting")
+            self.close()
+
+        if self.mail is None:
+            with metrics_utils.timed("imap_connect"):
+                self.mail = connect_xoauth2(self.server, self.user, access_token)
+                self.access_token = access_token
+                self.connects += 1
+                self.uidvalidity, self.highestmodseq = select_mailbox(self.mail, mailbox, condstore)
+            self.mailbox = mailbox
+        elif condstore or mailbox != self.mailbox:
+            # Re-SELECT to get a current HIGHESTMODSEQ; still far cheaper than TLS + auth
+            self.uidvalidity, self.highestmodseq = select_mailbox(self.mail, mailbox, condstore)
+            self.mailbox = mailbox
+        self.last_used = time.monotonic()
+        return self
+
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+
+def _evict_idle_connections():
+    now = time.monotonic()
+    stale = []
+    with _POOL_LOCK:
+        for key, entry in list(_POOL.items()):
+            if now - entry.last_used > IMAP_POOL_IDLE_SECONDS and entry.lock.acquire(blocking=False):
+                stale.append(_POOL.pop(key))
+    for entry in stale:
+        try: entry.close()
+        finally: entry.lock.release()
+
+@contextlib.contextmanager
+def pooled_connection(server, user, access_token, mailbox="inbox", condstore=False):
+    """
+    Check out the account's pooled connection, (re)connecting only if it is missing,
+    unhealthy (NOOP fails) or the access token changed. A connection-level error in
+    the body drops the connection so the next cycle reconnects.
+    """
+    _evict_idle_connections()
+    key = (server, user.strip().lower())
+    with _POOL_LOCK:
+        entry = _POOL.get(key)
+        if entry is None:
+            entry = _POOL[key] = PooledConnection(server, user)
+    with entry.lock:
+        entry.ensure(access_token, mailbox, condstore)
+        try:
+            yield entry
+        except (imaplib.IMAP4.abort, OSError):
+            entry.close()
+            raise
+        finally:
+            entry.last_used = time.monotonic()
+
+def _close_entry(entry):
+    with entry.lock:
+        entry.close()
+
+def close_pooled_connection(server, user, wait=True):
+    """
+    Drop the account's pooled connection. With wait=False a connection that a scan
+    cycle is still using is closed by a background thread once the cycle releases it.
+    """
+    key = (server, user.strip().lower())
+    with _POOL_LOCK:
+        entry = _POOL.pop(key, None)
+    if entry is None:
+        return
+    if wait:
+        _close_entry(entry)
+    elif entry.lock.acquire(blocking=False):
+        try: entry.close()
+        finally: entry.lock.release()
+    else:
+        threading.Thread(target=_close_entry, args=(entry,), name=f"imap-close-{user}", daemon=True).start()
+
+# --- PARTIAL FETCH (BODYSTRUCTURE) ---
+# "full" downloads whole RFC822 messages; "partial" downloads headers + BODYSTRUCTURE,
+# then only the text/plain and text/html sections (optionally capped at
+# IMAP_PARTIAL_BYTES via <0.N>), so attachments never cross the wire.
+IMAP_FETCH_MODE = os.getenv("IMAP_FETCH_MODE", "full").lower()
+IMAP_PARTIAL_BYTES = int(os.getenv("IMAP_PARTIAL_BYTES", "0"))
+# First round of a partial fetch: structure + headers only
+PARTIAL_STRUCTURE_QUERY = "(UID BODYSTRUCTURE BODY.PEEK[HEADER])"
+
+def _s(value):
+    if value is None: return ""
+    if isinstance(value, bytes): return value.decode(errors='ignore')
+    return str(value)
+
+def _param_dict(params):
+    if not isinstance(params, list): return {}
+    return {_s(params[i]).lower(): _s(params[i + 1]) for i in range(0, len(params) - 1, 2)}
+
+def _disposition_filename(disposition):
+    if not isinstance(disposition, list) or len(disposition) < 2: return None
+    params = _param_dict(disposition[1])
+    return params.get("filename") or params.get("filename*")
+
+def walk_bodystructure(bs, section=""):
+    """
+    Yield one dict per MIME part in the same order as email.message.Message.walk():
+    section (IMAP part specifier), ctype, encoding, filename, multipart flag.
+    """
+    if not isinstance(bs, list) or not bs:
+        return
+    if isinstance(bs[0], list):
+        children = []
+        for item in bs:
+            if not isinstance(item, list): break
+            children.append(item)
+        rest = bs[len(children):]
+        subtype = _s(rest[0]).lower() if rest else "mixed"
+        disposition = rest[2] if len(rest) > 2 else None
+        yield {"section": section, "ctype": f"multipart/{subtype}", "encoding": "",
+               "filename": _disposition_filename(disposition), "multipart": True}
+        for i, child in enumerate(children, 1):
+            yield from walk_bodystructure(child, f"{section}.{i}" if section else str(i))
+        return
+
+    ctype = f"{_s(bs[0])}/{_s(bs[1])}".lower()
+    encoding = _s(bs[5]).lower() if len(bs) > 5 else ""
+    if ctype.startswith("text/"):
+        disposition_idx = 9
+    elif ctype == "message/rfc822":
+        disposition_idx = 11
+    else:
+        disposition_idx = 8
+    disposition = bs[disposition_idx] if len(bs) > disposition_idx else None
+    filename = _disposition_filename(disposition) or _param_dict(bs[2]).get("name")
+    own_section = section or "1"
+    inner = bs[8] if ctype == "message/rfc822" and len(bs) > 8 else None
+    yield {"section": own_section, "ctype": ctype, "encoding": encoding,
+           "filename": filename, "multipart": isinstance(inner, list)}
+    if isinstance(inner, list) and inner:
+        # Parts of an attached message are numbered below the message's own section
+        if isinstance(inner[0], list):
+            yield from walk_bodystructure(inner, own_section)
+        else:
+            yield from walk_bodystructure(inner, f"{own_section}.1")
+
+def attachment_tokens(parts):
+    """Same PDF/IMG/CALENDAR tokens get_email_content derives from part filenames."""
+    tokens = []
+    for part in parts:
+        if part["filename"]:
+            fname = part["filename"].lower()
+            if ".pdf" in fname: tokens.append("PDF")
+            elif ".jpg" in fname or ".jpeg" in fname or ".png" in fname: tokens.append("IMG")
+            elif "invite" in fname: tokens.append("CALENDAR")
+    return tokens
+
+def plan_text_sections(bodystructure):
+    """
+    Pick the sections to download: (plain_part, html_part, tokens). Mirrors
+    get_email_content: the last text/plain and text/html part win; a single-part
+    message is read as plain text unless it is text/html.
+    """
+    parts = list(walk_bodystructure(bodystructure))
+    if not parts:
+        return None, None, []
+    if not parts[0]["multipart"]:
+        top = parts[0]
+        return (None, top, []) if top["ctype"] == "text/html" else (top, None, [])
+    plain = html = None
+    for part in parts:
+        if part["ctype"] == "text/plain": plain = part
+        elif part["ctype"] == "text/html": html = part
+    return plain, html, attachment_tokens(parts)
+
+def decode_section(raw, encoding):
+    """Undo the Content-Transfer-Encoding of a (possibly truncated) section."""
+    if raw is None: return b""
+    if encoding == "base64":
+        data = b"".join(raw.split())
+        data = data[:len(data) - len(data) % 4]  # a byte cap may cut mid-quantum
+        try: return binascii.a2b_base64(data)
+        except binascii.Error: return b""
+    if encoding == "quoted-printable":
+        return quopri.decodestring(raw)
+    return raw
+
+def _section_item(section, max_bytes):
+    return f"BODY.PEEK[{section}]<0.{max_bytes}>" if max_bytes else f"BODY.PEEK[{section}]"
+
+def _section_value(attrs, section):
+    for key in (f"BODY[{section}]", f"BODY[{section}]<0>"):
+        if key in attrs:
+            return attrs[key]
+    return None
+
+def fetch_messages_partial(mail, uids, chunk_size=None, max_bytes=None):
+    """
+    Yield (uid, header_bytes, body_text, body_html, tokens) in the order of `uids`.
+    Two FETCH rounds per chunk: structure + headers, then just the text sections
+    (one command per distinct set of sections, which is usually one).
+    """
+    max_bytes = IMAP_PARTIAL_BYTES if max_bytes is None else max_bytes
+    for chunk in uid_chunks(uids, chunk_size):
+        plans = partial_plans(fetch_uid_attributes(mail, chunk, PARTIAL_STRUCTURE_QUERY, chunk_size))
+        bodies = {}
+        for query, group_uids in partial_body_queries(plans, max_bytes):
+            for uid, attrs in fetch_uid_attributes(mail, group_uids, query, chunk_size):
+                bodies[uid] = attrs
+        yield from partial_results(chunk, plans, bodies)
+
+def partial_plans(structure_items):
+    """{uid: (header, plain part, html part, attachment tokens)} from the structure round."""
+    plans = {}
+    for uid, attrs in structure_items:
+        header = attrs.get("BODY[HEADER]")
+        if not isinstance(header, bytes):
+            continue
+        plain, html, tokens = plan_text_sections(attrs.get("BODYSTRUCTURE"))
+        plans[uid] = (header, plain, html, tokens)
+    return plans
+
+def partial_body_queries(plans, max_bytes):
+    """(FETCH query, uids) pairs: one per distinct set of text sections."""
+    groups = {}
+    for uid, (_, plain, html, _) in plans.items():
+        sections = tuple(p["section"] for p in (plain, html) if p is not None)
+        if sections:
+            groups.setdefault(sections, []).append(uid)
+    for sections, group_uids in groups.items():
+        yield "(UID " + " ".join(_section_item(s, max_bytes) for s in sections) + ")", group_uids
+
+def partial_results(chunk, plans, bodies):
+    """Yield (uid, header, body_text, body_html, tokens) in chunk order."""
+    for uid in chunk:
+        uid = int(uid)
+        if uid not in plans:
+            continue
+        header, plain, html, tokens = plans[uid]
+        attrs = bodies.get(uid, {})
+        body_text = body_html = ""
+        if plain is not None:
+            body_text = decode_section(_section_value(attrs, plain["section"]), plain["encoding"]).decode(errors='ignore')
+        if html is not None:
+            body_html = decode_section(_section_value(attrs, html["section"]), html["encoding"]).decode(errors='ignore')
+        yield uid, header, body_text, body_html, tokens
@@ -0,0 +1,182 @@
+import os
+import time
+import bisect
+import itertools
+
+# Display order: priority first, then newest time, then most recently added
+PRIORITY_RANK = {"High": 0, "Medium": 1, "Low": 2, "Unknown": 3}
+
+def _time_seconds(value):
+    # Rows carry "HH:MM:SS"; anything else sorts as the oldest time
+    try:
+        h, m, s = str(value).split(":")
+        return int(h) * 3600 + int(m) * 60 + int(s)
+    except (ValueError, AttributeError):
+        return -1
+
+class InboxModel:
+    """
+    The scanned inbox kept in display order as rows are added.
+
+    Rows live in a list of small sorted buckets (the layout sortedcontainers uses):
+    an insert bisects the bucket maxima, then the bucket, so it costs O(log n) plus
+    a memmove of at most BUCKET_SIZE entries. Per-priority counts are updated on
+    insert, and a DataFrame is only built (and cached) when the UI renders.
+    """
+    BUCKET_SIZE = 512
+
+    def __init__(self, rows=None):
+        self.clear()
+        if rows:
+            self.extend(rows)
+
+    @classmethod
+    def from_frame(cls, df):
+        """Load a DataFrame already in display order (e.g. from the history store)."""
+        inbox = cls()
+        if df is not None and not df.empty:
+            # Insert bottom-up so the top row ends up as the most recent insert
+            inbox.extend(df.iloc[::-1].to_dict("records"))
+        return inbox
+
+    def clear(self):
+        self._buckets = []   # lists of (key, row)
+        self._maxes = []     # last key of each bucket
+        self._seq = itertools.count()
+        self._len = 0
+        self.counts = {label: 0 for label in PRIORITY_RANK}
+        self.version = 0
+        self._frames = {}
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def empty(self):
+        return self._len == 0
+
+    def _key(self, row):
+        rank = PRIORITY_RANK.get(row.get("Priority"), 3)
+        return (rank, -_time_seconds(row.get("Time")), -next(self._seq))
+
+    def insert(self, row):
+        key = self._key(row)
+        item = (key, row)
+        if not self._buckets:
+            self._buckets.append([item])
+            self._maxes.append(key)
+        else:
+            pos = bisect.bisect_left(self._maxes, key)
+            if pos == len(self._buckets):
+                pos -= 1
+            bucket = self._buckets[pos]
+            bisect.insort(bucket, item, key=lambda x: x[0])
+            self._maxes[pos] = bucket[-1][0]
+            if len(bucket) > 2 * self.BUCKET_SIZE:
+                half = len(bucket) // 2
+                self._buckets[pos:pos + 1] = [bucket[:half], bucket[half:]]
+                self._maxes[pos:pos + 1] = [bucket[half - 1][0], bucket[-1][0]]
+
+        self._len += 1
+        priority = row.get("Priority")
+        self.counts[priority if priority in self.counts else "Unknown"] += 1
+        self.version += 1
+        self._frames = {}
+
+    def extend(self, rows):
+        for row in rows:
+            self.insert(row)
+
+    def rows(self):
+        for bucket in self._buckets:
+            for _, row in bucket:
+                yield row
+
+    def row_at(self, index):
+        """Row at a display position (what st.dataframe selection returns)."""
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError(index)
+        for bucket in self._buckets:
+            if index < len(bucket):
+                return bucket[index][1]
+            index -= len(bucket)
+        raise IndexError(index)
+
+    def to_frame(self, exclude=()):
+        """Materialize the rows (minus `exclude` columns) as a DataFrame; cached per version."""
+        key = tuple(exclude)
+        df = self._frames.get(key)
+        if df is None:
+            import pandas as pd  # deferred: keeps app startup light
+            excluded = set(exclude)
+            df = pd.DataFrame([
+                {k: v for k, v in row.items() if k not in excluded} for row in self.rows()
+            ])
+            self._frames[key] = df
+        return df
+
+# --- RENDER THROTTLING ---
+# Redraw the dashboard during a scan at most this often...
+RENDER_INTERVAL_SECONDS = float(os.getenv("RENDER_INTERVAL_SECONDS", "1.0"))
+# ...or sooner once this many rows arrived since the last redraw
+RENDER_MIN_ROWS = int(os.getenv("RENDER_MIN_ROWS", "50"))
+
+class RenderScheduler:
+    """
+    Coalesces per-email UI updates during a scan. `notify()` after each insert
+    redraws only when the inbox changed since the last draw and either
+    `interval` seconds passed or `min_rows` rows arrived; `flush()` draws
+    whatever is still pending once the cycle completes.
+
+    `inbox` is an InboxModel or a callable returning the current one, for
+    callers that may replace the model (a replaced inbox is always pending).
+    """
+    def __init__(self, inbox, render, interval=RENDER_INTERVAL_SECONDS, min_rows=RENDER_MIN_ROWS,
+                 clock=time.monotonic):
+        self._inbox = inbox if callable(inbox) else (lambda: inbox)
+        self.render = render
+        self.interval = interval
+        self.min_rows = min_rows
+        self.clock = clock
+        self.renders = 0
+        # The page already shows the inbox as it was when the cycle started
+        self._remember(self.inbox)
+
+    @property
+    def inbox(self):
+        return self._inbox()
+
+    @property
+    def pending(self):
+        inbox = self.inbox
+        return inbox is not self._drawn_inbox or inbox.version != self._drawn_version
+
+    def notify(self):
+        if not self.pending:
+            return False
+        inbox = self.inbox
+        due = inbox is not self._drawn_inbox or (self.clock() - self._drawn_at) >= self.interval
+        if not due and self.min_rows > 0:
+            due = (len(inbox) - self._drawn_len) >= self.min_rows
+        if due:
+            self._draw()
+        return due
+
+    def flush(self):
+        if self.pending:
+            self._draw()
+            return True
+        return False
+
+    def _remember(self, inbox):
+        self._drawn_inbox = inbox
+        self._drawn_version = inbox.version
+        self._drawn_len = len(inbox)
+        self._drawn_at = self.clock()
+
+    def _draw(self):
+        self.render()
+        self.renders += 1
+        self._remember(self.inbox)
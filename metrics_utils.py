@@ -0,0 +1,240 @@
+import os
+import time
+import bisect
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- CONFIG ---
+# Serve the Prometheus text format on http://<host>:METRICS_PORT/metrics (0 disables)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Also write it to this file after every scan cycle (textfile collector); empty disables
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+# Upper bounds (seconds) of the stage duration histogram buckets
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PREFIX = "neuromail"
+
+# Stages timed across the pipeline (labels of neuromail_stage_seconds). Stages nest:
+# "inference" is a whole classifier call and includes its "tokenize" and "forward"
+STAGES = (
+    "token_refresh", "imap_connect", "imap_search", "imap_fetch", "imap_store",
+    "parse", "tokenize", "forward", "inference", "save_history", "scan_cycle", "ui_render",
+)
+
+class _StageStats:
+    __slots__ = ("count", "total", "max", "last", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.buckets = [0] * len(STAGE_BUCKETS)
+
+class Metrics:
+    """
+    Process-wide stage timings (count/sum/max/histogram per stage and label set)
+    and monotonically increasing counters. Thread-safe; scanner threads, the
+    parse pool driver and Streamlit sessions all record into one instance.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}     # (stage, labels) -> _StageStats
+        self._counters = {}   # (name, labels) -> value
+        self._help = {}
+        self._collectors = []
+        self.started_at = time.time()
+
+    def observe(self, stage, seconds, **labels):
+        key = (stage, tuple(sorted(labels.items())))
+        with self._lock:
+            stats = self._stages.get(key)
+            if stats is None:
+                stats = self._stages[key] = _StageStats()
+            stats.count += 1
+            stats.total += seconds
+            stats.last = seconds
+            if seconds > stats.max:
+                stats.max = seconds
+            pos = bisect.bisect_left(STAGE_BUCKETS, seconds)
+            if pos < len(stats.buckets):
+                stats.buckets[pos] += 1
+
+    @contextlib.contextmanager
+    def timed(self, stage, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, **labels)
+
+    def inc(self, name, value=1, help=None, **labels):
+        if not value:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            if help and name not in self._help:
+                self._help[name] = help
+
+    def register_collector(self, collect):
+        """`collect()` returns extra [(name, type, help, value)] samples at export time."""
+        with self._lock:
+            if collect not in self._collectors:
+                self._collectors.append(collect)
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+            self.started_at = time.time()
+
+    def snapshot(self):
+        """Plain dicts for the diagnostics panel: stage rows and counter values."""
+        with self._lock:
+            stages = [
+                {
+                    "stage": stage + "".join(f" {k}={v}" for k, v in labels),
+                    "count": stats.count,
+                    "total_s": round(stats.total, 3),
+                    "avg_ms": round(stats.total / stats.count * 1000, 2) if stats.count else 0.0,
+                    "max_ms": round(stats.max * 1000, 2),
+                    "last_ms": round(stats.last * 1000, 2),
+                }
+                for (stage, labels), stats in sorted(self._stages.items())
+            ]
+            counters = {
+                name + "".join(f" {k}={v}" for k, v in labels): value
+                for (name, labels), value in sorted(self._counters.items())
+            }
+            collectors = list(self._collectors)
+        for collect in collectors:
+            for name, _, _, value in collect():
+                counters[name] = value
+        return {"stages": stages, "counters": counters}
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        with self._lock:
+            stages = sorted((k, (s.count, s.total, s.max, list(s.buckets))) for k, s in self._stages.items())
+            counters = sorted(self._counters.items())
+            help_text = dict(self._help)
+            collectors = list(self._collectors)
+
+        name = f"{PREFIX}_stage_seconds"
+        lines.append(f"# HELP {name} Time spent per pipeline stage.")
+        lines.append(f"# TYPE {name} histogram")
+        for (stage, labels), (count, total, _, buckets) in stages:
+            base = _labels((("stage", stage),) + labels)
+            cumulative = 0
+            for bound, n in zip(STAGE_BUCKETS, buckets):
+                cumulative += n
+                lines.append(f"{name}_bucket{_labels((('stage', stage),) + labels + (('le', _num(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels((('stage', stage),) + labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{base} {_num(total)}")
+            lines.append(f"{name}_count{base} {count}")
+
+        name = f"{PREFIX}_stage_max_seconds"
+        lines.append(f"# HELP {name} Slowest single run of each stage since start.")
+        lines.append(f"# TYPE {name} gauge")
+        for (stage, labels), (_, _, slowest, _) in stages:
+            lines.append(f"{name}{_labels((('stage', stage),) + labels)} {_num(slowest)}")
+
+        seen = set()
+        for (counter, labels), value in counters:
+            metric = f"{PREFIX}_{counter}"
+            if counter not in seen:
+                seen.add(counter)
+                lines.append(f"# HELP {metric} {help_text.get(counter, counter.replace('_', ' '))}")
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_labels(labels)} {_num(value)}")
+
+        for collect in collectors:
+            for sample, kind, description, value in collect():
+                metric = f"{PREFIX}_{sample}"
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} {kind}")
+                lines.append(f"{metric} {_num(value)}")
+
+        metric = f"{PREFIX}_process_start_time_seconds"
+        lines.append(f"# HELP {metric} When metrics collection started (unix time).")
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {_num(self.started_at)}")
+        return "\n".join(lines) + "\n"
+
+def _num(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    escaped = (
+        f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for k, v in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+METRICS = Metrics()
+
+# Module-level shortcuts for the process-wide registry
+observe = METRICS.observe
+timed = METRICS.timed
+inc = METRICS.inc
+register_collector = METRICS.register_collector
+snapshot = METRICS.snapshot
+render_prometheus = METRICS.render_prometheus
+
+# --- EXPORT ---
+def write_prometheus_file(path=None):
+    """Write the text format to METRICS_FILE (atomically, for node_exporter's textfile collector)."""
+    path = path or METRICS_FILE
+    if not path:
+        return None
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(render_prometheus())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not write metrics to {path}: {e}")
+        return None
+    return path
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+_SERVER = None
+_SERVER_LOCK = threading.Lock()
+
+def start_metrics_server(port=None, host=None):
+    """Serve /metrics on a daemon thread (once per process); None when disabled or the port is taken."""
+    global _SERVER
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    with _SERVER_LOCK:
+        if _SERVER is None:
+            try:
+                _SERVER = ThreadingHTTPServer((host or METRICS_HOST, port), _MetricsHandler)
+            except OSError as e:
+                print(f"Metrics endpoint not started on port {port}: {e}")
+                return None
+            threading.Thread(target=_SERVER.serve_forever, name="metrics-http", daemon=True).start()
+        return _SERVER
@@ -0,0 +1,467 @@
+import os
+import threading
+import time
+import download_utils
+import metrics_utils
+# transformers (and torch through it) and joblib are imported where a model is
+# built: they take seconds to import and the login page must not wait for them
+
+# --- CONFIG ---
+# Default model directory (for HF zip/unzip artifact)
+# Point to the distilled model by default; override via env as needed
+MODEL_DIR = os.getenv("MODEL_DIR", "./final_transformer_model")
+ASSET_URL = os.getenv(
+    "MODEL_ASSET_URL",
+    "https://github.com/PerseusJ/NeuroMail/releases/download/v1.0/email_model_transformer.zip"
+)
+# Expected SHA-256 of the release zip; empty skips the check with a warning that prints
+# the downloaded digest to pin here (the hash still names the version)
+ASSET_SHA256 = os.getenv("MODEL_ASSET_SHA256", "")
+LEGACY_MODEL_PATH = "email_model.pkl"
+# Inference backend for the HF model:
+#   "torch"      fp32 PyTorch pipeline (reference)
+#   "torch-int8" dynamic int8 quantization of the Linear layers (torch.ao.quantization)
+#   "onnx"       ONNX Runtime with all graph optimizations; the exported graph is
+#                cached in ONNX_MODEL_DIR and re-exported when MODEL_DIR changes
+# Every backend returns the same [{"label", "score"}, ...] per email. The accuracy
+# delta against "torch" has not been measured on the NeuroMail model yet. onnx runs
+# the same fp32 math and should only differ by rounding; torch-int8 moves scores
+# and can flip borderline labels. Measure it (label agreement, largest score
+# difference via backend_agreement()) before switching:
+#   python benchmark.py --stages corpus --compare-backends torch-int8,onnx
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "torch").lower()
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", MODEL_DIR.rstrip("/\\") + "_onnx")
+MAX_LENGTH = 512
+# Most emails per classifier forward pass during a scan cycle...
+INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", "64"))
+# ...and most padded tokens per pass (batch size x longest input in the batch)
+INFERENCE_BATCH_TOKENS = int(os.getenv("INFERENCE_BATCH_TOKENS", "8192"))
+# Inputs are cut to this many characters before tokenization, which still does the
+# real truncation. Prose averages 4-6 characters per token and URLs or long words
+# split into subword pieces of a few characters, so 20 per token leaves wide margin
+MAX_INPUT_CHARS = int(os.getenv("MAX_INPUT_CHARS", str(MAX_LENGTH * 20)))
+# Token length buckets: a batch only pads up to its bucket's bound
+LENGTH_BUCKETS = (32, 64, 128, 256, MAX_LENGTH)
+DEFAULT_LABEL_MAP = {0: "Low", 1: "Medium", 2: "High"}
+
+# --- MODEL ARTIFACT FETCHER ---
+def resolve_model_dir():
+    """
+    The directory holding the HF model, or None. A config.json directly in MODEL_DIR
+    (a hand-placed model or the old flat layout) wins over the downloaded versions.
+    """
+    if os.path.exists(os.path.join(MODEL_DIR, "config.json")):
+        return MODEL_DIR
+    version_dir = download_utils.current_version_dir(MODEL_DIR)
+    if version_dir and os.path.exists(os.path.join(version_dir, "config.json")):
+        return version_dir
+    return None
+
+def model_download_progress():
+    """Progress of the release asset fetch (state, downloaded, total, fraction, error)."""
+    return download_utils.get_download_progress(ASSET_URL).snapshot()
+
+def ensure_model_present():
+    """
+    Ensure the HF model is available, downloading the release asset if missing, and
+    return its directory (None if the download failed; the next call resumes it).
+    Honors MODEL_DIR, MODEL_ASSET_SHA256 and optional GITHUB_TOKEN (for private releases).
+    """
+    model_dir = resolve_model_dir()
+    if model_dir:
+        return model_dir
+
+    token = os.getenv("GITHUB_TOKEN")
+    headers = {"Authorization": f"Bearer {token}"} if token else None
+    try:
+        return download_utils.fetch_artifact(
+            ASSET_URL, MODEL_DIR, sha256=ASSET_SHA256, headers=headers, required_file="config.json",
+        )
+    except download_utils.DownloadError as e:
+        print(f"Model download failed: {e}")
+        return None
+
+# --- PREDICTION HELPERS ---
+def normalize_priority_label(priority_label):
+    if priority_label == '0': return "Low"
+    if priority_label == '1': return "Medium"
+    if priority_label == '2': return "High"
+    return priority_label
+
+def _top_prediction(results):
+    # Hugging Face pipeline returns list of dicts per input
+    results = sorted(results, key=lambda x: x.get("score", 0), reverse=True)
+    top = results[0] if results else {}
+    return top.get("label", "Unknown"), top.get("score", 0.0)
+
+def _predict_one_pkl(model, full_input):
+    try:
+        pred = model.predict([full_input])[0]
+        prob = max(model.predict_proba([full_input])[0])
+    except:
+        pred = "Unknown"
+        prob = 0.0
+    return pred, prob
+
+def _model_identity(kind, backend, source):
+    # Changes whenever the artifact on disk or the backend changes (cache keys use it)
+    marker = os.path.join(source, "config.json") if os.path.isdir(source) else source
+    try: mtime = int(os.path.getmtime(marker))
+    except OSError: mtime = 0
+    return f"{kind}:{backend}:{os.path.abspath(source)}:{mtime}"
+
+# --- LENGTH-BUCKETED BATCHING ---
+def truncate_input(text):
+    """Cut at MAX_INPUT_CHARS so a huge body is never tokenized in full just to be truncated."""
+    return text[:MAX_INPUT_CHARS] if len(text) > MAX_INPUT_CHARS else text
+
+def estimate_tokens(text):
+    # ~4 characters per word piece for mail text; only used to group similar lengths
+    return min(MAX_LENGTH, len(text) // 4 + 2)
+
+def plan_batches(texts, max_batch_size=None, max_batch_tokens=None):
+    """
+    Group input indexes into batches of similar length: each text goes to the first
+    LENGTH_BUCKETS bound >= its estimated token count, and a bucket is cut into
+    batches of at most `max_batch_size` inputs and `max_batch_tokens` padded tokens.
+    Callers scatter results back by index, so the original order is preserved.
+    """
+    max_batch_size = max(1, max_batch_size or INFERENCE_BATCH_SIZE)
+    max_batch_tokens = max_batch_tokens or INFERENCE_BATCH_TOKENS
+    buckets = {}
+    for i, text in enumerate(texts):
+        est = estimate_tokens(text)
+        bound = next((b for b in LENGTH_BUCKETS if est <= b), LENGTH_BUCKETS[-1])
+        buckets.setdefault(bound, []).append((est, i))
+
+    batches = []
+    for bound in sorted(buckets, reverse=True):
+        members = sorted(buckets[bound], reverse=True)
+        # The longest member sets the padding, so size the batch from the bucket bound
+        per_batch = max(1, min(max_batch_size, max_batch_tokens // bound))
+        for j in range(0, len(members), per_batch):
+            batches.append([i for _, i in members[j:j + per_batch]])
+    return batches
+
+# --- SHARED MODEL HANDLE ---
+class ModelHandle:
+    """
+    A loaded classifier shared read-only by every session in the process.
+    Inference goes through `lock`, so concurrent sessions take turns instead of
+    oversubscribing the CPU threads of one model.
+    """
+    def __init__(self, model, kind, source, label_map=None, load_seconds=0.0, backend=None):
+        self.model = model
+        self.kind = kind  # "hf_pipeline" or "pkl"
+        self.backend = backend or kind
+        self.source = source
+        self.label_map = label_map or dict(DEFAULT_LABEL_MAP)
+        self.load_seconds = load_seconds
+        self.lock = threading.Lock()
+        self.identity = _model_identity(kind, self.backend, source)
+
+    def parameter_bytes(self):
+        """Size of the model weights, or None when it can't be measured (pickles)."""
+        if getattr(self.model, "weights_bytes", None) is not None:
+            return self.model.weights_bytes
+        net = getattr(self.model, "model", None)
+        if net is None or not hasattr(net, "state_dict"):
+            return None
+        # state_dict rather than parameters(): quantized Linear weights are packed buffers
+        return _tensor_bytes(list(net.state_dict().values()))
+
+    def _classify_hf(self, texts, batch_size):
+        outputs = [None] * len(texts)
+        for indexes in plan_batches(texts, batch_size, INFERENCE_BATCH_TOKENS):
+            batch = [texts[i] for i in indexes]
+            try:
+                results = [_top_prediction(r) for r in self.model(batch, batch_size=len(batch))]
+            except Exception as e:
+                # One bad input should not sink the whole batch; retry one by one
+                print(f"Batch inference failed, retrying per email: {e}")
+                results = []
+                for text in batch:
+                    try: results.append(_top_prediction(self.model(text)[0]))
+                    except Exception as e_one:
+                        print(f"Error classifying email: {e_one}")
+                        results.append(None)
+            for i, result in zip(indexes, results):
+                outputs[i] = result
+        return outputs
+
+    def classify(self, texts, batch_size=None):
+        """
+        Classify many inputs at once and return one (label, confidence) per text, in order.
+        An entry is None if that single text could not be classified (the caller skips it,
+        exactly like a failed email in the old per-email loop).
+        """
+        if not texts:
+            return []
+        batch_size = batch_size or INFERENCE_BATCH_SIZE
+        model = self.model
+        metrics_utils.inc("model_inputs_total", len(texts), help="Texts run through the classifier (cache misses).")
+
+        # The whole call: tokenization and the forward pass are also timed on their own
+        with self.lock, metrics_utils.timed("inference"):
+            if self.kind == "hf_pipeline":
+                outputs = self._classify_hf([truncate_input(t) for t in texts], batch_size)
+            else:
+                try:
+                    preds = model.predict(list(texts))
+                    probs = [max(p) for p in model.predict_proba(list(texts))]
+                    pairs = list(zip(preds, probs))
+                except:
+                    pairs = [_predict_one_pkl(model, text) for text in texts]
+
+                outputs = []
+                for pred, prob in pairs:
+                    if isinstance(pred, int):
+                        outputs.append((self.label_map.get(pred, "Unknown"), prob))
+                    else:
+                        outputs.append((str(pred), prob))
+
+        return [
+            (normalize_priority_label(o[0]), o[1]) if o is not None else None
+            for o in outputs
+        ]
+
+def _tensor_bytes(values):
+    total = 0
+    for value in values:
+        if isinstance(value, (tuple, list)):
+            total += _tensor_bytes(value)
+        elif hasattr(value, "numel") and hasattr(value, "element_size"):
+            total += value.numel() * value.element_size()
+    return total
+
+# --- INFERENCE BACKENDS ---
+class OnnxTextClassifier:
+    """
+    Drop-in for the HF text-classification pipeline (top_k=None) backed by an
+    ONNX Runtime session: same call forms, same [{"label", "score"}, ...] output.
+    """
+    def __init__(self, session, tokenizer, id2label, weights_bytes=None):
+        self.session = session
+        self.tokenizer = tokenizer
+        self.id2label = id2label
+        self.weights_bytes = weights_bytes
+        self.input_names = {i.name for i in session.get_inputs()}
+
+    def _run(self, texts):
+        import numpy as np
+        with metrics_utils.timed("tokenize"):
+            enc = self.tokenizer(texts, truncation=True, max_length=MAX_LENGTH, padding=True, return_tensors="np")
+        feeds = {k: v.astype(np.int64) for k, v in enc.items() if k in self.input_names}
+        with metrics_utils.timed("forward"):
+            logits = self.session.run(None, feeds)[0]
+        logits = logits - logits.max(axis=-1, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=-1, keepdims=True)
+        out = []
+        for row in probs:
+            scores = [{"label": self.id2label.get(i, str(i)), "score": float(p)} for i, p in enumerate(row)]
+            out.append(sorted(scores, key=lambda x: x["score"], reverse=True))
+        return out
+
+    def __call__(self, inputs, batch_size=None, **kwargs):
+        if isinstance(inputs, str):
+            # Same quirk as the HF pipeline: a single string comes back wrapped in a list
+            return [self._run([inputs])[0]]
+        inputs = list(inputs)
+        batch_size = batch_size or len(inputs) or 1
+        results = []
+        for i in range(0, len(inputs), batch_size):
+            results.extend(self._run(inputs[i:i + batch_size]))
+        return results
+
+def _export_onnx(hf_model, tokenizer, onnx_path):
+    import torch
+    os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+    sample = tokenizer(["NeuroMail export sample"], return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask") if n in sample]
+    dynamic_axes = {n: {0: "batch", 1: "sequence"} for n in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+    # Export to a temp file and rename, so a crash never leaves a truncated graph cached
+    tmp_path = f"{onnx_path}.tmp"
+    # The TorchScript exporter: it takes dynamic_axes as is, while the dynamo exporter
+    # (the default since torch 2.9) also needs onnxscript installed
+    with torch.no_grad():
+        torch.onnx.export(
+            hf_model, tuple(sample[n] for n in input_names), tmp_path,
+            input_names=input_names, output_names=["logits"],
+            dynamic_axes=dynamic_axes, opset_version=17, dynamo=False,
+        )
+    os.replace(tmp_path, onnx_path)
+
+def _build_onnx_classifier(hf_model, tokenizer, model_dir):
+    import onnxruntime as ort
+    onnx_path = os.path.join(ONNX_MODEL_DIR, "model.onnx")
+    config_path = os.path.join(model_dir, "config.json")
+    if not os.path.exists(onnx_path) or os.path.getmtime(onnx_path) < os.path.getmtime(config_path):
+        print(f"Exporting ONNX graph to {onnx_path}")
+        _export_onnx(hf_model, tokenizer, onnx_path)
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+    return OnnxTextClassifier(session, tokenizer, dict(hf_model.config.id2label), os.path.getsize(onnx_path))
+
+def _build_hf_classifier(backend, model_dir):
+    """Return (classifier, backend actually used) for the HF model in `model_dir`."""
+    from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    hf_model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+
+    if backend == "onnx":
+        try:
+            return _build_onnx_classifier(hf_model, tokenizer, model_dir), "onnx"
+        except Exception as e:
+            print(f"ONNX backend unavailable ({e}), using torch")
+            backend = "torch"
+
+    if backend == "torch-int8":
+        import torch
+        hf_model = torch.ao.quantization.quantize_dynamic(hf_model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend != "torch":
+        print(f"Unknown MODEL_BACKEND '{backend}', using torch")
+        backend = "torch"
+
+    # Ensure input fits the model by truncating; max_length=512 is standard for DistilBERT
+    clf = pipeline("text-classification", model=hf_model, tokenizer=tokenizer, top_k=None, truncation=True, max_length=MAX_LENGTH)
+    # The pipeline tokenizes each input in preprocess() and runs the model in _forward();
+    # time them apart
+    preprocess, forward = clf.preprocess, clf._forward
+    def timed_preprocess(*args, **kwargs):
+        with metrics_utils.timed("tokenize"):
+            return preprocess(*args, **kwargs)
+    def timed_forward(*args, **kwargs):
+        with metrics_utils.timed("forward"):
+            return forward(*args, **kwargs)
+    clf.preprocess, clf._forward = timed_preprocess, timed_forward
+    return clf, backend
+
+def backend_agreement(reference, candidate, texts, batch_size=None):
+    """
+    Compare two ModelHandles on the same texts: label agreement rate and the
+    largest confidence difference. Use it to measure a backend's accuracy delta.
+    """
+    ref = reference.classify(texts, batch_size)
+    cand = candidate.classify(texts, batch_size)
+    pairs = [(r, c) for r, c in zip(ref, cand) if r is not None and c is not None]
+    if not pairs:
+        return {"n": 0, "label_agreement": None, "max_score_delta": None}
+    return {
+        "n": len(pairs),
+        "label_agreement": sum(r[0] == c[0] for r, c in pairs) / len(pairs),
+        "max_score_delta": max(abs(float(r[1]) - float(c[1])) for r, c in pairs),
+    }
+
+def load_model(backend=None):
+    """
+    Load the classifier and wrap it in a ModelHandle (None if no model is available).
+    Priority: HF directory (MODEL_DIR), then local email_model.pkl for backward compat.
+    `backend` overrides MODEL_BACKEND for the HF model.
+    """
+    started = time.perf_counter()
+
+    # Ensure model artifacts are present (fetch + verify + extract if missing)
+    model_dir = ensure_model_present()
+
+    # 1) Try Hugging Face directory
+    if model_dir:
+        clf, used_backend = _build_hf_classifier(backend or MODEL_BACKEND, model_dir)
+        return ModelHandle(clf, "hf_pipeline", model_dir, load_seconds=time.perf_counter() - started, backend=used_backend)
+
+    # 2) Fallback: legacy sklearn pickle
+    if os.path.exists(LEGACY_MODEL_PATH):
+        import joblib
+        model = joblib.load(LEGACY_MODEL_PATH)
+        return ModelHandle(model, "pkl", LEGACY_MODEL_PATH, load_seconds=time.perf_counter() - started)
+
+    return None
+
+# --- BACKGROUND WARM-UP ---
+# Seconds before a warm-up that found no model (or failed) is attempted again
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "30"))
+
+class ModelWarmup:
+    """
+    Loads the shared model on a daemon thread so pages render while it downloads,
+    imports transformers/torch and builds the classifier. `state` is one of
+    "loading", "ready", "missing" (no model available) or "failed".
+    """
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.state = "loading"
+        self.handle = None
+        self.error = None
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self._thread = threading.Thread(target=self._run, name="model-warmup", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self.handle = load_model(self.backend)
+            self.state = "ready" if self.handle is not None else "missing"
+        except Exception as e:
+            print(f"Model warm-up failed: {e}")
+            self.error = str(e)
+            self.state = "failed"
+        self.finished_at = time.monotonic()
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return self.handle
+
+_WARMUP = None
+_WARMUP_LOCK = threading.Lock()
+
+def start_model_warmup(backend=None):
+    """
+    Start loading the process-wide model in the background (once) and return the
+    ModelWarmup; callers read `.handle`, which stays None until it is ready.
+    """
+    global _WARMUP
+    with _WARMUP_LOCK:
+        warmup = _WARMUP
+        retry = (
+            warmup is not None and warmup.done and not warmup.ready
+            and time.monotonic() - warmup.finished_at >= WARMUP_RETRY_SECONDS
+        )
+        if warmup is None or retry:
+            warmup = _WARMUP = ModelWarmup(backend)
+        return warmup
+
+# --- PROCESS STATS ---
+def process_rss_bytes():
+    """Current resident set size of this process (peak RSS where /proc is unavailable)."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+    except Exception:
+        return None
+
+def format_bytes(num):
+    if num is None: return "n/a"
+    for unit in ("B", "KB", "MB", "GB"):
+        if num < 1024 or unit == "GB":
+            return f"{num:.0f} {unit}" if unit == "B" else f"{num:.1f} {unit}"
+        num /= 1024
@@ -0,0 +1,291 @@
+import os
+import re
+import email
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email.header import decode_header
+from html.parser import HTMLParser
+
+# --- CONFIG ---
+# MIME parsing / text extraction processes. 0 parses in the calling thread; "auto"
+# uses every core. Small batches are parsed in-process (pool overhead > gain).
+_workers = os.getenv("PARSE_WORKERS", "auto").lower()
+PARSE_WORKERS = (os.cpu_count() or 1) if _workers == "auto" else int(_workers)
+PARSE_POOL_MIN_BATCH = int(os.getenv("PARSE_POOL_MIN_BATCH", "16"))
+# Messages handed to a worker process per task
+PARSE_CHUNKSIZE = int(os.getenv("PARSE_CHUNKSIZE", "8"))
+# Characters of HTML-derived text kept for the model: 20 per model_utils.MAX_LENGTH
+# (512) token, as model_utils.MAX_INPUT_CHARS, so truncation still happens in the tokenizer
+MODEL_TEXT_CHARS = int(os.getenv("MODEL_TEXT_CHARS", str(512 * 20)))
+
+# Quotes are dropped from model input (training format); whitespace runs become one space
+_CLEAN_TABLE = str.maketrans({'"': None, "'": None})
+
+def clean_text(text):
+    if text is None: return ""
+    if isinstance(text, bytes): text = text.decode(errors='ignore')
+    return " ".join(str(text).translate(_CLEAN_TABLE).split())
+
+# --- HTML TO TEXT ---
+# Elements whose content is never visible text
+_SKIP_TAGS = {"script", "style", "head", "title", "noscript", "template", "svg", "math", "object", "iframe"}
+# Elements that separate words even without whitespace around them
+_BREAK_TAGS = {
+    "br", "p", "div", "li", "ul", "ol", "tr", "td", "th", "table", "thead", "tbody", "tfoot",
+    "h1", "h2", "h3", "h4", "h5", "h6", "hr", "blockquote", "pre", "section", "article",
+    "header", "footer", "nav", "aside", "center", "dd", "dt", "dl", "address", "img",
+}
+# Skipped elements that cannot hold page content: a block-level tag inside one means
+# it was never closed, so skipping ends there
+_NO_FLOW_SKIP_TAGS = {"head", "title"}
+# Opening <body> or closing </body>/</html> ends every skip scope
+_DOCUMENT_TAGS = {"body", "html"}
+_HTML_FEED_CHUNK = 8192
+
+class _HTMLTextExtractor(HTMLParser):
+    """Visible text of an HTML body, clean_text-normalized, collected up to `limit` chars."""
+    def __init__(self, limit):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+        self.skip = []  # open skip elements, innermost last
+        self.space = False
+        self.done = False
+
+    def _end_unclosed(self):
+        while self.skip and self.skip[-1] in _NO_FLOW_SKIP_TAGS:
+            self.skip.pop()
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self.skip.append(tag)
+        elif tag == "body":
+            self.skip.clear()
+        elif tag in _BREAK_TAGS:
+            self._end_unclosed()
+            self.space = True
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in _BREAK_TAGS:
+            self._end_unclosed()
+            self.space = True
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            if tag in self.skip:
+                # Also ends anything left open inside it
+                del self.skip[len(self.skip) - 1 - self.skip[::-1].index(tag):]
+        elif tag in _DOCUMENT_TAGS:
+            self.skip.clear()
+        elif tag in _BREAK_TAGS:
+            self._end_unclosed()
+            self.space = True
+
+    def handle_data(self, data):
+        if self.skip or self.done or not data:
+            return
+        if data[0].isspace():
+            self.space = True
+        for word in data.translate(_CLEAN_TABLE).split():
+            if self.parts and self.space:
+                self.parts.append(" ")
+                self.size += 1
+            self.parts.append(word)
+            self.size += len(word)
+            self.space = True
+        self.space = data[-1].isspace()
+        if self.size >= self.limit:
+            self.done = True
+
+    def close(self):
+        # An unclosed <script>/<style> leaves the rest of the document unparsed in
+        # rawdata (CDATA mode); read it as markup instead of dropping it
+        while self.cdata_elem and self.rawdata and not self.done:
+            rest, self.rawdata = self.rawdata, ""
+            if self.skip and self.skip[-1] == self.cdata_elem:
+                self.skip.pop()
+            self.clear_cdata_mode()
+            self.feed(rest)
+        super().close()
+
+    def text(self):
+        return "".join(self.parts)[:self.limit].rstrip()
+
+def html_to_text(html, limit=None):
+    """
+    One pass over `html` with html.parser: drops script/style/head content, decodes
+    entities, normalizes whitespace like clean_text, and stops feeding the parser
+    once `limit` characters (MODEL_TEXT_CHARS) of text were collected. A stray
+    unclosed <title>/<head> ends at the next block-level tag, any skipped element at
+    </body>, and an unclosed <script>/<style> gives the rest back as markup.
+    """
+    if not html: return ""
+    limit = MODEL_TEXT_CHARS if limit is None else limit
+    parser = _HTMLTextExtractor(limit)
+    try:
+        for i in range(0, len(html), _HTML_FEED_CHUNK):
+            parser.feed(html[i:i + _HTML_FEED_CHUNK])
+            if parser.done:
+                break
+        else:
+            parser.close()
+    except Exception:
+        # Never lose the message over malformed markup: fall back to the tag-strip regex
+        return clean_text(re.sub('<[^<]+?>', '', html))[:limit]
+    return parser.text()
+
+def safe_decode_header(header_value):
+    if not header_value: return "No Subject"
+    try:
+        headers = decode_header(header_value)
+        parts = []
+        for content, encoding in headers:
+            if isinstance(content, bytes):
+                parts.append(content.decode(encoding or 'utf-8', errors='ignore'))
+            else:
+                parts.append(str(content))
+        return "".join(parts)
+    except: return str(header_value)
+
+def get_email_content(msg):
+    body_text = ""
+    body_html = ""
+    tokens = []
+    
+    if msg.is_multipart():
+        for part in msg.walk():
+            ctype = part.get_content_type()
+            
+            if ctype == "text/plain":
+                try: body_text = part.get_payload(decode=True).decode(errors='ignore')
+                except: pass
+            elif ctype == "text/html":
+                try: body_html = part.get_payload(decode=True).decode(errors='ignore')
+                except: pass
+                
+            if part.get_filename():
+                fname = part.get_filename().lower()
+                if ".pdf" in fname: tokens.append("PDF")
+                elif ".jpg" in fname or ".jpeg" in fname or ".png" in fname: tokens.append("IMG")
+                elif "invite" in fname: tokens.append("CALENDAR")
+    else:
+        # Not multipart, payload is body
+        try:
+            payload = msg.get_payload(decode=True).decode(errors='ignore')
+            if msg.get_content_type() == "text/html":
+                body_html = payload
+            else:
+                body_text = payload
+        except: pass
+        
+    return email_content_from_parts(body_text, body_html, tokens)
+
+def email_content_from_parts(body_text, body_html, tokens):
+    """Build the get_email_content tuple from already-extracted parts (also used by partial IMAP fetch)."""
+    # If we found HTML but no Text, use the visible HTML text for classification
+    # If we found Text but no HTML, simple.
+    
+    final_text_for_model = clean_text(body_text) if body_text else html_to_text(body_html)
+    
+    return final_text_for_model, body_text, body_html, tokens
+
+def parse_single_email(msg, e_id_int, content=None):
+    """
+    Extract everything the classifier and the table need from one message.
+    `content` is a ready get_email_content tuple when the body was fetched separately
+    (partial IMAP fetch); then `msg` only needs the headers.
+    """
+    sub = safe_decode_header(msg["Subject"])
+    snd_raw = msg.get("From", "")
+    snd = safe_decode_header(snd_raw).replace("<", "").replace(">", "")
+    
+    # Extract content (Text for Model, HTML for Display)
+    c_b_model, body_plain, body_html, toks = content if content is not None else get_email_content(msg)
+    
+    c_s, c_sub = clean_text(snd), clean_text(sub)
+    
+    # Deduplication removed per user request: show all emails even near-duplicates
+    # (previously used sender+subject+body signature)
+
+    return {
+        "sender": c_s,
+        "subject": c_sub,
+        "tokens": toks,
+        "body_model": c_b_model,
+        "body_plain": body_plain,
+        "body_html": body_html,
+        # Prediction — align with training input format (sender + subject + body)
+        "full_input": f"{c_s} {c_sub} {c_b_model}",
+        "id": e_id_int,
+    }
+
+def parse_fetched(e_id_int, raw_msg, parts=None):
+    """Raw RFC822 bytes (or, with partial fetch, the header plus (body_text, body_html, tokens))."""
+    msg = email.message_from_bytes(raw_msg)
+    content = email_content_from_parts(*parts) if parts is not None else None
+    return parse_single_email(msg, e_id_int, content=content)
+
+def _parse_fetched_task(item):
+    # Runs in a worker process: never raise, the failure is reported per message
+    e_id_int, raw_msg, parts = item
+    try:
+        return e_id_int, parse_fetched(e_id_int, raw_msg, parts), None
+    except Exception as e:
+        return e_id_int, None, str(e)
+
+# --- PROCESS POOL ---
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_parse_pool(workers=None):
+    """Process-wide pool. 'spawn' so workers never inherit model threads or sockets."""
+    global _POOL
+    workers = PARSE_WORKERS if workers is None else workers
+    if workers <= 1:
+        return None
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _POOL
+
+def shutdown_parse_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(cancel_futures=True)
+            _POOL = None
+
+def _map(func, items, workers):
+    pool = get_parse_pool(workers) if len(items) >= PARSE_POOL_MIN_BATCH else None
+    if pool is None:
+        return map(func, items)
+    # Lazy, in input order: callers can consume early results while later ones parse
+    return pool.map(func, items, chunksize=max(1, PARSE_CHUNKSIZE))
+
+def _iter_parse_results(fetched, workers):
+    fetched = list(fetched)
+    done = 0
+    try:
+        for result in _map(_parse_fetched_task, fetched, workers):
+            done += 1
+            yield result
+    except BrokenProcessPool as e:
+        # A worker died (OOM, killed): drop the pool and finish this batch in-process
+        print(f"Parse pool failed ({e}), parsing {len(fetched) - done} emails in-process")
+        shutdown_parse_pool()
+        for item in fetched[done:]:
+            yield _parse_fetched_task(item)
+
+def iter_parsed(fetched, workers=None):
+    """
+    Parse (uid, raw, parts) triples on the process pool; yields parsed dicts in
+    input order. Messages that fail to parse are logged and skipped.
+    """
+    for e_id_int, parsed, error in _iter_parse_results(fetched, workers):
+        if error is not None:
+            print(f"Error processing email {e_id_int}: {error}")
+            continue
+        yield parsed
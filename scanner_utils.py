@@ -0,0 +1,652 @@
+import os
+import time
+import queue
+import random
+import asyncio
+import imaplib
+import datetime
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import auth_utils
+import imap_utils
+import async_imap_utils
+import cache_utils
+import parse_utils
+import metrics_utils
+
+# --- CONFIG ---
+# Poll-mode interval between scan cycles while mail is arriving
+SCAN_POLL_SECONDS = float(os.getenv("SCAN_POLL_SECONDS", "5"))
+# Longest poll-mode interval; each cycle without new mail multiplies the interval
+# by SCAN_BACKOFF_FACTOR up to this
+SCAN_POLL_MAX_SECONDS = float(os.getenv("SCAN_POLL_MAX_SECONDS", "120"))
+SCAN_BACKOFF_FACTOR = float(os.getenv("SCAN_BACKOFF_FACTOR", "2"))
+# Every wait is randomized by +/- this fraction so sessions don't poll in lockstep
+SCAN_JITTER = float(os.getenv("SCAN_JITTER", "0.2"))
+# Longest wait before retrying after a connection error (same backoff factor)
+SCAN_RETRY_MAX_SECONDS = float(os.getenv("SCAN_RETRY_MAX_SECONDS", "300"))
+# "thread": one blocking imaplib worker per account; "asyncio": every account on one
+# event loop (multi-account mode, per-provider rate limits, shared classifier)
+SCANNER_BACKEND = os.getenv("SCANNER_BACKEND", "thread").lower()
+# Parsed messages per classify call while the parse pool works on the rest
+PARSE_CLASSIFY_CHUNK = int(os.getenv("PARSE_CLASSIFY_CHUNK", "64"))
+# A subscriber (browser session) that has not drained its events for this long is
+# dropped; if it comes back it gets a "resync" event and reloads from history
+SCAN_SUBSCRIBER_TTL_SECONDS = float(os.getenv("SCAN_SUBSCRIBER_TTL_SECONDS", "300"))
+
+# --- ROWS ---
+def build_row(parsed, priority_label, prob, blobs=None):
+    """The dashboard/history row for a parsed, classified email."""
+    if blobs is not None:
+        # Bodies go to the blob store; the row only keeps their references
+        bodies = {"BodyRef": blobs.put_text(parsed["body_plain"]), "HtmlRef": blobs.put_text(parsed["body_html"])}
+    else:
+        bodies = {"ContentFull": parsed["body_plain"], "ContentHtml": parsed["body_html"]}
+    return {
+        "Time": datetime.datetime.now().strftime("%H:%M:%S"),
+        "Priority": priority_label,
+        "Confidence": prob,
+        "Sender": parsed["sender"],
+        "Subject": parsed["subject"],
+        "Tokens": parsed["tokens"],
+        "Content": parsed["body_model"][:500], # Short snippet for legacy/debug
+        **bodies,                              # Full Plain Text / HTML (or their refs)
+        "ID": parsed["id"]
+    }
+
+def process_single_email(msg, model, e_id_int, blobs=None):
+    """The one-email-at-a-time path: parse, classify (batch of one), build the row."""
+    parsed = parse_utils.parse_single_email(msg, e_id_int)
+    prediction = cache_utils.classify_with_cache(model, [parsed["full_input"]], batch_size=1)[0]
+    if prediction is None:
+        return None
+    priority_label, prob = prediction
+    return build_row(parsed, priority_label, prob, blobs=blobs)
+
+def iter_parse_and_classify(model, fetched, chunk_size=None):
+    """
+    fetched: (uid, raw, parts) triples -> yields (parsed dicts, predictions) per
+    chunk. The pool keeps parsing while each chunk of results goes through the
+    model (batched forward passes, memoized by the classification cache).
+    """
+    chunk_size = chunk_size or PARSE_CLASSIFY_CHUNK
+    pending = []
+    # "parse" is the time spent waiting on the pool, i.e. what parsing adds to the cycle
+    results = parse_utils.iter_parsed(fetched)
+    while True:
+        started = time.perf_counter()
+        parsed = next(results, None)
+        if parsed is None:
+            break
+        metrics_utils.observe("parse", time.perf_counter() - started)
+        pending.append(parsed)
+        if len(pending) >= chunk_size:
+            yield pending, cache_utils.classify_with_cache(model, [p["full_input"] for p in pending])
+            pending = []
+    if pending:
+        yield pending, cache_utils.classify_with_cache(model, [p["full_input"] for p in pending])
+
+def parse_and_classify(model, fetched, chunk_size=None):
+    """All of iter_parse_and_classify at once: (parsed dicts, predictions)."""
+    parsed_batch, predictions = [], []
+    for parsed, predicted in iter_parse_and_classify(model, fetched, chunk_size):
+        parsed_batch.extend(parsed)
+        predictions.extend(predicted)
+    return parsed_batch, predictions
+
+# --- SCHEDULING ---
+# Network-level failures worth retrying; auth and protocol errors (IMAP4.error) stay fatal
+TRANSIENT_ERRORS = (imaplib.IMAP4.abort, OSError, EOFError, asyncio.TimeoutError)
+
+def is_transient_error(e):
+    return isinstance(e, TRANSIENT_ERRORS)
+
+class PollScheduler:
+    """
+    How long to wait before the next scan. Poll mode starts at `base` seconds, goes
+    back to it as soon as a cycle finds new mail and backs off by `factor` per quiet
+    cycle up to `max_seconds`. Connection errors back off separately (base, base*factor,
+    ... up to `retry_max_seconds`) until a cycle succeeds. All waits get +/- `jitter`.
+    """
+    def __init__(self, base=SCAN_POLL_SECONDS, max_seconds=SCAN_POLL_MAX_SECONDS,
+                 factor=SCAN_BACKOFF_FACTOR, jitter=SCAN_JITTER, retry_max_seconds=SCAN_RETRY_MAX_SECONDS):
+        self.base = max(0.1, base)
+        self.max_seconds = max(self.base, max_seconds)
+        self.factor = max(1.0, factor)
+        self.jitter = min(max(0.0, jitter), 1.0)
+        self.retry_max_seconds = max(self.base, retry_max_seconds)
+        self.interval = self.base
+        self.failures = 0
+
+    def _jittered(self, seconds):
+        return seconds * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+
+    def succeeded(self):
+        """A cycle went through: the next error starts the retry backoff from `base` again."""
+        self.failures = 0
+
+    def after_cycle(self, new_messages):
+        """Seconds until the next poll after a successful cycle that found `new_messages`."""
+        self.succeeded()
+        if new_messages:
+            self.interval = self.base
+        else:
+            self.interval = min(self.max_seconds, self.interval * self.factor)
+        return self._jittered(self.interval)
+
+    def after_error(self):
+        """Seconds until the retry after a transient error."""
+        self.failures += 1
+        delay = min(self.retry_max_seconds, self.base * self.factor ** (self.failures - 1))
+        return self._jittered(delay)
+
+# kind: "status" (text), "rows" (list of rows, already persisted), "cycle" (datetime
+# of a completed cycle), "error" (text; the worker stops), "stopped" (None),
+# "resync" (None; events were missed, reload the rows from history)
+ScanEvent = namedtuple("ScanEvent", ["kind", "payload"])
+
+class ScanEventFanout:
+    """
+    One event queue per subscriber (a Streamlit session), so every tab open on an
+    account sees every row, status and error instead of splitting them. Subscribers
+    that stop draining (closed tabs) are dropped after SCAN_SUBSCRIBER_TTL_SECONDS.
+    """
+    def __init__(self, ttl_seconds=SCAN_SUBSCRIBER_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._subscribers = {}  # subscriber -> [queue, last drain (monotonic)]
+
+    def subscribe(self, subscriber, *initial):
+        """Start queueing events for `subscriber` (seeded with `initial`); False if it already was."""
+        with self._lock:
+            if subscriber in self._subscribers:
+                return False
+            events = queue.Queue()
+            for event in initial:
+                events.put(event)
+            self._subscribers[subscriber] = [events, time.monotonic()]
+            return True
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+
+    def publish(self, event):
+        now = time.monotonic()
+        with self._lock:
+            for subscriber, entry in list(self._subscribers.items()):
+                if now - entry[1] > self.ttl_seconds:
+                    del self._subscribers[subscriber]
+                else:
+                    entry[0].put(event)
+
+    def drain(self, subscriber):
+        """Events queued for `subscriber` (never blocks), or None if it is not subscribed."""
+        with self._lock:
+            entry = self._subscribers.get(subscriber)
+            if entry is None:
+                return None
+            entry[1] = time.monotonic()
+        events = []
+        while True:
+            try:
+                events.append(entry[0].get_nowait())
+            except queue.Empty:
+                return events
+
+class ScannerWorker:
+    """
+    Scans one account in a daemon thread: fetch, parse, classify, mark read and
+    persist, independent of any Streamlit script run. Results are published as
+    ScanEvents to every subscribed session's queue, which the UI drains on rerun, so
+    scanning keeps going while the browser tab is idle or the user is clicking around.
+
+    Messages are parsed on the parse_utils process pool and classified in chunks as
+    they come back, so MIME parsing of later messages overlaps with inference.
+    `build_row(parsed, label, prob)` makes the dashboard row (normally a wrapper of build_row).
+    """
+    def __init__(self, server, user, token_data, model, build_row, history_store,
+                 sync_path, limit, push=True, poll_seconds=SCAN_POLL_SECONDS):
+        self.server = server
+        self.user = user
+        self.token_data = token_data
+        self.model = model
+        self.build_row = build_row
+        self.history_store = history_store
+        self.sync_path = sync_path
+        self.limit = limit
+        self.push = push
+        self.poll_seconds = poll_seconds
+        self.scheduler = PollScheduler(base=poll_seconds)
+        self.status = "Idle"
+        self.last_scan_time = None
+        self.fanout = ScanEventFanout()
+        self._previous = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"scanner-{user}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def is_alive(self):
+        return self._thread.is_alive() and not self._stop.is_set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def follow(self, previous):
+        """
+        Take over from `previous` (stopped, possibly mid-cycle): keep its subscribers
+        and their undrained events, and start scanning only once it has finished.
+        Call before start().
+        """
+        self.fanout = previous.fanout
+        self._previous = previous
+
+    def _await_previous(self):
+        # The previous worker may still be writing sync state and history, or be
+        # about to stop the account's IDLE watcher
+        previous, self._previous = self._previous, None
+        return previous
+
+    def subscribe(self, subscriber):
+        """Deliver events to `subscriber` from now on (starting with the current status)."""
+        self.fanout.subscribe(subscriber, ScanEvent("status", self.status))
+
+    def unsubscribe(self, subscriber):
+        self.fanout.unsubscribe(subscriber)
+
+    def drain(self, subscriber):
+        """
+        Events published for `subscriber` since its last drain (never blocks). A
+        subscriber that was never subscribed or was dropped gets "resync" first.
+        """
+        events = self.fanout.drain(subscriber)
+        if events is None:
+            self.subscribe(subscriber)
+            events = [ScanEvent("resync", None)] + self.fanout.drain(subscriber)
+        return events
+
+    def _emit(self, kind, payload=None):
+        if kind == "status":
+            if payload == self.status:
+                return
+            self.status = payload
+        self.fanout.publish(ScanEvent(kind, payload))
+
+    def _token(self):
+        # Refresh helpers update token_data in place, so the session copy stays current
+        with metrics_utils.timed("token_refresh"):
+            token_data, access_token = auth_utils.get_access_token(self.token_data)
+        if not token_data: raise Exception("Token refresh failed")
+        return access_token
+
+    def _watcher(self):
+        if not self.push:
+            return None
+        watcher = imap_utils.get_idle_watcher(self.server, self.user, self._token)
+        return watcher if watcher.supported else None
+
+    def _retry_delay(self, e):
+        """Backoff before retrying a transient error; re-raises anything else."""
+        metrics_utils.inc("scan_errors_total", help="Scan cycles that ended in an error.")
+        if not is_transient_error(e):
+            raise e
+        delay = self.scheduler.after_error()
+        metrics_utils.inc("scan_retries_total", help="Scan cycles retried after a connection error.")
+        print(f"Scan of {self.user} failed ({e}); retrying in {delay:.0f}s")
+        self._emit("status", f"Connection lost, retrying in {delay:.0f}s (attempt {self.scheduler.failures})")
+        return delay
+
+    def _run(self):
+        seen_generation = 0
+        delay = 0.0  # first cycle (and retries) run without waiting for the watcher
+        try:
+            previous = self._await_previous()
+            if previous is not None:
+                previous.join(timeout=30)
+            while not self._stop.is_set():
+                watcher = self._watcher()
+                if delay and self._stop.wait(delay):
+                    break
+                if watcher is not None and not delay:
+                    # Push: scan only when the IDLE connection reported new mail
+                    generation = watcher.wait_for_change(seen_generation, 1.0)
+                    if generation == seen_generation:
+                        continue
+                    seen_generation = generation
+                if self._stop.is_set():
+                    break
+                try:
+                    with metrics_utils.timed("scan_cycle"):
+                        new_messages = self.scan_cycle()
+                except Exception as e:
+                    delay = self._retry_delay(e)
+                    continue
+                if watcher is not None:
+                    self.scheduler.succeeded()
+                    delay = 0.0
+                else:
+                    # Poll: sooner while mail is arriving, backing off while the inbox is quiet
+                    delay = self.scheduler.after_cycle(new_messages)
+        except Exception as e:
+            self._emit("error", f"Connection Error: {e}")
+        finally:
+            if self.push:
+                imap_utils.stop_idle_watcher(self.server, self.user)
+            self._stop.set()
+            self._emit("stopped")
+
+    # --- cycle steps shared by the thread and asyncio drivers ---
+    def _plan_cycle(self, uidvalidity, highestmodseq):
+        """
+        Incremental sync: returns (sync_state, last_uid, since_modseq), or None when
+        CONDSTORE says nothing changed since the last scan (no SEARCH needed).
+        """
+        sync_state = imap_utils.load_sync_state(self.sync_path)
+        imap_utils.reconcile_sync_state(sync_state, uidvalidity)
+        last_uid = sync_state["last_uid"]
+        if last_uid > 0 and highestmodseq is not None and highestmodseq == sync_state.get("highestmodseq"):
+            self._emit("status", "Monitoring (Up to date)")
+            return None
+        since_modseq = sync_state.get("highestmodseq") if (last_uid > 0 and highestmodseq is not None) else None
+        return sync_state, last_uid, since_modseq
+
+    def _select_uids(self, sync_state, last_uid, highestmodseq, all_ids):
+        """Pick this cycle's UIDs (newest first) and advance the persisted high-water mark."""
+        # Initial batch: the newest `limit`; live updates: everything above the mark
+        ids_to_process = all_ids[:self.limit] if last_uid == 0 else all_ids
+        if highestmodseq is not None:
+            sync_state["highestmodseq"] = highestmodseq
+        if not ids_to_process:
+            if highestmodseq is not None:
+                imap_utils.save_sync_state(self.sync_path, sync_state)
+            self._emit("status", "Monitoring (Up to date)" if last_uid > 0 else "No Unread Emails")
+            return []
+
+        self._emit("status", f"Scanning {len(ids_to_process)} emails...")
+        # Update high water mark up front so a message that fails to fetch or
+        # classify is not retried forever
+        sync_state["last_uid"] = max(last_uid, ids_to_process[0])
+        imap_utils.save_sync_state(self.sync_path, sync_state)
+        return ids_to_process
+
+    def _parse_and_classify(self, fetched):
+        fetched = list(fetched)
+        self._emit("status", f"Parsing and classifying {len(fetched)} emails...")
+        return parse_and_classify(self.model, fetched)
+
+    def _build_rows(self, parsed_batch, predictions):
+        built_rows = []
+        for parsed, prediction in zip(parsed_batch, predictions):
+            if prediction is None:
+                continue
+            try:
+                built_rows.append(self.build_row(parsed, *prediction))
+            except Exception as e:
+                print(f"Error processing email {parsed['id']}: {e}")
+        return built_rows
+
+    def _finish_cycle(self, new_rows):
+        """Persist and publish the cycle's rows; returns how many there were."""
+        # Persist the whole cycle with a single append + commit, then publish
+        if new_rows:
+            with metrics_utils.timed("save_history"):
+                self.history_store.append_rows(new_rows)
+            self._emit("rows", new_rows)
+        metrics_utils.inc("scan_cycles_total", help="Completed scan cycles.")
+        metrics_utils.inc("messages_scanned_total", len(new_rows), help="Emails classified, stored and marked read.")
+        metrics_utils.write_prometheus_file()
+        self.last_scan_time = datetime.datetime.now()
+        self._emit("status", "Monitoring (Up to date)")
+        self._emit("cycle", self.last_scan_time)
+        return len(new_rows)
+
+    def scan_cycle(self):
+        """One incremental scan of the inbox; new rows are persisted, then published. Returns their count."""
+        access_token = self._token()
+
+        # Connect with XOAUTH2, reusing the account's pooled connection when it is still
+        # healthy and the token hasn't changed (no TLS handshake / auth / SELECT per cycle)
+        with imap_utils.pooled_connection(self.server, self.user, access_token, "inbox",
+                                          condstore=imap_utils.IMAP_CONDSTORE) as conn:
+            mail = conn.mail
+            plan = self._plan_cycle(conn.uidvalidity, conn.highestmodseq)
+            if plan is None:
+                return 0
+            sync_state, last_uid, since_modseq = plan
+            all_ids = imap_utils.search_unseen_uids(mail, last_uid, since_modseq)
+            ids_to_process = self._select_uids(sync_state, last_uid, conn.highestmodseq, all_ids)
+            if not ids_to_process:
+                return 0
+
+            # Stage 1: fetch the whole batch (one UID FETCH per IMAP_FETCH_CHUNK emails)
+            if imap_utils.IMAP_FETCH_MODE == "partial":
+                # Headers + BODYSTRUCTURE, then only the text sections (no attachments)
+                fetched = (
+                    (uid, header, (body_text, body_html, toks))
+                    for uid, header, body_text, body_html, toks in imap_utils.fetch_messages_partial(mail, ids_to_process)
+                )
+            else:
+                fetched = ((uid, raw, None) for uid, raw in imap_utils.fetch_messages(mail, ids_to_process))
+
+            # Stage 2: parse (process pool) and classify, overlapped
+            parsed_batch, predictions = self._parse_and_classify(fetched)
+
+            # Stage 3: build rows, mark them read in bulk (one UID STORE per chunk)
+            built_rows = self._build_rows(parsed_batch, predictions)
+            seen_ids = imap_utils.mark_seen(mail, [r["ID"] for r in built_rows])
+            new_rows = [row for row in built_rows if row["ID"] in seen_ids]
+
+        return self._finish_cycle(new_rows)
+
+class AsyncAccountScanner(ScannerWorker):
+    """
+    Multi-account mode (SCANNER_BACKEND=asyncio): same interface and cycle steps as
+    ScannerWorker, but the account runs as a task on the shared MultiAccountLoop
+    with one asyncio IMAP connection (scans, then IDLEs on it). Parsing, the shared
+    classifier, sync-state and blob file I/O and SQLite writes run in executors so
+    the loop keeps serving the network I/O of every other account meanwhile.
+    """
+    def __init__(self, hub, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hub = hub
+        self._done = threading.Event()
+
+    def start(self):
+        self.hub.submit(self._run_async())
+        return self
+
+    def is_alive(self):
+        return not self._done.is_set() and not self._stop.is_set()
+
+    def join(self, timeout=None):
+        self._done.wait(timeout)
+
+    async def _sleep(self, seconds):
+        """Sleep that wakes up within a second of stop()."""
+        deadline = time.monotonic() + seconds
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            await asyncio.sleep(min(1.0, deadline - time.monotonic()))
+
+    async def _run_async(self):
+        loop = asyncio.get_running_loop()
+        limiter = self.hub.limiter(self.server)
+        client = selected = None
+        try:
+            previous = self._await_previous()
+            if previous is not None:
+                await loop.run_in_executor(None, previous.join, 30)
+            while not self._stop.is_set():
+                try:
+                    access_token = await loop.run_in_executor(None, self._token)
+                    async with limiter.sessions:
+                        if client is None or not client.is_open or client.access_token != access_token:
+                            if client is not None:
+                                await client.logout()
+                            client = await async_imap_utils.connect_xoauth2(self.server, self.user, access_token, limiter)
+                            selected = None
+                        if selected is None or imap_utils.IMAP_CONDSTORE:
+                            # Fresh HIGHESTMODSEQ needs a re-SELECT; UIDVALIDITY alone does not
+                            selected = await async_imap_utils.select_mailbox(
+                                client, "inbox", condstore=imap_utils.IMAP_CONDSTORE
+                            )
+                        with metrics_utils.timed("scan_cycle"):
+                            new_messages = await self.scan_cycle_async(client, *selected)
+
+                    if self.push and "IDLE" in client.capabilities:
+                        self.scheduler.succeeded()
+                        # Push: park the connection in IDLE until the server reports new mail
+                        while not self._stop.is_set():
+                            if await client.idle(imap_utils.IDLE_REFRESH_SECONDS, self._stop):
+                                break
+                        continue
+                except Exception as e:
+                    delay = self._retry_delay(e)
+                    # Reconnect from scratch on the retry
+                    if client is not None:
+                        await client.logout()
+                    client = selected = None
+                    await self._sleep(delay)
+                    continue
+                # Poll: sooner while mail is arriving, backing off while the inbox is quiet
+                await self._sleep(self.scheduler.after_cycle(new_messages))
+        except Exception as e:
+            self._emit("error", f"Connection Error: {e}")
+        finally:
+            if client is not None:
+                await client.logout()
+            self._stop.set()
+            self._emit("stopped")
+            self._done.set()
+
+    async def scan_cycle_async(self, client, uidvalidity, highestmodseq):
+        loop = asyncio.get_running_loop()
+        # Sync state is a JSON file on disk: load and save it off the loop
+        plan = await loop.run_in_executor(None, self._plan_cycle, uidvalidity, highestmodseq)
+        if plan is None:
+            return 0
+        sync_state, last_uid, since_modseq = plan
+        all_ids = await async_imap_utils.search_unseen_uids(client, last_uid, since_modseq)
+        ids_to_process = await loop.run_in_executor(
+            None, self._select_uids, sync_state, last_uid, highestmodseq, all_ids
+        )
+        if not ids_to_process:
+            return 0
+
+        # Stage 1: fetch over the event loop
+        if imap_utils.IMAP_FETCH_MODE == "partial":
+            fetched = [
+                (uid, header, (body_text, body_html, toks))
+                for uid, header, body_text, body_html, toks in await async_imap_utils.fetch_messages_partial(client, ids_to_process)
+            ]
+        else:
+            fetched = [(uid, raw, None) for uid, raw in await async_imap_utils.fetch_messages(client, ids_to_process)]
+
+        # Stage 2: parse on the process pool; one classifier for all accounts, fed
+        # through a single-thread executor
+        parsed_batch, predictions = await loop.run_in_executor(
+            self.hub.classify_executor, self._parse_and_classify, fetched
+        )
+
+        # Stage 3: build rows (bodies are compressed and written to the blob store, so
+        # off the loop), mark them read in bulk
+        built_rows = await loop.run_in_executor(None, self._build_rows, parsed_batch, predictions)
+        seen_ids = await async_imap_utils.mark_seen(client, [r["ID"] for r in built_rows])
+        new_rows = [row for row in built_rows if row["ID"] in seen_ids]
+        return await loop.run_in_executor(None, self._finish_cycle, new_rows)
+
+class MultiAccountLoop:
+    """One event loop thread shared by every account scanned in asyncio mode."""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.classify_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="classify")
+        self._limiters = {}
+        self._thread = threading.Thread(target=self._run, name="imap-asyncio", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def limiter(self, server):
+        """Per-provider limiter (called on the loop thread)."""
+        limiter = self._limiters.get(server)
+        if limiter is None:
+            limiter = self._limiters[server] = async_imap_utils.ProviderLimiter()
+        return limiter
+
+_HUB = None
+_HUB_LOCK = threading.Lock()
+
+def get_multi_account_loop():
+    global _HUB
+    with _HUB_LOCK:
+        if _HUB is None:
+            _HUB = MultiAccountLoop()
+        return _HUB
+
+_SCANNERS = {}
+_SCANNERS_LOCK = threading.Lock()
+
+def _key(server, user):
+    return (server, user.strip().lower())
+
+def get_scanner(server, user):
+    """The account's worker (running, or stopped with events left to drain), or None."""
+    with _SCANNERS_LOCK:
+        return _SCANNERS.get(_key(server, user))
+
+# A running worker is reused only if it scans with these same settings
+RESTART_SETTINGS = ("limit", "push", "poll_seconds", "model")
+
+def _same_settings(worker, kwargs):
+    return all(getattr(worker, name) == kwargs[name] for name in RESTART_SETTINGS if name in kwargs)
+
+def start_scanner(server, user, subscriber=None, **kwargs):
+    """
+    Process-wide: one scanner per account. The running one is reused when its settings
+    match; otherwise it is stopped and the new worker takes over once it has finished
+    (in the worker, so the caller never blocks). `subscriber` gets the worker's events.
+    """
+    key = _key(server, user)
+    with _SCANNERS_LOCK:
+        previous = _SCANNERS.get(key)
+        if previous is not None and previous.is_alive() and _same_settings(previous, kwargs):
+            if subscriber is not None:
+                previous.subscribe(subscriber)
+            return previous
+        if SCANNER_BACKEND == "asyncio":
+            worker = AsyncAccountScanner(get_multi_account_loop(), server, user, **kwargs)
+        else:
+            worker = ScannerWorker(server, user, **kwargs)
+        if previous is not None:
+            previous.stop()
+            worker.follow(previous)
+        if subscriber is not None:
+            worker.subscribe(subscriber)
+        worker = _SCANNERS[key] = worker.start()
+        return worker
+
+def active_scanners():
+    """Number of accounts currently being scanned in this process."""
+    with _SCANNERS_LOCK:
+        return sum(1 for worker in _SCANNERS.values() if worker.is_alive())
+
+def stop_scanner(server, user, wait=False):
+    # The worker stays registered so rows from a cycle that was already running can
+    # still be drained; start_scanner replaces it
+    worker = get_scanner(server, user)
+    if worker is not None:
+        worker.stop()
+        if wait:
+            worker.join(timeout=30)
+    return worker
@@ -0,0 +1,35 @@
+import asyncio
+import async_imap_utils
+import imap_utils
+from benchmark import BenchIMAPServer, BENCH_USER, BENCH_TOKEN
+
+RAW = b"From: a@example.com\r\nSubject: hi\r\n\r\nbody\r\n"
+
+def _search_all(uids):
+    server = BenchIMAPServer([(uid, RAW) for uid in uids]).start()
+    previous_ssl = imap_utils.IMAP_SSL
+    imap_utils.IMAP_SSL = False
+
+    async def run():
+        client = await async_imap_utils.connect_xoauth2(server.host, BENCH_USER, BENCH_TOKEN, port=server.port)
+        try:
+            await async_imap_utils.select_mailbox(client)
+            return await async_imap_utils.search_unseen_uids(client)
+        finally:
+            await client.logout()
+
+    try:
+        return asyncio.run(run())
+    finally:
+        imap_utils.IMAP_SSL = previous_ssl
+        server.stop()
+
+def test_search_response_longer_than_64k_seven_digit_uids():
+    # ~9,000 unread 7-digit UIDs: one SEARCH line of ~72 KB
+    uids = list(range(1000000, 1009000))
+    assert sorted(_search_all(uids)) == uids
+
+def test_search_response_longer_than_64k_many_small_uids():
+    uids = list(range(1, 60001))
+    found = _search_all(uids)
+    assert len(found) == 60000 and set(found) == set(uids)
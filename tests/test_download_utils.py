@@ -0,0 +1,108 @@
+import io
+import os
+import time
+import hashlib
+import zipfile
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import download_utils
+
+def _zip_bytes():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("config.json", "{}")
+        zf.writestr("weights.bin", os.urandom(64 * 1024))
+    return buf.getvalue()
+
+class _ArtifactServer:
+    """Serves one payload with Range support; the first `cut_after` bytes of a full
+    response are sent before the connection drops, once."""
+    def __init__(self, payload, cut_after=None):
+        self.payload = payload
+        self.cut_after = cut_after
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                rng = self.headers.get("Range")
+                server.requests.append(rng)
+                start = int(rng[len("bytes="):].rstrip("-")) if rng else 0
+                body = server.payload[start:]
+                self.send_response(206 if rng else 200)
+                if rng:
+                    self.send_header("Content-Range", f"bytes {start}-{len(server.payload) - 1}/{len(server.payload)}")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if not rng and server.cut_after is not None:
+                    body, server.cut_after = body[:server.cut_after], None
+                    self.wfile.write(body)
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/model.zip"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest.fixture
+def no_retry_sleep(monkeypatch):
+    monkeypatch.setattr(download_utils.time, "sleep", lambda seconds: None)
+
+def test_interrupted_download_resumes_with_range(tmp_path, no_retry_sleep, monkeypatch):
+    monkeypatch.setattr(download_utils, "DOWNLOAD_CHUNK_BYTES", 4096)
+    payload = _zip_bytes()
+    # The unfinished last chunk is lost with the connection; whole chunks are on disk
+    server = _ArtifactServer(payload, cut_after=5 * 4096 + 100)
+    try:
+        version_dir = download_utils.fetch_artifact(
+            server.url, str(tmp_path), sha256=hashlib.sha256(payload).hexdigest(), required_file="config.json",
+        )
+    finally:
+        server.close()
+    assert server.requests == [None, f"bytes={5 * 4096}-"]
+    assert os.path.exists(os.path.join(version_dir, "config.json"))
+    assert not os.path.exists(tmp_path / "download.part")
+
+def test_checksum_mismatch_deletes_the_partial_file(tmp_path, no_retry_sleep):
+    server = _ArtifactServer(_zip_bytes())
+    try:
+        with pytest.raises(download_utils.DownloadError, match="checksum mismatch"):
+            download_utils.fetch_artifact(server.url, str(tmp_path), sha256="0" * 64)
+    finally:
+        server.close()
+    assert not os.path.exists(tmp_path / "download.part")
+    assert download_utils.current_version_dir(str(tmp_path)) is None
+
+def _hold_lock(path, log_path, hold_seconds):
+    with download_utils.FileLock(path):
+        entered = time.monotonic()
+        time.sleep(hold_seconds)
+        left = time.monotonic()
+    with open(log_path, "a", encoding="utf-8") as f:
+        f.write(f"{entered} {left}\n")
+
+def test_file_lock_excludes_other_processes(tmp_path):
+    ctx = multiprocessing.get_context("spawn")
+    lock_path, log_path = str(tmp_path / ".lock"), str(tmp_path / "log")
+    workers = [ctx.Process(target=_hold_lock, args=(lock_path, log_path, 0.5)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=30)
+        assert worker.exitcode == 0
+    with open(log_path, encoding="utf-8") as f:
+        (a_in, a_out), (b_in, b_out) = sorted(tuple(map(float, line.split())) for line in f)
+    assert b_in >= a_out
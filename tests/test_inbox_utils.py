@@ -0,0 +1,24 @@
+from inbox_utils import InboxModel, RenderScheduler
+
+def _row(i):
+    return {"ID": i, "Sender": f"s{i}", "Subject": f"m{i}", "Priority": "Low", "Time": "10:00"}
+
+def test_render_scheduler_follows_a_replaced_inbox():
+    state = {"inbox": InboxModel()}
+    drawn = []
+    scheduler = RenderScheduler(lambda: state["inbox"], lambda: drawn.append(len(state["inbox"])),
+                                interval=3600, min_rows=0)
+    state["inbox"] = InboxModel([_row(1), _row(2)])
+    assert scheduler.notify() and drawn == [2]
+    state["inbox"].insert(_row(3))
+    assert not scheduler.notify()
+    assert scheduler.flush() and drawn == [2, 3]
+    assert not scheduler.pending
+
+def test_render_scheduler_accepts_a_fixed_inbox():
+    inbox = InboxModel()
+    scheduler = RenderScheduler(inbox, lambda: None, interval=3600, min_rows=2)
+    inbox.insert(_row(1))
+    assert not scheduler.notify()
+    inbox.insert(_row(2))
+    assert scheduler.notify() and scheduler.renders == 1
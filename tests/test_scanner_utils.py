@@ -0,0 +1,16 @@
+from scanner_utils import PollScheduler
+
+def test_quiet_cycles_back_off_and_new_mail_resets():
+    s = PollScheduler(base=5, max_seconds=40, factor=2, jitter=0)
+    assert [s.after_cycle(0) for _ in range(4)] == [10, 20, 40, 40]
+    assert s.after_cycle(3) == 5
+
+def test_success_resets_retry_backoff():
+    s = PollScheduler(base=5, factor=2, jitter=0, retry_max_seconds=300)
+    assert [s.after_error() for _ in range(3)] == [5, 10, 20]
+    s.succeeded()
+    assert s.after_error() == 5 and s.failures == 1
+
+def test_jitter_stays_within_bounds():
+    s = PollScheduler(base=10, max_seconds=10, jitter=0.2)
+    assert all(8 <= s.after_cycle(1) <= 12 for _ in range(200))